@@ -0,0 +1,77 @@
+"""Compare two benchmark results files from benchmarks.run.
+
+Usage (from the osm_opensidewalks directory):
+
+    python -m benchmarks.compare base.json new.json --threshold 0.1
+
+Exits with status 1 if any stage got slower (or used more memory) than the
+threshold allows.
+
+"""
+import json
+
+import click
+
+
+def load_results(path):
+    """Benchmark results keyed by (elements, stage)."""
+    with open(path) as f:
+        report = json.load(f)
+    return {
+        (result["elements"], result["stage"]): result
+        for result in report["results"]
+    }
+
+
+def compare(base, new, threshold=0.1):
+    """Compare the wall time and peak RSS of the stages in both results.
+
+    :param base: Results from load_results.
+    :type base: dict
+    :param new: Results from load_results.
+    :type new: dict
+    :param threshold: Largest allowed relative increase, e.g. 0.1 for 10%.
+    :type threshold: float
+    :returns: List of (elements, stage, metric, base value, new value,
+              ratio, regressed) tuples.
+
+    """
+    rows = []
+    for key in sorted(base.keys() & new.keys()):
+        for metric in ("wall_time", "peak_rss"):
+            before = base[key][metric]
+            after = new[key][metric]
+            ratio = after / before if before else float("inf")
+            rows.append(
+                (*key, metric, before, after, ratio, ratio > 1 + threshold)
+            )
+    return rows
+
+
+def _format(metric, value):
+    if metric == "peak_rss":
+        return f"{value / 2**20:.1f} MB"
+    return f"{value:.3f} s"
+
+
+@click.command()
+@click.argument("base", type=click.Path(exists=True))
+@click.argument("new", type=click.Path(exists=True))
+@click.option("-t", "--threshold", default=0.1, type=click.FloatRange(min=0))
+def main(base, new, threshold):
+    rows = compare(load_results(base), load_results(new), threshold)
+    regressed = False
+    for elements, stage, metric, before, after, ratio, slower in rows:
+        flag = "  REGRESSION" if slower else ""
+        click.echo(
+            f"{elements:>10} {stage:<22} {metric:<10} "
+            f"{_format(metric, before):>12} -> {_format(metric, after):>12} "
+            f"({ratio:.2f}x){flag}"
+        )
+        regressed |= slower
+    if regressed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Time the pipeline's stages on synthetic data at several scales.
+
+Usage (from the osm_opensidewalks directory):
+
+    python -m benchmarks.run -s 1000 -s 100000 -o results.json
+
+Synthetic data is generated once per scale and cached in the data
+directory. Every stage is run `--repeat` times. Results are written as JSON
+that can be compared with benchmarks.compare.
+
+"""
+import datetime
+import json
+import statistics
+import subprocess
+from pathlib import Path
+
+import click
+
+from osm_osw.constants import BUFFER_DIST
+from osm_osw.inference.curb_ramps import infer_curbramps
+from osm_osw.osm.osm_graph import OSMGraph
+from osm_osw.report import host_info, measure_call
+from osm_osw.stages import (
+    extract_masked_geometries,
+    graph_path,
+    infer_region_inclines,
+    mask_tileset,
+)
+
+from .synthetic import grid_bounds, grid_size, write_dem, write_pbf
+
+REGION_ID = "bench"
+TILESET = "synthetic"
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+
+# Stages in the order they're run, and the stages each one needs to have
+# run first.
+STAGES = {
+    "from_pbf": [],
+    "simplify": ["from_pbf"],
+    "construct_geometries": ["simplify"],
+    "infer_curbramps": ["construct_geometries"],
+    "extract": [],
+    "mask": ["extract"],
+    "incline": ["infer_curbramps", "mask"],
+}
+
+
+def _with_prerequisites(stages):
+    needed = set()
+
+    def add(stage):
+        if stage not in needed:
+            needed.add(stage)
+            for prerequisite in STAGES[stage]:
+                add(prerequisite)
+
+    for stage in stages:
+        add(stage)
+    return [stage for stage in STAGES if stage in needed]
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_data(data_dir, elements, regenerate=False):
+    """Generate (or reuse) the synthetic .osm.pbf and DEM for a scale.
+
+    :param data_dir: Directory for cached data. Each scale gets its own
+                     subdirectory, laid out like a working directory.
+    :type data_dir: str
+    :param elements: Approximate number of OSM elements.
+    :type elements: int
+    :param regenerate: Generate the data even if it's cached.
+    :type regenerate: bool
+    :returns: Tuple of (working directory, dict of data sizes).
+
+    """
+    workdir = Path(data_dir, str(elements))
+    info_path = Path(workdir, "data.json")
+    if info_path.exists() and not regenerate:
+        with open(info_path) as f:
+            return workdir, json.load(f)
+
+    workdir.mkdir(parents=True, exist_ok=True)
+    n = grid_size(elements)
+    info = {"grid_size": n}
+    info.update(write_pbf(Path(workdir, f"{REGION_ID}.osm.pbf"), n))
+    width, height = write_dem(
+        Path(workdir, "dems", f"{TILESET}.tif"), grid_bounds(n)
+    )
+    info["dem_pixels"] = width * height
+
+    with open(info_path, "w") as f:
+        json.dump(info, f)
+    return workdir, info
+
+
+def run_stages(workdir, stages, jobs=1, allocations=0):
+    """Run stages once on a scale's data.
+
+    :param workdir: The scale's working directory, from prepare_data.
+    :type workdir: str
+    :param stages: Names of the stages to run, in order, with their
+                   prerequisites.
+    :type stages: list of str
+    :param jobs: Number of worker processes used to parse the .osm.pbf.
+    :type jobs: int
+    :param allocations: Number of top allocating source lines to record.
+    :type allocations: int
+    :returns: dict of measurement records (see measure_call), keyed by
+              stage.
+
+    """
+    options = {"allocations": allocations, "process": True}
+    records = {}
+    OG = None
+    polygons = None
+
+    def measure(stage, func, *args, **kwargs):
+        result, records[stage] = measure_call(
+            (stage, None), options, func, *args, **kwargs
+        )
+        return result
+
+    for stage in stages:
+        if stage == "from_pbf":
+            pbf_path = str(Path(workdir, f"{REGION_ID}.osm.pbf"))
+            OG = measure(stage, OSMGraph.from_pbf, pbf_path, jobs=jobs)
+        elif stage == "simplify":
+            measure(stage, OG.simplify)
+        elif stage == "construct_geometries":
+            measure(stage, OG.construct_geometries)
+        elif stage == "infer_curbramps":
+            measure(stage, infer_curbramps, OG)
+            OG.save(graph_path(workdir, REGION_ID))
+        elif stage == "extract":
+            polygons = measure(
+                stage,
+                extract_masked_geometries,
+                workdir,
+                REGION_ID,
+                BUFFER_DIST,
+            )
+        elif stage == "mask":
+            measure(
+                stage,
+                mask_tileset,
+                Path(workdir, "dems", f"{TILESET}.tif"),
+                polygons,
+            )
+        elif stage == "incline":
+            measure(
+                stage, infer_region_inclines, workdir, REGION_ID, [TILESET]
+            )
+
+    return records
+
+
+def summarize(runs):
+    """Combine the records of repeated runs of a stage: the fastest and
+    median wall time, the least CPU time and the largest peak RSS.
+
+    :param runs: Records from measure_call.
+    :type runs: list of dict
+    :returns: dict
+
+    """
+    wall_times = [run["wall_time"] for run in runs]
+    summary = {
+        "wall_time": min(wall_times),
+        "median_wall_time": statistics.median(wall_times),
+        "wall_times": wall_times,
+        "cpu_time": min(run["cpu_time"] for run in runs),
+        "children_cpu_time": min(run["children_cpu_time"] for run in runs),
+        "peak_rss": max(run["peak_rss"] for run in runs),
+        "counts": runs[-1]["counts"],
+    }
+    if "allocations" in runs[-1]:
+        summary["traced_peak"] = max(run["traced_peak"] for run in runs)
+        summary["allocations"] = runs[-1]["allocations"]
+    return summary
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--scale",
+    "scales",
+    multiple=True,
+    type=click.IntRange(min=1),
+    help="Approximate number of OSM elements. Can be given several times.",
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(list(STAGES)),
+    help="Stage to time (with any stages it needs). Defaults to all.",
+)
+@click.option("-o", "--output", required=True, type=click.Path())
+@click.option(
+    "--data-dir",
+    envvar="OSM_OSW_BENCHMARK_DATA",
+    default="/tmp/osm_osw_benchmarks",
+    type=click.Path(file_okay=False),
+)
+@click.option("-r", "--repeat", default=3, type=click.IntRange(min=1))
+@click.option("-j", "--jobs", default=1, type=click.IntRange(min=1))
+@click.option("--allocations", default=0, type=click.IntRange(min=0))
+@click.option("--regenerate", is_flag=True)
+def run(
+    scales, stages, output, data_dir, repeat, jobs, allocations, regenerate
+):
+    scales = scales or DEFAULT_SCALES
+    selected = stages or list(STAGES)
+    stages = _with_prerequisites(selected)
+
+    report = {
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": _revision(),
+        "host": host_info(),
+        "repeat": repeat,
+        "jobs": jobs,
+        "results": [],
+    }
+    for elements in scales:
+        click.echo(f"Preparing {elements} elements...")
+        workdir, data = prepare_data(data_dir, elements, regenerate)
+
+        runs = {stage: [] for stage in stages}
+        for i in range(repeat):
+            click.echo(f"  run {i + 1} of {repeat}")
+            records = run_stages(workdir, stages, jobs, allocations)
+            for stage, record in records.items():
+                runs[stage].append(record)
+
+        for stage in stages:
+            if stage not in selected:
+                continue
+            summary = summarize(runs[stage])
+            click.echo(
+                f"  {stage}: {summary['wall_time']:.3f} s, "
+                f"{summary['peak_rss'] / 2**20:.0f} MB"
+            )
+            report["results"].append(
+                {"elements": elements, **data, "stage": stage, **summary}
+            )
+
+        # Results are saved after every scale, so larger scales can be
+        # interrupted.
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    run()
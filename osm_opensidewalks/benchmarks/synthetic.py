@@ -0,0 +1,270 @@
+"""Synthetic OpenStreetMap and DEM data for benchmarks.
+
+The OSM data is a grid of streets with interior vertices, sidewalks along
+the east-west streets, crossings with kerb nodes, a building on every block,
+bridges and some untagged and ignored elements. The DEM is a gently sloping,
+rippled surface covering the grid.
+
+"""
+import math
+from pathlib import Path
+
+import numpy as np
+import osmium
+from osmium.osm.mutable import Node, Way
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Distance between grid streets, in degrees.
+SPACING = 0.001
+
+# Southwest corner of the grid.
+LON0 = -122.3
+LAT0 = 47.6
+
+# NED 1/3 arc-second resolution, in degrees.
+DEM_RESOLUTION = 1 / 10800
+
+# DEM margin around the grid, in degrees.
+DEM_MARGIN = 0.005
+
+# Number of DEM rows written at a time.
+DEM_BLOCK_ROWS = 256
+
+# Approximate number of OSM elements per grid intersection.
+ELEMENTS_PER_INTERSECTION = 12
+
+
+def grid_size(elements):
+    """Number of streets in each direction of a grid with about the given
+    number of OSM elements.
+
+    :param elements: Number of nodes and ways.
+    :type elements: int
+    :returns: int
+
+    """
+    return max(2, round(math.sqrt(elements / ELEMENTS_PER_INTERSECTION)))
+
+
+def grid_bounds(n):
+    """Bounds of a grid's elements: [w, s, e, n]."""
+    return [
+        LON0 - 2 * SPACING,
+        LAT0 - 2 * SPACING,
+        LON0 + (n - 1) * SPACING,
+        LAT0 + (n - 1) * SPACING,
+    ]
+
+
+def _elements(n):
+    # Yields ("node", id, (lon, lat), tags) and ("way", id, refs, tags)
+    # tuples. Ids are deterministic, so the file can be written in two
+    # passes (nodes, then ways) without holding every element in memory.
+    next_ids = {"node": 0, "way": 0}
+
+    def new_id(kind):
+        next_ids[kind] += 1
+        return next_ids[kind]
+
+    def node(lon, lat, tags=None):
+        return ("node", new_id("node"), (lon, lat), tags or {})
+
+    def way(refs, tags):
+        return ("way", new_id("way"), refs, tags)
+
+    # Intersections are nodes 1 to n * n.
+    def intersection(i, j):
+        return i * n + j + 1
+
+    for i in range(n):
+        for j in range(n):
+            yield node(LON0 + i * SPACING, LAT0 + j * SPACING)
+
+    # Nodes with tags that aren't on any way.
+    for k in range(20):
+        yield node(LON0 - SPACING - k * 1e-5, LAT0 - SPACING, {"amenity": "x"})
+
+    # East-west streets with an interior vertex per block.
+    for j in range(n):
+        refs = []
+        for i in range(n):
+            refs.append(intersection(i, j))
+            if i < n - 1:
+                element = node(LON0 + (i + 0.5) * SPACING, LAT0 + j * SPACING)
+                refs.append(element[1])
+                yield element
+        yield way(refs, {"highway": "residential", "width": "7.5"})
+
+    # North-south streets with two interior vertices per block.
+    for i in range(n):
+        refs = []
+        for j in range(n):
+            refs.append(intersection(i, j))
+            if j < n - 1:
+                for t in (0.3, 0.6):
+                    element = node(
+                        LON0 + i * SPACING, LAT0 + (j + t) * SPACING
+                    )
+                    refs.append(element[1])
+                    yield element
+        highway = "service" if i % 2 else "tertiary"
+        yield way(refs, {"highway": highway})
+
+    # Sidewalks north of each east-west street, each with a crossing of the
+    # street at its western end.
+    offset = SPACING * 0.1
+    for j in range(n - 1):
+        lat = LAT0 + j * SPACING
+        refs = []
+        for i in range(2 * n - 1):
+            element = node(LON0 + i * 0.5 * SPACING, lat + offset)
+            refs.append(element[1])
+            yield element
+        incline = "0.02" if j % 2 else "up"
+        yield way(
+            refs,
+            {"highway": "footway", "footway": "sidewalk", "incline": incline},
+        )
+
+        lon = LON0 + 0.2 * SPACING
+        kerbs = [
+            node(
+                lon,
+                lat + offset * 0.9,
+                {
+                    "kerb": "lowered",
+                    "barrier": "kerb",
+                    "tactile_paving": "yes",
+                },
+            ),
+            node(lon, lat),
+            node(
+                lon,
+                lat - offset * 0.9,
+                {"kerb": "raised" if j % 2 else "flush"},
+            ),
+        ]
+        yield from kerbs
+        crossing = "zebra" if j % 2 else "unmarked"
+        yield way(
+            [refs[0]] + [element[1] for element in kerbs],
+            {
+                "highway": "footway",
+                "footway": "crossing",
+                "crossing": crossing,
+            },
+        )
+
+    # A footway joining the grid, and a way that isn't part of the network.
+    corners = [
+        node(LON0 - SPACING, LAT0 - SPACING),
+        node(LON0 - 2 * SPACING, LAT0 - SPACING),
+        node(LON0 - 2 * SPACING, LAT0 - 2 * SPACING),
+    ]
+    yield from corners
+    refs = [element[1] for element in corners]
+    yield way(refs + [intersection(0, 0)], {"highway": "footway"})
+    yield way([refs[0], refs[2]], {"highway": "motorway"})
+
+    # A building on every block, and a bridge (line and area) on every tenth.
+    size = SPACING * 0.3
+    for i in range(n - 1):
+        for j in range(n - 1):
+            x = LON0 + (i + 0.3) * SPACING
+            y = LAT0 + (j + 0.3) * SPACING
+            ring = [
+                node(x, y),
+                node(x + size, y),
+                node(x + size, y + size),
+                node(x, y + size),
+            ]
+            yield from ring
+            refs = [element[1] for element in ring]
+            if (i + j) % 10:
+                yield way(refs + [refs[0]], {"building": "yes"})
+                continue
+            yield way(refs + [refs[0]], {"man_made": "bridge"})
+            yield way(
+                [refs[0], refs[2]],
+                {"highway": "footway", "bridge": "yes", "layer": "1"},
+            )
+
+
+def write_pbf(path, n):
+    """Write a synthetic grid of n by n streets to an .osm.pbf file.
+
+    :param path: Path to the .osm.pbf file. It is replaced if it exists.
+    :type path: str
+    :param n: Number of streets in each direction.
+    :type n: int
+    :returns: dict with the number of "nodes" and "ways" written.
+
+    """
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+
+    counts = {"nodes": 0, "ways": 0}
+    writer = osmium.SimpleWriter(str(path))
+    try:
+        for kind, element_id, value, tags in _elements(n):
+            if kind == "node":
+                writer.add_node(Node(id=element_id, location=value, tags=tags))
+                counts["nodes"] += 1
+        for kind, element_id, value, tags in _elements(n):
+            if kind == "way":
+                writer.add_way(Way(id=element_id, nodes=value, tags=tags))
+                counts["ways"] += 1
+    finally:
+        writer.close()
+
+    return counts
+
+
+def write_dem(path, bounds, resolution=DEM_RESOLUTION):
+    """Write a synthetic float32 DEM GeoTIFF covering the given bounds.
+
+    :param path: Path to the GeoTIFF. It is replaced if it exists.
+    :type path: str
+    :param bounds: Bounding box [w, s, e, n] in degrees. The DEM extends
+                   DEM_MARGIN beyond it.
+    :type bounds: list of float
+    :param resolution: Pixel size in degrees.
+    :type resolution: float
+    :returns: Tuple of (width, height) in pixels.
+
+    """
+    west = bounds[0] - DEM_MARGIN
+    north = bounds[3] + DEM_MARGIN
+    width = math.ceil((bounds[2] + DEM_MARGIN - west) / resolution)
+    height = math.ceil((north - bounds[1] + DEM_MARGIN) / resolution)
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(west, north, resolution, resolution),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dem:
+        cols = np.arange(width)
+        for row in range(0, height, DEM_BLOCK_ROWS):
+            rows = np.arange(row, min(row + DEM_BLOCK_ROWS, height))
+            xs, ys = np.meshgrid(cols, rows)
+            z = 100 + 0.05 * xs + 0.02 * ys + 3 * np.sin(xs / 40.0)
+            dem.write(
+                z.astype("float32"),
+                1,
+                window=Window(0, row, width, len(rows)),
+            )
+
+    return width, height
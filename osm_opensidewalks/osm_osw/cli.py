@@ -1,27 +1,129 @@
 """osm_opensidewalks CLI."""
 import asyncio
-import json
+import functools
+import os
 from pathlib import Path
+from typing import Optional, Tuple
 
 import click
-import rasterio
 from shapely.geometry import shape
 
 from .constants import BUFFER_DIST, TMP_DIR
-from .dems.transforms import get_ned13_for_bounds, infer_incline, list_ned13s
-from .dems.mask_dem import (
-    count_masked_areas,
-    count_bridges,
-    extract_areas,
-    extract_bridges,
-    mask_dem,
-)
+from .dems.transforms import get_ned13_for_bounds, list_ned13s
+from .manifest import Manifest
 from .osm.osm_clip import osm_clip
-from .osm.osm_graph import OSMGraph, NodeCounter, WayCounter
 from .osm.fetch import osm_fetch
-from .osw.osw_normalizer import OSWWayNormalizer, OSWNodeNormalizer
+from .parallel import run_jobs
+from .pipeline import (
+    clip_key,
+    curbramps_key,
+    dem_path,
+    incline_key,
+    mask_key,
+    merge_key,
+    network_key,
+    region_tilesets,
+    runall_tasks,
+)
+from .report import Report
+from .scheduler import run_tasks
 from .schemas.config_schema import ConfigSchema
-from .inference.curb_ramps import infer_curbramps as infer_osm_curbramps
+from .stages import (
+    apply_region_changes,
+    build_network,
+    extract_masked_geometries,
+    graph_path,
+    infer_region_curbramps,
+    infer_region_inclines,
+    mask_tileset,
+    merge_regions,
+    tileset_polygons,
+)
+
+# Number of worker processes used for per-region stages.
+JOBS_OPTION = click.option(
+    "-j",
+    "--jobs",
+    envvar="OSM_OSW_JOBS",
+    default=1,
+    type=click.IntRange(min=1),
+)
+
+# Memory budget for the tasks that runall runs at once.
+MEMORY_OPTION = click.option(
+    "-m",
+    "--memory",
+    envvar="OSM_OSW_MEMORY",
+    type=click.IntRange(min=1),
+    help=(
+        "Memory budget in MB for concurrently running tasks (estimated from "
+        "input sizes). Unlimited by default."
+    ),
+)
+
+# Stages skip regions (and DEM tiles) whose inputs haven't changed since they
+# were last built, as recorded in the working directory's manifest, unless
+# forced.
+FORCE_OPTION = click.option(
+    "-f",
+    "--force",
+    envvar="OSM_OSW_FORCE",
+    is_flag=True,
+    help="Rebuild outputs even if their inputs haven't changed.",
+)
+
+# By default, DEM pixels are masked if their centers are in a building or
+# bridge. All-touched masking is more conservative near small features.
+ALL_TOUCHED_OPTION = click.option(
+    "--all-touched",
+    envvar="OSM_OSW_ALL_TOUCHED",
+    is_flag=True,
+    help="Mask every DEM pixel that a building or bridge touches.",
+)
+
+# Incline inference only reads the DEM pixels around network nodes, so in
+# region of interest mode only those pixels are masked.
+ROI_OPTION = click.option(
+    "--roi",
+    envvar="OSM_OSW_ROI",
+    is_flag=True,
+    help="Only mask the DEM pixels around network nodes.",
+)
+
+
+def report_options(command):
+    """Add performance report options to a command. The command is given a
+    Report (which only measures anything when --report is given) as its
+    `report` argument, and the report is written when the command finishes.
+
+    """
+
+    @click.option(
+        "--report",
+        "report_path",
+        envvar="OSM_OSW_REPORT",
+        type=click.Path(dir_okay=False),
+        help=(
+            "Write a JSON report of the wall time, CPU time, peak memory and "
+            "element counts of every stage of every region."
+        ),
+    )
+    @click.option(
+        "--report-allocations",
+        envvar="OSM_OSW_REPORT_ALLOCATIONS",
+        default=0,
+        type=click.IntRange(min=0),
+        help=(
+            "Also report the top N allocating source lines of every stage, "
+            "using tracemalloc (slow)."
+        ),
+    )
+    @functools.wraps(command)
+    def wrapper(*args, report_path, report_allocations, **kwargs):
+        with Report(report_path, command.__name__, report_allocations) as r:
+            return command(*args, report=r, **kwargs)
+
+    return wrapper
 
 
 @click.group()
@@ -32,12 +134,15 @@ def osm_osw() -> None:
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def fetch(config: str, workdir: str) -> None:
+@report_options
+def fetch(config: str, workdir: str, report: Report) -> None:
     config = ConfigSchema.dict_from_filepath(config)
 
     for feature in config["features"]:
         click.echo(f"Fetching osm.pbf for {feature['properties']['name']}...")
-        download_path = osm_fetch(
+        download_path = report.call(
+            ("fetch", feature["properties"]["id"]),
+            osm_fetch,
             feature["properties"]["extract_url"],
             workdir,
             progressbar=True,
@@ -48,15 +153,16 @@ def fetch(config: str, workdir: str) -> None:
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def clip(config: str, workdir: str) -> None:
+@FORCE_OPTION
+@report_options
+def clip(config: str, workdir: str, force: bool, report: Report) -> None:
     # FIXME: add option to configure number of simultaneous processes and/or
     # maximum memory usage.
     config = ConfigSchema.dict_from_filepath(config)
-
-    regions = [region["properties"]["id"] for region in config["features"]]
-    click.echo(f"Extracting clipped .osm.pbf regions for {', '.join(regions)}")
+    manifest = Manifest(workdir, force)
 
     osm_clips = []
+    clipped = []
     for region in config["features"]:
         extract_path = Path(
             workdir, Path(region["properties"]["extract_url"]).name
@@ -66,12 +172,29 @@ def clip(config: str, workdir: str) -> None:
 
         clipped_path = Path(workdir, f"{region_id}.osm.pbf")
 
+        key = clip_key(manifest, workdir, region)
+        if manifest.is_fresh(clipped_path, "clip", key):
+            continue
+
         osm_clips.append(osm_clip(extract_path, clipped_path, region))
+        clipped.append((region_id, clipped_path, key))
+
+    if not clipped:
+        click.echo("Clipped OSM PBFs are up to date.")
+        return
+
+    regions = [region_id for region_id, _, _ in clipped]
+    click.echo(f"Extracting clipped .osm.pbf regions for {', '.join(regions)}")
 
     async def run_all_osm_clips():
         await asyncio.gather(*osm_clips)
 
-    asyncio.run(run_all_osm_clips())
+    # Regions are clipped at the same time, so they're measured together.
+    report.call(("clip", None), asyncio.run, run_all_osm_clips())
+
+    for _, clipped_path, key in clipped:
+        manifest.record(clipped_path, "clip", key, creates=True)
+    manifest.save()
 
     click.echo("Clipped OSM PBFs.")
 
@@ -80,365 +203,470 @@ def clip(config: str, workdir: str) -> None:
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
 @click.option("-s/-ns", "--simplify/--no_simplify", default=True)
-def network(config: str, workdir: str, simplify: bool) -> None:
-    # FIXME: move at least some of the async functionality to upstream modules,
-    # e.g. the 'asyncifying' run_in_executor-using async functions
+@JOBS_OPTION
+@FORCE_OPTION
+@report_options
+def network(
+    config: str,
+    workdir: str,
+    simplify: bool,
+    jobs: int,
+    force: bool,
+    report: Report,
+) -> None:
     config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir, force)
 
-    # FIXME: define this at a module-level and make it the default behavior.
-    # OpenSidewalks Schema-fication should be hardcoded (for now).
-    def opensidewalks_way_filter(tags):
-        normalizer = OSWWayNormalizer(tags)
-        return normalizer.filter()
-
-    def opensidewalks_node_filter(tags):
-        normalizer = OSWNodeNormalizer(tags)
-        return normalizer.filter()
-
-    #
-    # Get counts of all ways/nodes in each dataset
-    #
-
-    async def count_ways(pbf_path: str):
-        loop = asyncio.get_event_loop()
-        way_counter = WayCounter()
-        await loop.run_in_executor(None, way_counter.apply_file, pbf_path)
-        return way_counter.count
-
-    async def count_nodes(pbf_path: str):
-        loop = asyncio.get_event_loop()
-        node_counter = NodeCounter()
-        await loop.run_in_executor(None, node_counter.apply_file, pbf_path)
-        return node_counter.count
-
-    tasks = []
+    keys = {}
     for region in config["features"]:
         region_id = region["properties"]["id"]
-        pbf_path = str(Path(workdir, f"{region_id}.osm.pbf"))
-        tasks.append(count_ways(pbf_path))
-        tasks.append(count_nodes(pbf_path))
+        key = network_key(manifest, workdir, region_id, simplify)
+        if not manifest.is_fresh(
+            graph_path(workdir, region_id), "network", key
+        ):
+            keys[region_id] = key
+
+    if not keys:
+        click.echo("Networks are up to date.")
+        return
+
+    region_ids = list(keys)
+
+    # Progress is measured in bytes read, so no counting passes are needed.
+    pbf_size = sum(
+        os.path.getsize(Path(workdir, f"{region_id}.osm.pbf"))
+        for region_id in region_ids
+    )
+
+    # Each region is read, simplified, given geometries and written to file
+    # by a single worker so that graphs never need to be sent between
+    # processes. With fewer regions than jobs, regions are built one at a
+    # time instead, each parsing its .osm.pbf with all of the jobs.
+    if len(region_ids) < jobs:
+        region_jobs, parse_jobs = 1, jobs
+    else:
+        region_jobs, parse_jobs = jobs, 1
 
     with click.progressbar(
-        length=len(tasks),
-        label="Estimating number of ways and nodes in datasets...",
-    ) as pbar:
-
-        async def count_main():
-            results = []
-            for future in asyncio.as_completed(tasks):
-                pbar.update(1)
-                results.append(await future)
-            return results
-
-        count_results = asyncio.run(count_main())
-    graph_element_count = sum(count_results)
-
-    #
-    # Create an OSMGraph per region
-    #
-    async def get_osmgraph(region_id, pbf_path, way_filter, node_filter, pbar):
-        loop = asyncio.get_event_loop()
-        OG = await loop.run_in_executor(
-            None,
-            OSMGraph.from_pbf,
-            pbf_path,
-            way_filter,
-            node_filter,
-            pbar,
-        )
-        return region_id, OG
-
-    with click.progressbar(
-        length=graph_element_count,
+        length=pbf_size,
         label="Creating networks from region extracts...",
     ) as pbar:
+        func, tasks = report.tasks(
+            [("network", region_id) for region_id in region_ids],
+            build_network,
+            [
+                ((workdir, region_id, simplify, parse_jobs), {})
+                for region_id in region_ids
+            ],
+        )
+        report.results(
+            run_jobs(func, tasks, jobs=region_jobs, progressbar=pbar)
+        )
 
-        tasks = []
-        for region in config["features"]:
-            region_id = region["properties"]["id"]
-            pbf_path = str(Path(workdir, f"{region_id}.osm.pbf"))
-            tasks.append(
-                get_osmgraph(
-                    region_id,
-                    pbf_path,
-                    opensidewalks_way_filter,
-                    opensidewalks_node_filter,
-                    pbar,
-                )
-            )
-
-        async def osm_graph_main():
-            return await asyncio.gather(*tasks)
-
-        osm_graph_results = asyncio.run(osm_graph_main())
-
-    osm_graph_results = list(osm_graph_results)
-    #
-    # Optionally, simplify ways by joining simple connection nodes (degree-2)
-    #
-    if simplify:
-
-        async def simplify_og(og):
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, og.simplify)
-
-        with click.progressbar(
-            length=len(osm_graph_results),
-            label="Simplifying ways...",
-        ) as pbar:
-
-            async def simplify_main():
-                tasks = [
-                    simplify_og(OG) for region_id, OG in osm_graph_results
-                ]
-                for future in asyncio.as_completed(tasks):
-                    pbar.update(1)
-                    await future
-
-            asyncio.run(simplify_main())
-
-    #
-    # Construct geometries
-    #
-    async def construct_geometries(og, pbar):
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, og.construct_geometries, pbar)
-
-    with click.progressbar(
-        length=len(osm_graph_results),
-        label="Constructing geometries...",
-    ) as pbar:
+    for region_id, key in keys.items():
+        manifest.record(
+            graph_path(workdir, region_id), "network", key, creates=True
+        )
+    manifest.save()
 
-        async def construct_geometries_main():
-            tasks = [
-                construct_geometries(OG, pbar)
-                for region_id, OG in osm_graph_results
-            ]
-            await asyncio.gather(*tasks)
+    regions = ", ".join(region_ids)
+    click.echo(f"Created networks from the clipped {regions} region(s).")
 
-        asyncio.run(construct_geometries_main())
 
-    #
-    # Write to file
-    #
-    async def write_og(region_id: str, og):
-        loop = asyncio.get_event_loop()
-        nodes_path = Path(workdir, f"{region_id}.graph.nodes.geojson")
-        edges_path = Path(workdir, f"{region_id}.graph.edges.geojson")
-        await loop.run_in_executor(None, og.to_geojson, nodes_path, edges_path)
+@osm_osw.command()
+@click.argument("config", type=click.Path())
+@click.argument("change_files", nargs=-1, type=click.Path(exists=True))
+@click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
+@click.option("-s/-ns", "--simplify/--no_simplify", default=True)
+@JOBS_OPTION
+@report_options
+def apply_changes(
+    config: str,
+    change_files: Tuple[str, ...],
+    workdir: str,
+    simplify: bool,
+    jobs: int,
+    report: Report,
+) -> None:
+    """Apply OSM change (.osc) files, oldest first, to the clipped extracts
+    and networks of the regions.
+
+    """
+    config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir)
 
     with click.progressbar(
-        length=len(osm_graph_results),
-        label="Writing graph nodes and edges GeoJSONs to file...",
+        length=len(config["features"]),
+        label="Applying changes...",
     ) as pbar:
+        func, tasks = report.tasks(
+            [
+                ("apply_changes", region["properties"]["id"])
+                for region in config["features"]
+            ],
+            apply_region_changes,
+            [
+                ((workdir, region, list(change_files), simplify), {})
+                for region in config["features"]
+            ],
+        )
+        report.results(
+            run_jobs(
+                func, tasks, jobs=jobs, progressbar=pbar, task_progress=True
+            )
+        )
 
-        async def write_main():
-            tasks = [
-                write_og(region_id, OG) for region_id, OG in osm_graph_results
-            ]
-            for future in asyncio.as_completed(tasks):
-                pbar.update(1)
-                await future
-
-        asyncio.run(write_main())
-
-    regions = ", ".join(r for r, o in osm_graph_results)
-    click.echo(f"Created networks from the clipped {regions} region(s).")
-
-
-"""
+    # The updated networks are recorded as built from the updated extracts,
+    # so that later stages are rerun but the networks aren't rebuilt.
+    key = manifest.key(
+        "apply_changes", [manifest.digest(path) for path in change_files]
+    )
     for region in config["features"]:
         region_id = region["properties"]["id"]
-        clipped_path = Path(workdir, f"{region_id}.osm.pbf")
-
-        # TODO: add a progressbar
-        click.echo(f"Counting network ways in {region_id}...")
-        way_counter = WayCounter()
-        way_counter.apply_file(str(clipped_path))
-        node_counter = NodeCounter()
-        node_counter.apply_file(str(clipped_path))
-        with click.progressbar(
-            length=way_counter.count + node_counter.count,
-            label=f"Importing ways for {region_id}...",
-        ) as pbar:
-            OG = OSMGraph.from_pbf(
-                str(clipped_path),
-                way_filter=opensidewalks_way_filter,
-                node_filter=opensidewalks_node_filter,
-                progressbar=pbar,
-            )
-
-        if simplify:
-            click.echo(f"Joining degree-2 nodes for {region_id}...")
-            OG.simplify()
-
-        with click.progressbar(
-            length=len(OG.G.edges) + len(OG.G.nodes),
-            label=f"Constructing geometries for {region_id}...",
-        ) as pbar:
-            OG.construct_geometries(progressbar=pbar)
-
-        graph_nodes_path = Path(workdir, f"{region_id}.graph.nodes.geojson")
-        graph_edges_path = Path(workdir, f"{region_id}.graph.edges.geojson")
-        OG.to_geojson(graph_nodes_path, graph_edges_path)
-
-        click.echo(f"Created network from clipped {region_id} region.")
-        """
+        pbf_path = Path(workdir, f"{region_id}.osm.pbf")
+        manifest.record(pbf_path, "apply_changes", key)
+        manifest.record(
+            graph_path(workdir, region_id),
+            "network",
+            network_key(manifest, workdir, region_id, simplify),
+            creates=True,
+        )
+    manifest.save()
 
 
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def mask(config: str, workdir: str) -> None:
+@JOBS_OPTION
+@FORCE_OPTION
+@ALL_TOUCHED_OPTION
+@ROI_OPTION
+@report_options
+def mask(
+    config: str,
+    workdir: str,
+    jobs: int,
+    force: bool,
+    all_touched: bool,
+    roi: bool,
+    report: Report,
+) -> None:
     config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir, force)
 
-    tilesets = list_ned13s(workdir)
-    tileset_paths = [
-        Path(workdir, "dems", f"{tileset}.tif") for tileset in tilesets
-    ]
-
-    # Create blank mask by default - no pixels are masked.
-    for path in tileset_paths:
-        with rasterio.open(path, "r+") as rast:
-            rast.write_mask(True)
-
-    # Add masked regions
+    # Fetch DEMs if they aren't already cached. This happens before any
+    # workers are started so that no tile is downloaded twice.
     for region in config["features"]:
-        region_id = region["properties"]["id"]
-        # Fetch DEMs if they aren't already cached
         get_ned13_for_bounds(
             shape(region["geometry"]).bounds, workdir, progressbar=True
         )
 
-        clipped_extract_path = Path(workdir, f"{region_id}.osm.pbf")
-        click.echo(f"Counting buildings and bridge areas in {region_id}...")
-        area_count = count_masked_areas(clipped_extract_path)
-        with click.progressbar(
-            length=area_count,
-            label=f"Extracting buildings and bridge areas from {region_id}: ",
-        ) as pbar:
-            area_geoms = extract_areas(
-                clipped_extract_path, buffer=BUFFER_DIST, progressbar=pbar
-            )
+    tilesets_by_region = region_tilesets(config)
+
+    # A tileset's mask only depends on the regions that overlap it, so only
+    # tilesets overlapping changed regions are masked again.
+    stale = []
+    for tileset in list_ned13s(workdir):
+        path = dem_path(workdir, tileset)
+        region_ids = [
+            region_id
+            for region_id, tilesets in tilesets_by_region.items()
+            if tileset in tilesets
+        ]
+        if not region_ids:
+            # Tilesets that no region overlaps are never masked.
+            continue
+        network_keys = None
+        if roi:
+            network_keys = []
+            for region_id in region_ids:
+                graph = graph_path(workdir, region_id)
+                network_keys.append(manifest.stage_key(graph, "network"))
+                if network_keys[-1] is None:
+                    raise click.ClickException(
+                        f"--roi needs the network of region {region_id}. "
+                        "Run the network command first."
+                    )
+        key = mask_key(
+            manifest, workdir, region_ids, all_touched, network_keys
+        )
+        if not manifest.is_fresh(path, "mask", key):
+            stale.append((tileset, path, region_ids, key))
 
-        for tileset, path in zip(tilesets, tileset_paths):
-            with click.progressbar(
-                length=area_count,
-                label=f"Masking {tileset} with geometries from {region_id}",
-            ) as pbar2:
-                mask_dem(path, area_geoms, progressbar=pbar2)
-
-        click.echo(f"Counting bridge lines in {region_id}...")
-        bridge_count = count_bridges(clipped_extract_path)
-
-        with click.progressbar(
-            length=bridge_count,
-            label=f"Extracting buffered bridge lines from {region_id}: ",
-        ) as pbar:
-            bridge_geoms = extract_bridges(
-                clipped_extract_path, buffer=BUFFER_DIST, progressbar=pbar
+    if not stale:
+        click.echo("DEM masks are up to date.")
+        return
+
+    region_ids = [
+        region_id
+        for region_id in tilesets_by_region
+        if any(region_id in tile_regions for _, _, tile_regions, _ in stale)
+    ]
+    with click.progressbar(
+        length=len(region_ids),
+        label="Extracting buildings, bridge areas and bridge lines...",
+    ) as pbar:
+        func, tasks = report.tasks(
+            [("extract", region_id) for region_id in region_ids],
+            extract_masked_geometries,
+            [
+                ((workdir, region_id, BUFFER_DIST), {})
+                for region_id in region_ids
+            ],
+        )
+        region_geoms = report.results(
+            run_jobs(
+                func, tasks, jobs=jobs, progressbar=pbar, task_progress=True
+            )
+        )
+    geoms_by_region = dict(zip(region_ids, region_geoms))
+
+    # Every tileset is only given the polygons that overlap it.
+    routed = tileset_polygons(
+        [path for _, path, _, _ in stale],
+        [geom for geoms in region_geoms for geom in geoms],
+    )
+    # Tilesets are masked in parallel. A single tileset is masked in this
+    # process instead, so its strips can be masked in parallel without
+    # starting a pool inside a worker.
+    mask_jobs = jobs if len(stale) == 1 else 1
+    tasks = []
+    for (_, path, tile_regions, _), geoms in zip(stale, routed):
+        graph_paths = None
+        if roi:
+            graph_paths = [
+                graph_path(workdir, region_id) for region_id in tile_regions
+            ]
+        tasks.append(
+            (
+                (path, geoms),
+                {
+                    "all_touched": all_touched,
+                    "graph_paths": graph_paths,
+                    "jobs": mask_jobs,
+                    "reuse": not force,
+                },
             )
+        )
+
+    # Masks are written by one worker per tileset, so no two processes ever
+    # write to the same file.
+    tilesets = ", ".join(tileset for tileset, _, _, _ in stale)
+    with click.progressbar(
+        length=sum(len(args[1]) for args, _ in tasks),
+        label=f"Masking {tilesets}...",
+    ) as pbar:
+        func, tasks = report.tasks(
+            [("mask", tileset) for tileset, _, _, _ in stale],
+            mask_tileset,
+            tasks,
+        )
+        report.results(run_jobs(func, tasks, jobs=jobs, progressbar=pbar))
 
-        for tileset, path in zip(tilesets, tileset_paths):
-            with click.progressbar(
-                length=bridge_count,
-                label=f"Masking {tileset} with bridges from {region_id}",
-            ) as pbar2:
-                mask_dem(path, bridge_geoms, progressbar=pbar2)
+    for _, path, _, key in stale:
+        manifest.record(path, "mask", key, creates=True)
+    manifest.save()
 
 
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def infer_curbramps(config: str, workdir: str) -> None:
+@JOBS_OPTION
+@FORCE_OPTION
+@report_options
+def infer_curbramps(
+    config: str, workdir: str, jobs: int, force: bool, report: Report
+) -> None:
     config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir, force)
+
+    key = curbramps_key(manifest)
+    region_ids = [
+        region["properties"]["id"]
+        for region in config["features"]
+        if not manifest.is_fresh(
+            graph_path(workdir, region["properties"]["id"]),
+            "infer_curbramps",
+            key,
+        )
+    ]
+    if not region_ids:
+        click.echo("Curbramps are up to date.")
+        return
 
-    # Infer inclines
-    for region in config["features"]:
-        region_id = region["properties"]["id"]
-
-        graph_nodes_path = Path(workdir, f"{region_id}.graph.nodes.geojson")
-        graph_edges_path = Path(workdir, f"{region_id}.graph.edges.geojson")
+    with click.progressbar(
+        length=len(region_ids),
+        label="Inferring curbramps...",
+    ) as pbar:
+        func, tasks = report.tasks(
+            [("infer_curbramps", region_id) for region_id in region_ids],
+            infer_region_curbramps,
+            [((workdir, region_id), {}) for region_id in region_ids],
+        )
+        report.results(
+            run_jobs(
+                func, tasks, jobs=jobs, progressbar=pbar, task_progress=True
+            )
+        )
 
-        OG = OSMGraph.from_geojson(graph_nodes_path, graph_edges_path)
-        with click.progressbar(
-            length=len(OG.G.edges),
-            label=f"Inferring curbramps for {region_id}",
-        ) as bar:
-            infer_osm_curbramps(OG, progressbar=bar)
-        OG.to_geojson(graph_nodes_path, graph_edges_path)
+    for region_id in region_ids:
+        manifest.record(graph_path(workdir, region_id), "infer_curbramps", key)
+    manifest.save()
 
 
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def incline(config: str, workdir: str) -> None:
+@JOBS_OPTION
+@FORCE_OPTION
+@report_options
+def incline(
+    config: str, workdir: str, jobs: int, force: bool, report: Report
+) -> None:
     config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir, force)
 
-    # Infer inclines
+    # Download region(s) if necessary
     for region in config["features"]:
-        # Download region(s) if necessary
         get_ned13_for_bounds(
             shape(region["geometry"]).bounds, workdir, progressbar=True
         )
-        region_id = region["properties"]["id"]
-
-        graph_nodes_path = Path(workdir, f"{region_id}.graph.nodes.geojson")
-        graph_edges_path = Path(workdir, f"{region_id}.graph.edges.geojson")
-
-        # FIXME: using unweaver's geopackage might make many of these steps
-        # easier
-        OG = OSMGraph.from_geojson(graph_nodes_path, graph_edges_path)
-
-        tilesets = list_ned13s(workdir)
-        for tileset in tilesets:
-            tileset_path = Path(workdir, "dems", f"{tileset}.tif")
 
-            with rasterio.open(tileset_path) as dem:
-                with click.progressbar(
-                    length=len(OG.G.edges),
-                    label=f"Estimating inclines for {region_id} for {tileset}",
-                ) as bar:
-                    for u, v, d in OG.G.edges(data=True):
-                        incline = infer_incline(
-                            d["geometry"], d["length"], dem, 3
-                        )
-                        if incline is not None:
-                            d["incline"] = incline
-                        bar.update(1)
+    # Inclines depend on the (masked) DEM tilesets that overlap a region.
+    cached = set(list_ned13s(workdir))
+    keys = {}
+    tilesets = {}
+    for region_id, names in region_tilesets(config).items():
+        tilesets[region_id] = [name for name in names if name in cached]
+        key = incline_key(manifest, workdir, tilesets[region_id])
+        if not manifest.is_fresh(
+            graph_path(workdir, region_id), "incline", key
+        ):
+            keys[region_id] = key
+
+    if not keys:
+        click.echo("Inclines are up to date.")
+        return
+
+    region_ids = list(keys)
+    with click.progressbar(
+        length=len(region_ids),
+        label="Estimating inclines...",
+    ) as pbar:
+        func, tasks = report.tasks(
+            [("incline", region_id) for region_id in region_ids],
+            infer_region_inclines,
+            [
+                ((workdir, region_id, tilesets[region_id]), {})
+                for region_id in region_ids
+            ],
+        )
+        report.results(
+            run_jobs(
+                func, tasks, jobs=jobs, progressbar=pbar, task_progress=True
+            )
+        )
 
-        OG.to_geojson(graph_nodes_path, graph_edges_path)
+    for region_id, key in keys.items():
+        manifest.record(graph_path(workdir, region_id), "incline", key)
+    manifest.save()
 
 
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-def merge(config: str, workdir: str) -> None:
+@click.option(
+    "--ndjson",
+    is_flag=True,
+    help=(
+        "Write newline-delimited GeoJSON to transportation.geojsonl instead "
+        "of a FeatureCollection."
+    ),
+)
+@FORCE_OPTION
+@report_options
+def merge(
+    config: str, workdir: str, ndjson: bool, force: bool, report: Report
+) -> None:
     config = ConfigSchema.dict_from_filepath(config)
-
-    fc = {"type": "FeatureCollection", "features": []}
-
-    for region in config["features"]:
-        region_id = region["properties"]["id"]
-        graph_geojson_path = Path(workdir, f"{region_id}.graph.edges.geojson")
-
-        with open(graph_geojson_path) as f:
-            region_fc = json.load(f)
-
-        fc["features"] = fc["features"] + region_fc["features"]
-
-    with open(Path(workdir, "transportation.geojson"), "w") as f:
-        json.dump(fc, f)
+    manifest = Manifest(workdir, force)
+
+    region_ids = [region["properties"]["id"] for region in config["features"]]
+
+    if ndjson:
+        path = Path(workdir, "transportation.geojsonl")
+        other = Path(workdir, "transportation.geojson")
+    else:
+        path = Path(workdir, "transportation.geojson")
+        other = Path(workdir, "transportation.geojsonl")
+
+    key = merge_key(manifest, workdir, region_ids)
+    if manifest.is_fresh(path, "merge", key):
+        click.echo(f"{path.name} is up to date.")
+        return
+
+    report.call(
+        ("merge", None),
+        merge_regions,
+        workdir,
+        region_ids,
+        path,
+        ndjson=ndjson,
+    )
+    # An earlier merge's file in the other format is stale now, and could be
+    # mistaken for the current one.
+    if other.exists():
+        other.unlink()
+
+    manifest.record(path, "merge", key, creates=True)
+    manifest.save()
 
 
 @osm_osw.command()
 @click.argument("config", type=click.Path())
 @click.option("--workdir", envvar="OSM_OSW_WORKDIR", default=TMP_DIR)
-@click.pass_context
-def runall(ctx: click.Context, config: str, workdir: str) -> None:
-    ctx.forward(clip)
-    ctx.forward(network)
-    ctx.forward(infer_curbramps)
-    ctx.forward(mask)
-    ctx.forward(incline)
-    ctx.forward(merge)
+@JOBS_OPTION
+@MEMORY_OPTION
+@FORCE_OPTION
+@ALL_TOUCHED_OPTION
+@ROI_OPTION
+@report_options
+def runall(
+    config: str,
+    workdir: str,
+    jobs: int,
+    memory: Optional[int],
+    force: bool,
+    all_touched: bool,
+    roi: bool,
+    report: Report,
+) -> None:
+    """Run every stage for every region. Each region moves on to its next
+    stage as soon as its inputs are ready, and DEMs are fetched and masked
+    alongside graph building, using up to JOBS CPUs and (optionally) MEMORY
+    MB at once.
+
+    """
+    config = ConfigSchema.dict_from_filepath(config)
+    manifest = Manifest(workdir, force)
+
+    tasks = runall_tasks(
+        config,
+        workdir,
+        manifest,
+        all_touched=all_touched,
+        roi=roi,
+        jobs=jobs,
+    )
+    if memory is not None:
+        memory *= 2**20
+    with click.progressbar(
+        length=len(tasks),
+        label="Running pipeline...",
+    ) as pbar:
+        results = run_tasks(
+            tasks, jobs=jobs, memory=memory, progressbar=pbar, report=report
+        )
+
+    skipped = len(tasks) - len(results)
+    click.echo(f"Ran {len(results)} tasks ({skipped} were up to date).")
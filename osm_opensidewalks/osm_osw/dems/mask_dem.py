@@ -1,12 +1,27 @@
+from collections import namedtuple
+import hashlib
 import json
+import math
+import os
+from pathlib import Path
+import zipfile
 
 import numpy as np
 import osmium
-from osmium.geom import GeoJSONFactory
+from osmium.geom import WKBFactory
+import pygeos
 import rasterio
-from shapely.geometry import LineString, MultiPolygon, Point, mapping, shape
+from rasterio.features import rasterize
+from rasterio.transform import Affine
 import utm
 
+from ..osm.osm_graph import HAS_FILTERS
+from ..osm.pbf import apply_file
+from ..parallel import run_jobs
+
+# Number of segments used to approximate a quarter circle when buffering.
+BUFFER_QUAD_SEGS = 16
+
 
 def is_masked_area(tags):
     if "building" in tags:
@@ -16,140 +31,173 @@ def is_masked_area(tags):
     return False
 
 
-def multipolygon_to_utm(geojson_geom):
-    # Flatten array, then get UTM coords
-    lons = []
-    lats = []
-    for polygon in geojson_geom["coordinates"]:
-        for ring in polygon:
-            for lon, lat in ring:
-                lons.append(lon)
-                lats.append(lat)
-    xs, ys, zone_number, zone_letter = utm.from_latlon(
-        np.array(lats), np.array(lons)
-    )
+def region_utm_zone(geoms):
+    """The UTM zone at the center of the bounds of (lon-lat) geometries.
 
-    # Unflatten array so that it's a polygon again
-    xs_rev = list(reversed(xs))
-    ys_rev = list(reversed(ys))
-    new_coords = []
-    for polygon in geojson_geom["coordinates"]:
-        p = []
-        new_coords.append(p)
-        for ring in polygon:
-            r = []
-            p.append(r)
-            for lon, lat in ring:
-                r.append([xs_rev.pop(), ys_rev.pop()])
+    :param geoms: pygeos geometries.
+    :type geoms: numpy.ndarray
+    :returns: Tuple of (zone number, zone letter).
 
-    return (
-        {"type": "MultiPolygon", "coordinates": new_coords},
-        zone_number,
-        zone_letter,
+    """
+    west, south, east, north = pygeos.total_bounds(geoms)
+    lon = (west + east) / 2
+    lat = (south + north) / 2
+    return utm.latlon_to_zone_number(lat, lon), utm.latitude_to_zone_letter(
+        lat
     )
 
 
-def multipolygon_from_utm(geojson_geom, zone_number, zone_letter):
-    # Reflatten and reproject to lon-lat
-    xs_buff = []
-    ys_buff = []
-    for polygon in geojson_geom["coordinates"]:
-        for ring in polygon:
-            for x, y in ring:
-                xs_buff.append(x)
-                ys_buff.append(y)
+def buffer_geometries(geoms, buffer):
+    """Buffer lon-lat geometries by a distance in meters, all at once. All
+    of the geometries are buffered in one UTM zone, so they should be from
+    the same region.
+
+    :param geoms: pygeos geometries.
+    :type geoms: numpy.ndarray
+    :param buffer: Buffer distance in meters.
+    :type buffer: float
+    :returns: numpy.ndarray of buffered pygeos (lon-lat) geometries.
 
-    lats_buff, lons_buff = utm.to_latlon(
-        np.array(xs_buff), np.array(ys_buff), zone_number, zone_letter
+    """
+    if not len(geoms):
+        return geoms
+    zone_number, zone_letter = region_utm_zone(geoms)
+
+    coords = pygeos.get_coordinates(geoms)
+    xs, ys = utm.from_latlon(
+        coords[:, 1],
+        coords[:, 0],
+        force_zone_number=zone_number,
+        force_zone_letter=zone_letter,
+    )[:2]
+    projected = pygeos.set_coordinates(geoms.copy(), np.column_stack((xs, ys)))
+
+    buffered = pygeos.buffer(projected, buffer, quadsegs=BUFFER_QUAD_SEGS)
+
+    coords = pygeos.get_coordinates(buffered)
+    lats, lons = utm.to_latlon(
+        coords[:, 0], coords[:, 1], zone_number, zone_letter
     )
+    return pygeos.set_coordinates(buffered, np.column_stack((lons, lats)))
 
-    # Unflatten array so that it's a polygon again
-    lons_buff_rev = list(reversed(lons_buff))
-    lats_buff_rev = list(reversed(lats_buff))
 
-    buff_coords = []
-    for polygon in geojson_geom["coordinates"]:
-        p = []
-        buff_coords.append(p)
-        for ring in polygon:
-            r = []
-            p.append(r)
-            for lon, lat in ring:
-                r.append([lons_buff_rev.pop(), lats_buff_rev.pop()])
+def to_geojson_multipolygons(geoms):
+    """Convert polygonal geometries to GeoJSON MultiPolygons, with their
+    bounding boxes ("bbox").
 
-    return {"type": "MultiPolygon", "coordinates": buff_coords}
+    :param geoms: pygeos (Multi)Polygon geometries.
+    :type geoms: numpy.ndarray
+    :returns: list of GeoJSON MultiPolygon geometries (dict).
 
-
-def buffer_multipolygon(geojson_geom, buffer):
-    utm_multipolygon, zone_number, zone_letter = multipolygon_to_utm(
-        geojson_geom
+    """
+    polygons, geom_index = pygeos.get_parts(geoms, return_index=True)
+    rings, polygon_index = pygeos.get_rings(polygons, return_index=True)
+    coords = pygeos.get_coordinates(rings)
+    ring_coords = np.split(
+        coords, np.cumsum(pygeos.get_num_coordinates(rings))[:-1]
     )
-    multipolygon = shape(utm_multipolygon)
-    buffered = multipolygon.buffer(buffer)
 
-    if buffered.type == "Polygon":
-        buffered = MultiPolygon([buffered])
+    polygon_rings = [[] for _ in range(len(polygons))]
+    for polygon, ring in zip(polygon_index, ring_coords):
+        polygon_rings[polygon].append(ring.tolist())
+    multipolygons = [[] for _ in range(len(geoms))]
+    for geom, polygon in zip(geom_index, polygon_rings):
+        if polygon:
+            multipolygons[geom].append(polygon)
 
-    buffered_geojson = mapping(buffered)
+    return [
+        {"type": "MultiPolygon", "bbox": bbox, "coordinates": coordinates}
+        for bbox, coordinates in zip(
+            pygeos.bounds(geoms).tolist(), multipolygons
+        )
+    ]
 
-    return multipolygon_from_utm(buffered_geojson, zone_number, zone_letter)
 
+def polygon_bounds(polygons):
+    """Bounds of GeoJSON (multi)polygons, from their "bbox" if they have one.
 
-def buffer_linestring(geojson_linestring, buffer):
-    lons, lats = zip(*geojson_linestring["coordinates"])
-    xs, ys, zone_number, zone_letter = utm.from_latlon(
-        np.array(lats), np.array(lons)
-    )
+    :param polygons: GeoJSON (multi)polygon geometries.
+    :type polygons: list of dict
+    :returns: (n, 4) numpy.ndarray of [w, s, e, n] bounds.
 
-    linestring = LineString(zip(xs, ys))
+    """
+    bounds = np.empty((len(polygons), 4))
+    for i, polygon in enumerate(polygons):
+        if "bbox" in polygon:
+            bounds[i] = polygon["bbox"]
+            continue
+        coords = np.concatenate(
+            [
+                np.asarray(ring, dtype=float)[:, :2]
+                for rings in polygon["coordinates"]
+                for ring in rings
+            ]
+        )
+        bounds[i, :2] = coords.min(axis=0)
+        bounds[i, 2:] = coords.max(axis=0)
+    return bounds
+
+
+def route_polygons(polygons, tile_bounds):
+    """Find the polygons whose bounds intersect each of several tiles, using
+    a spatial index of the polygons' bounds.
+
+    :param polygons: GeoJSON (multi)polygon geometries.
+    :type polygons: list of dict
+    :param tile_bounds: [w, s, e, n] bounds of every tile.
+    :type tile_bounds: list of list of float
+    :returns: list of lists of polygons, one per tile.
 
-    polygon = linestring.buffer(buffer)
+    """
+    if not polygons:
+        return [[] for _ in tile_bounds]
+    bounds = polygon_bounds(polygons)
+    tree = pygeos.STRtree(pygeos.box(*bounds.T))
 
-    buffered_xs, buffered_ys = zip(*polygon.exterior.coords)
+    routed = []
+    for tile in tile_bounds:
+        indices = np.sort(tree.query(pygeos.box(*tile)))
+        routed.append([polygons[i] for i in indices])
+    return routed
 
-    buffered_lats, buffered_lons = utm.to_latlon(
-        np.array(buffered_xs), np.array(buffered_ys), zone_number, zone_letter
-    )
 
-    exterior_ring = list(zip(buffered_lons, buffered_lats))
-    polygon = [exterior_ring]
-    multipolygon_coords = [polygon]
+def bridge_filter(tags):
+    if "bridge" in tags and tags["bridge"] == "yes":
+        return True
+    return False
 
-    return {
-        "type": "MultiPolygon",
-        "coordinates": multipolygon_coords,
-    }
 
+def masked_geometry_filters():
+    """Create osmium filters that only pass objects that may be masked
+    areas or bridge lines, so that osmium only assembles areas from the
+    relations that could be masked and only hands those areas (and the
+    candidate ways) to Python.
 
-class MaskedAreaCounter(osmium.SimpleHandler):
-    def __init__(self):
-        super().__init__()
-        self.count = 0
+    :returns: list of osmium filters. Empty if filters aren't supported.
+
+    """
+    if not HAS_FILTERS:
+        return []
+    return [osmium.filter.KeyFilter("building", "man_made", "bridge")]
 
-    def area(self, a):
-        if is_masked_area(a.tags):
-            self.count += 1
 
+class MaskedGeometryHandler(osmium.SimpleHandler):
+    """Collects the WKB of masked areas (buildings and bridge areas) and of
+    bridge lines in one read of a file.
 
-class MaskedAreaHandler(osmium.SimpleHandler):
-    def __init__(self, buffer=None, progressbar=None):
+    """
+
+    def __init__(self, progressbar=None):
         super().__init__()
-        self.areas = []
-        self.geojson_factory = GeoJSONFactory()
-        self.buffer = buffer
+        self.area_wkbs = []
+        self.bridge_wkbs = []
+        self.wkb_factory = WKBFactory()
         self.progressbar = progressbar
 
     def area(self, a):
         if is_masked_area(a.tags):
             try:
-                geojson = self.geojson_factory.create_multipolygon(a)
-                geojson_geom = json.loads(geojson)
-                if self.buffer is not None:
-                    geojson_geom = buffer_multipolygon(
-                        geojson_geom, self.buffer
-                    )
-
-                self.areas.append(geojson_geom)
+                self.area_wkbs.append(self.wkb_factory.create_multipolygon(a))
             except RuntimeError:
                 # A RuntimeError is raised when the multipolygon cannot be
                 # created. This is upstream behavior that we do not yet work
@@ -159,39 +207,10 @@ class MaskedAreaHandler(osmium.SimpleHandler):
             if self.progressbar is not None:
                 self.progressbar.update(1)
 
-
-def bridge_filter(tags):
-    if "bridge" in tags and tags["bridge"] == "yes":
-        return True
-    return False
-
-
-class BridgeLineCounter(osmium.SimpleHandler):
-    def __init__(self):
-        super().__init__()
-        self.count = 0
-
-    def way(self, w):
-        if bridge_filter(w.tags):
-            self.count += 1
-
-
-class MaskedBridgeLineHandler(osmium.SimpleHandler):
-    def __init__(self, buffer, progressbar=None):
-        super().__init__()
-        self.buffer = buffer
-        self.bridges = []
-        self.geojson_factory = GeoJSONFactory()
-        self.progressbar = progressbar
-
     def way(self, w):
         if bridge_filter(w.tags):
             try:
-                geojson = self.geojson_factory.create_linestring(w)
-                geojson_geom = json.loads(geojson)
-                buffered_geom = buffer_linestring(geojson_geom, self.buffer)
-
-                self.bridges.append(buffered_geom)
+                self.bridge_wkbs.append(self.wkb_factory.create_linestring(w))
             except RuntimeError:
                 # A RuntimeError is raised when the linestring cannot be
                 # created. This is upstream behavior that we do not yet work
@@ -202,81 +221,422 @@ class MaskedBridgeLineHandler(osmium.SimpleHandler):
                 self.progressbar.update(1)
 
 
-def count_masked_areas(path):
-    """Count the number of areas to mask in an OSM PBF file.
+def extract_masked(path, buffer, progressbar=None):
+    """Extract buffered (multi)polygons of areas and bridge lines to mask
+    from an OSM PBF file in one read. Geometries are collected as WKB and
+    buffered together once the whole file has been read.
 
-    :param path: Path to the .osm.pbf
+    :param path: Path to the .osm.pbf file.
     :type path: str
+    :param buffer: Buffer distance in meters.
+    :type buffer: float
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as areas and lines are extracted.
+    :type progressbar: click.progressbar
+    :returns: Tuple of (areas, bridges), lists of GeoJSON MultiPolygon
+              geometries (dict).
 
     """
-    area_counter = MaskedAreaCounter()
-    area_counter.apply_file(str(path))
+    handler = MaskedGeometryHandler(progressbar=progressbar)
+    apply_file(
+        handler, path, locations=True, filters=masked_geometry_filters()
+    )
 
-    return area_counter.count
+    areas = pygeos.from_wkb(np.array(handler.area_wkbs, dtype=object))
+    areas = buffer_geometries(areas, buffer)
 
+    lines = pygeos.from_wkb(np.array(handler.bridge_wkbs, dtype=object))
+    buffered = buffer_geometries(lines, buffer)
+    # Only the outline of a buffered line is masked, even if the line loops
+    # around and its buffer has holes.
+    bridges = pygeos.polygons(pygeos.get_exterior_ring(buffered))
 
-def extract_areas(path, buffer=None, progressbar=None):
-    """Extract (multi)polygons of areas to mask from an OSM PBF file.
+    return to_geojson_multipolygons(areas), to_geojson_multipolygons(bridges)
 
-    :param path: Path to the .osm.pbf file.
-    :type path: str
-    :param progressbar: An (optional) click.progressbar object that will be
-                        updated as areas are extracted.
-    :type progressbar: click.progressbar
 
-    """
-    area_handler = MaskedAreaHandler(buffer=buffer, progressbar=progressbar)
-    area_handler.apply_file(str(path))
+# Number of polygons burned into a mask at a time.
+MASK_BATCH_SIZE = 1000
 
-    return area_handler.areas
+# Approximate number of rows in the strips of a DEM that are masked (in
+# parallel) and cached separately. Strips are rounded up to whole blocks.
+MASK_STRIP_ROWS = 512
 
+# Version of the mask sidecar file format, see mask_sidecar_path.
+MASK_SIDECAR_VERSION = 1
 
-def count_bridges(path):
-    """Count the number of linear bridge features to mask in an OSM PBF file.
+# A raster's affine transform and size: all that's needed to rasterize
+# polygons into it, without passing open datasets to worker processes.
+RasterGrid = namedtuple("RasterGrid", ["transform", "width", "height"])
 
-    :param path: Path to the .osm.pbf
-    :type path: str
+# Size of the window of pixels read around a point to interpolate its
+# elevation (see transforms.interpolated_value).
+SAMPLE_WINDOW = 3
 
-    """
-    bridge_counter = BridgeLineCounter()
-    bridge_counter.apply_file(str(path))
+# Extra pixels around every sampled window that are masked in region of
+# interest mode, in case of rounding differences.
+ROI_MARGIN = 1
 
-    return bridge_counter.count
 
+def sampled_pixels(lons, lats, raster, margin=ROI_MARGIN):
+    """Find the pixels of a raster that are read to interpolate elevations
+    at points, e.g. the nodes of a graph.
 
-def extract_bridges(path, buffer=30, progressbar=None):
-    """Extract buffered polygons of bridge lines to mask from an OSM PBF file.
-
-    :param path: Path to the .osm.pbf file.
-    :type path: str
-    :param progressbar: An (optional) click.progressbar object that will be
-                        updated as areas are extracted.
-    :type progressbar: click.progressbar
+    :param lons: Longitudes of the points.
+    :type lons: numpy.ndarray
+    :param lats: Latitudes of the points.
+    :type lats: numpy.ndarray
+    :param raster: Open raster dataset or RasterGrid.
+    :type raster: rasterio.DatasetReader
+    :param margin: Number of extra pixels around every window.
+    :type margin: int
+    :returns: Boolean numpy.ndarray with the raster's shape.
 
     """
-    bridge_handler = MaskedBridgeLineHandler(
-        buffer=buffer, progressbar=progressbar
+    inv = ~raster.transform
+    cols = np.floor(inv.a * lons + inv.b * lats + inv.c).astype(np.int64)
+    rows = np.floor(inv.d * lons + inv.e * lats + inv.f).astype(np.int64)
+    # Many points share a window.
+    rows, cols = np.unique(np.column_stack((rows, cols)), axis=0).T
+
+    reach = SAMPLE_WINDOW // 2 + margin
+    sampled = np.zeros((raster.height, raster.width), dtype=bool)
+    for dy in range(-reach, reach + 1):
+        for dx in range(-reach, reach + 1):
+            r = rows + dy
+            c = cols + dx
+            inside = (r >= 0) & (r < raster.height) & (c >= 0)
+            inside &= c < raster.width
+            sampled[r[inside], c[inside]] = True
+    return sampled
+
+
+def _pixel_windows(bounds, transform):
+    # Pixel (row, col) ranges of [w, s, e, n] bounds.
+    inv = ~transform
+    xs = np.column_stack((bounds[:, 0], bounds[:, 2]))
+    ys = np.column_stack((bounds[:, 3], bounds[:, 1]))
+    cols = inv.a * xs + inv.b * ys + inv.c
+    rows = inv.d * xs + inv.e * ys + inv.f
+    return (
+        np.floor(rows.min(axis=1)).astype(np.int64).clip(min=0),
+        np.floor(rows.max(axis=1)).astype(np.int64) + 1,
+        np.floor(cols.min(axis=1)).astype(np.int64).clip(min=0),
+        np.floor(cols.max(axis=1)).astype(np.int64) + 1,
     )
-    bridge_handler.apply_file(str(path), locations=True)
 
-    return bridge_handler.bridges
 
+def mask_sidecar_path(dem_path):
+    """Path of the file that caches a DEM's mask: the mask bit-packed by
+    row, with a hash of the inputs of every strip of rows.
+
+    :param dem_path: Path to a DEM raster.
+    :type dem_path: str
+    :returns: pathlib.Path
+
+    """
+    return Path(dem_path).with_suffix(".mask.npz")
+
+
+def polygon_digest(polygon):
+    """Hash the coordinates of a GeoJSON (multi)polygon.
 
-def mask_dem(dem_path, polygons, progressbar=False):
-    """Insert a nodata mask into a DEM based on attributes of an OSM PBF file,
-    namely masking out pixels near buildings and bridges.
+    :param polygon: GeoJSON (multi)polygon geometry.
+    :type polygon: dict
+    :returns: bytes
+
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for rings in polygon["coordinates"]:
+        h.update(len(rings).to_bytes(8, "little"))
+        for ring in rings:
+            coords = np.asarray(ring, dtype=float)[:, :2]
+            h.update(len(coords).to_bytes(8, "little"))
+            h.update(coords.tobytes())
+    return h.digest()
+
+
+def _strip_digest(digests, all_touched, roi):
+    # Polygons are hashed in a fixed order: the order they're burned in
+    # doesn't change the mask.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(b"all_touched" if all_touched else b"centers")
+    if roi is not None:
+        h.update(np.packbits(roi, axis=1).tobytes())
+    for digest in sorted(digests):
+        h.update(digest)
+    return h.hexdigest()
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_mask_sidecar(path, grid, strips):
+    """Load a cached mask, if it was made for the same raster grid and
+    strips.
+
+    :param path: Path from mask_sidecar_path.
+    :type path: str
+    :param grid: The raster's transform and size.
+    :type grid: RasterGrid
+    :param strips: Row offsets of the strips, and the raster's height.
+    :type strips: numpy.ndarray
+    :returns: Tuple of (metadata dict, packed mask numpy.ndarray), or None.
+
+    """
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(npz["meta"].item())
+            packed = npz["packed"]
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+    if (
+        meta.get("version") != MASK_SIDECAR_VERSION
+        or meta["transform"] != list(grid.transform)[:6]
+        or meta["width"] != grid.width
+        or meta["height"] != grid.height
+        or meta["strips"] != strips.tolist()
+        or packed.shape != (grid.height, math.ceil(grid.width / 8))
+    ):
+        return None
+    return meta, packed
+
+
+def save_mask_sidecar(path, grid, strips, hashes, packed, dem_stat):
+    """Write a DEM's bit-packed mask and the hashes of its strips.
+
+    :param path: Path from mask_sidecar_path.
+    :type path: str
+    :param grid: The raster's transform and size.
+    :type grid: RasterGrid
+    :param strips: Row offsets of the strips, and the raster's height.
+    :type strips: numpy.ndarray
+    :param hashes: Hash of the inputs of every strip.
+    :type hashes: list of str
+    :param packed: The mask, bit-packed by row: 1 where masked.
+    :type packed: numpy.ndarray
+    :param dem_stat: [size, mtime_ns] of the DEM once the mask was written.
+    :type dem_stat: list of int
+
+    """
+    meta = {
+        "version": MASK_SIDECAR_VERSION,
+        "transform": list(grid.transform)[:6],
+        "width": grid.width,
+        "height": grid.height,
+        "strips": strips.tolist(),
+        "hashes": hashes,
+        "dem_stat": dem_stat,
+    }
+    path = Path(path)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), packed=packed)
+    os.replace(tmp_path, path)
+
+
+def mask_dem(
+    dem_path,
+    polygons,
+    progressbar=None,
+    all_touched=False,
+    points=None,
+    jobs=1,
+    reuse=True,
+):
+    """Replace a DEM's nodata mask with one that masks out the pixels of
+    polygons, namely buildings and bridges. The DEM is split into strips of
+    its internal blocks, which are masked in parallel with several jobs.
+
+    The mask is cached next to the DEM (see mask_sidecar_path), and strips
+    whose polygons haven't changed are reused from it. The DEM isn't written
+    at all if no strip changed since its mask was last written.
 
     :param dem_path: Path to a DEM raster.
     :type dem_path: str
     :param polygons: Iterable of GeoJSON (multi)polygon geometries.
     :type polygons: Iterable of GeoJSON (multi)polygon geometries (dict).
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as polygons are masked.
+    :type progressbar: click.progressbar
+    :param all_touched: Mask every pixel that a polygon touches, rather than
+                        only the pixels whose centers are in a polygon.
+    :type all_touched: bool
+    :param points: Optional (lons, lats) arrays of the points whose
+                   elevations will be interpolated. If given, only the
+                   pixels read for those points are masked (see
+                   sampled_pixels), and polygons that don't overlap them are
+                   skipped.
+    :type points: tuple of numpy.ndarray
+    :param jobs: Number of worker processes.
+    :type jobs: int
+    :param reuse: Reuse unchanged strips of the cached mask.
+    :type reuse: bool
 
     """
-    with rasterio.open(dem_path, "r+") as rast:
-        for polygon in polygons:
-            mask_polygon(polygon, rast)
+    sidecar_path = mask_sidecar_path(dem_path)
+    with rasterio.open(dem_path) as rast:
+        grid = RasterGrid(rast.transform, rast.width, rast.height)
+        block_height = rast.block_shapes[0][0]
+
+    polygons = list(polygons)
+    row_starts, row_ends, col_starts, col_ends = _pixel_windows(
+        polygon_bounds(polygons), grid.transform
+    )
+
+    roi = None
+    keep = np.ones(len(polygons), dtype=bool)
+    if points is not None:
+        roi = sampled_pixels(*points, grid)
+        keep = np.array(
+            [
+                roi[r0:r1, c0:c1].any()
+                for r0, r1, c0, c1 in zip(
+                    row_starts, row_ends, col_starts, col_ends
+                )
+            ],
+            dtype=bool,
+        )
+    if progressbar is not None:
+        progressbar.update(int((~keep).sum()))
+
+    # Polygons are given to every strip they may overlap, with a row to
+    # spare for rounding. Each one is counted (for progress) by the first.
+    strips = _strip_rows(grid.height, block_height)
+    n_strips = len(strips) - 1
+    firsts = np.searchsorted(strips, row_starts - 1, side="right") - 1
+    lasts = np.searchsorted(strips, row_ends, side="right") - 1
+    firsts = firsts.clip(0, n_strips - 1)
+    lasts = lasts.clip(0, n_strips - 1)
+
+    strip_polygons = [[] for _ in range(n_strips)]
+    strip_counted = [[] for _ in range(n_strips)]
+    strip_digests = [[] for _ in range(n_strips)]
+    for i in np.flatnonzero(keep):
+        digest = polygon_digest(polygons[i])
+        for strip in range(firsts[i], lasts[i] + 1):
+            strip_polygons[strip].append(polygons[i])
+            strip_counted[strip].append(strip == firsts[i])
+            strip_digests[strip].append(digest)
+
+    hashes = [
+        _strip_digest(
+            strip_digests[k],
+            all_touched,
+            None if roi is None else roi[strips[k] : strips[k + 1]],
+        )
+        for k in range(n_strips)
+    ]
+
+    cached = load_mask_sidecar(sidecar_path, grid, strips) if reuse else None
+    if cached is None:
+        packed = np.zeros(
+            (grid.height, math.ceil(grid.width / 8)), dtype=np.uint8
+        )
+        stale = list(range(n_strips))
+    else:
+        meta, packed = cached
+        stale = [k for k in range(n_strips) if hashes[k] != meta["hashes"][k]]
+        if not stale and meta["dem_stat"] == _file_stat(dem_path):
+            # The DEM already has this mask.
             if progressbar is not None:
-                progressbar.update(1)
+                progressbar.update(int(keep.sum()))
+            return
+    if progressbar is not None:
+        fresh = set(range(n_strips)) - set(stale)
+        progressbar.update(sum(sum(strip_counted[k]) for k in fresh))
+
+    tasks = [
+        (
+            (grid, strips[k], strips[k + 1], strip_polygons[k]),
+            {"counted": strip_counted[k], "all_touched": all_touched},
+        )
+        for k in stale
+    ]
+    results = run_jobs(mask_strip, tasks, jobs=jobs, progressbar=progressbar)
+    for k, strip_mask in zip(stale, results):
+        masked = strip_mask == 0
+        if roi is not None:
+            masked &= roi[strips[k] : strips[k + 1]]
+        packed[strips[k] : strips[k + 1]] = np.packbits(masked, axis=1)
+
+    masked = np.unpackbits(packed, axis=1, count=grid.width).astype(bool)
+    mask = np.full((grid.height, grid.width), 255, dtype=np.uint8)
+    mask[masked] = 0
+    with rasterio.open(dem_path, "r+") as rast:
+        rast.write_mask(mask)
+
+    save_mask_sidecar(
+        sidecar_path, grid, strips, hashes, packed, _file_stat(dem_path)
+    )
+
+
+def _strip_rows(height, block_height, rows=MASK_STRIP_ROWS):
+    # Row offsets of strips of whole blocks, plus the end. They only depend
+    # on the raster, so that cached strips line up from one run to the next.
+    step = math.ceil(rows / block_height) * block_height
+    return np.array(list(range(0, height, step)) + [height])
+
+
+def mask_strip(
+    grid,
+    row_start,
+    row_end,
+    polygons,
+    counted=None,
+    all_touched=False,
+    progressbar=None,
+):
+    """Mask the pixels of polygons in a strip of rows of a raster.
+
+    :param grid: The raster's transform and size.
+    :type grid: RasterGrid
+    :param row_start: First row of the strip.
+    :type row_start: int
+    :param row_end: Row after the last row of the strip.
+    :type row_end: int
+    :param polygons: GeoJSON (multi)polygon geometries.
+    :type polygons: list of dict
+    :param counted: Whether each polygon counts towards progress. Defaults
+                    to every polygon.
+    :type counted: list of bool
+    :param all_touched: Mask every pixel that a polygon touches, rather than
+                        only the pixels whose centers are in a polygon.
+    :type all_touched: bool
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as polygons are masked.
+    :type progressbar: click.progressbar
+    :returns: uint8 numpy.ndarray of the strip's mask: 0 where masked, 255
+              elsewhere.
+
+    """
+    mask = np.full((row_end - row_start, grid.width), 255, dtype=np.uint8)
+    if counted is None:
+        counted = [True] * len(polygons)
+
+    # Shapes are in the raster's pixel coordinates, so the strip's transform
+    # is just its offset.
+    transform = Affine.translation(0, row_start)
+    for start in range(0, len(polygons), MASK_BATCH_SIZE):
+        batch = polygons[start : start + MASK_BATCH_SIZE]
+        shapes = []
+        for polygon in batch:
+            raster_geom = to_raster_geometry(polygon, grid)
+            if raster_geom is not None:
+                shapes.append((raster_geom, 0))
+        if shapes:
+            rasterize(
+                shapes,
+                out=mask,
+                transform=transform,
+                all_touched=all_touched,
+            )
+        if progressbar is not None:
+            progressbar.update(sum(counted[start : start + MASK_BATCH_SIZE]))
+
+    return mask
 
 
 def to_raster_coords(geometry, raster):
@@ -285,11 +645,11 @@ def to_raster_coords(geometry, raster):
     for polygon in geometry["coordinates"]:
         new_polygon = []
         for ring in polygon:
-            new_ring = []
-            for coord in ring:
-                x, y = affine * (coord[0], coord[1])
-                new_ring.append([x, y])
-            new_polygon.append(new_ring)
+            # Transform a whole ring at once: x' = a * x + b * y + c, etc.
+            coords = np.asarray(ring, dtype=float)[:, :2]
+            xs = affine.a * coords[:, 0] + affine.b * coords[:, 1] + affine.c
+            ys = affine.d * coords[:, 0] + affine.e * coords[:, 1] + affine.f
+            new_polygon.append(np.column_stack((xs, ys)))
         polygons.append(new_polygon)
 
     new_geometry = {"type": "MultiPolygon", "coordinates": polygons}
@@ -297,10 +657,30 @@ def to_raster_coords(geometry, raster):
     return new_geometry
 
 
-def mask_polygon(polygon, raster):
+def _bounds(raster_coord_geojson):
+    rings = [
+        ring
+        for polygon in raster_coord_geojson["coordinates"]
+        for ring in polygon
+    ]
+    mins = np.min([ring.min(axis=0) for ring in rings], axis=0)
+    maxs = np.max([ring.max(axis=0) for ring in rings], axis=0)
+    return mins[0], mins[1], maxs[0], maxs[1]
+
+
+def to_raster_geometry(polygon, raster):
+    """Transform a polygon to a raster's pixel coordinates, for masking.
+
+    :param polygon: GeoJSON (multi)polygon geometry.
+    :type polygon: dict
+    :param raster: Open raster dataset or RasterGrid.
+    :type raster: rasterio.DatasetReader
+    :returns: The polygon in pixel coordinates, or None if it isn't
+              entirely within the raster.
+
+    """
     raster_coord_geojson = to_raster_coords(polygon, raster)
-    geom = shape(raster_coord_geojson)
-    bounds = geom.bounds
+    bounds = _bounds(raster_coord_geojson)
     minx = int(bounds[0])
     miny = int(bounds[1])
     maxx = int(bounds[2]) + 1
@@ -308,35 +688,6 @@ def mask_polygon(polygon, raster):
 
     if minx < 0 or miny < 0 or maxx > raster.width or maxy > raster.height:
         # Geometry falls outside of raster extent: do nothing
-        return
-
-    # Geometry bounds fall within raster extent, but could overlap boundary:
-    # adjust window to be within boundary
-    minx = max(0, minx)
-    miny = max(0, miny)
-    maxx = min(raster.width, maxx)
-    maxy = min(raster.height, maxy)
-
-    # Create windowed read indices
-    dx = maxx - minx
-    dy = maxy - miny
-
-    # Object at boundary may not overlap properly - throw out
-    if not dx or not dy:
-        return
-
-    # mask = np.ones((dy, dx)).astype(bool)
-    xs = [p + 0.5 for p in range(minx, maxx)]
-    ys = [p + 0.5 for p in range(miny, maxy)]
-
-    window = rasterio.windows.Window(minx, miny, dx, dy)
-
-    mask = raster.read_masks(indexes=1, window=window)
-
-    for i, y in enumerate(ys):
-        for j, x in enumerate(xs):
-            point = Point(x, y)
-            if geom.distance(point) == 0:
-                mask[i, j] = False
+        return None
 
-    raster.write_mask(mask, window=rasterio.windows.Window(minx, miny, dx, dy))
+    return raster_coord_geojson
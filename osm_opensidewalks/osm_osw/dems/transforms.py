@@ -7,6 +7,7 @@ from rasterio.windows import Window
 import requests
 from scipy.interpolate import RectBivariateSpline
 
+from ..report import add_count
 from .constants import ned_13_index
 
 AWS_BASE = "https://prd-tnm.s3.amazonaws.com/StagedProducts/Elevation"
@@ -43,8 +44,8 @@ def list_ned13s(workdir):
     return matching
 
 
-def get_ned13_for_bounds(bounds, workdir, progressbar=False):
-    """Retrieve the NED 1/3 arc-second tileset names based on a WGS84 (lon-lat)
+def ned13s_for_bounds(bounds):
+    """List the NED 1/3 arc-second tileset names that cover a WGS84 (lon-lat)
     bounding box list: [w, s, e, n].
 
     :param bounds: Bounding box list
@@ -71,6 +72,21 @@ def get_ned13_for_bounds(bounds, workdir, progressbar=False):
                 # FIXME Outside range - issue warning? Log?
                 pass
 
+    return ned_13_tiles
+
+
+def get_ned13_for_bounds(bounds, workdir, progressbar=False):
+    """Retrieve the NED 1/3 arc-second tileset names based on a WGS84 (lon-lat)
+    bounding box list: [w, s, e, n].
+
+    :param bounds: Bounding box list
+    :type bounds: List of float
+
+    :returns: List of strings
+
+    """
+    ned_13_tiles = ned13s_for_bounds(bounds)
+
     # Check temporary dir for these tiles
     cached_tiles = list_ned13s(workdir)
 
@@ -157,7 +173,7 @@ def idw(dx, dy, masked_array):
     xs = np.array([[i - dx for i in range(masked_array.shape[0])]])
     ys = np.array([[i - dy for i in range(masked_array.shape[1])]])
 
-    distances = np.sqrt((ys ** 2).T @ xs ** 2)
+    distances = np.sqrt((ys**2).T @ xs**2)
 
     distances_masked = distances[~masked_array.mask]
     values_masked = masked_array[~masked_array.mask]
@@ -217,6 +233,7 @@ def interpolated_value(x, y, dem, method="idw", scaling_factor=1.0):
     # FIXME: create any necessary special handling for masked vs. unmasked data
     # FIXME: bilinear interp function doesn't work with masked data
     try:
+        add_count("dem_windows_read")
         dem_arr = dem.read(
             1, window=Window(offset_x, offset_y, dim, dim), masked=True
         )
@@ -0,0 +1,199 @@
+"""Streaming GeoJSON reading and writing.
+
+Features are written and read one at a time, so memory use doesn't grow with
+file size. orjson is used for encoding when installed, and output can be
+compressed with gzip or (when zstandard is installed) zstd.
+
+"""
+import gzip
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Number of characters read at a time when parsing.
+READ_SIZE = 2**20
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+_FEATURES_ARRAY = re.compile(r'"features"\s*:\s*\[')
+_SKIPPED = " \t\n\r,"
+
+
+def compression_for(path, compression=None):
+    """Find the compression of a file from its suffix, unless given.
+
+    :param path: Path to the file.
+    :type path: str
+    :param compression: "gzip", "zstd", None (detect from the suffix) or
+                        "none".
+    :type compression: str
+    :returns: "gzip", "zstd" or None.
+
+    """
+    if compression is None:
+        return COMPRESSION_SUFFIXES.get("." + str(path).rsplit(".", 1)[-1])
+    if compression == "none":
+        return None
+    if compression not in COMPRESSION_SUFFIXES.values():
+        raise ValueError(f"Unknown compression {compression}")
+    return compression
+
+
+def open_file(path, mode, compression=None):
+    """Open a (possibly compressed) file. See compression_for.
+
+    :param path: Path to the file.
+    :type path: str
+    :param mode: A binary or text mode, e.g. "wb" or "rt".
+    :type mode: str
+    :param compression: "gzip", "zstd", None (detect from the suffix) or
+                        "none".
+    :type compression: str
+
+    """
+    compression = compression_for(path, compression)
+    encoding = None if "b" in mode else "utf-8"
+    if compression == "gzip":
+        return gzip.open(path, mode, encoding=encoding)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard")
+        return zstandard.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+def dumps(obj):
+    """Encode an object as compact JSON bytes, using orjson if installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+class FeatureCollectionWriter:
+    """Write GeoJSON Features to a FeatureCollection file one at a time.
+
+    Every feature is written on its own line. Use as a context manager.
+    See NewlineDelimitedWriter for output without the FeatureCollection.
+
+    :param path: Path to the output file.
+    :type path: str
+    :param compression: "gzip", "zstd", None (detect from the suffix) or
+                        "none".
+    :type compression: str
+
+    """
+
+    HEADER = b'{"type":"FeatureCollection","features":[\n'
+    SEPARATOR = b",\n"
+    FOOTER = b"\n]}\n"
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.compression = compression
+        self.f = None
+        self.count = 0
+
+    def __enter__(self):
+        self.f = open_file(self.path, "wb", self.compression)
+        self.f.write(self.HEADER)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.f.write(self.FOOTER)
+        finally:
+            self.f.close()
+
+    def write(self, feature):
+        if self.count:
+            self.f.write(self.SEPARATOR)
+        self.f.write(dumps(feature))
+        self.count += 1
+
+    def write_all(self, features):
+        for feature in features:
+            self.write(feature)
+
+
+class NewlineDelimitedWriter(FeatureCollectionWriter):
+    """Write GeoJSON Features one per line with no enclosing
+    FeatureCollection (newline-delimited GeoJSON), e.g. so that tippecanoe
+    can read different parts of the file in parallel.
+
+    """
+
+    HEADER = b""
+    SEPARATOR = b"\n"
+    FOOTER = b"\n"
+
+
+def iter_features(path, compression=None):
+    """Iterate over the Features of a GeoJSON FeatureCollection, or of a
+    newline-delimited GeoJSON file, without loading the whole file.
+
+    :param path: Path to the file.
+    :type path: str
+    :param compression: "gzip", "zstd", None (detect from the suffix) or
+                        "none".
+    :type compression: str
+
+    """
+    decoder = json.JSONDecoder()
+    with open_file(path, "rt", compression) as f:
+        buf = f.read(READ_SIZE)
+        eof = not buf
+
+        # In a FeatureCollection, the features array starts before any
+        # geometry. Otherwise, the file is a sequence of Features.
+        in_array = False
+        while True:
+            match = _FEATURES_ARRAY.search(buf)
+            geometry = buf.find('"geometry"')
+            if match is not None and (
+                geometry == -1 or match.start() < geometry
+            ):
+                buf = buf[match.end() :]
+                in_array = True
+                break
+            if geometry != -1 or eof:
+                break
+            chunk = f.read(READ_SIZE)
+            eof = not chunk
+            buf += chunk
+
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in _SKIPPED:
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    return
+                buf = f.read(READ_SIZE)
+                eof = not buf
+                pos = 0
+                continue
+            if in_array and buf[pos] == "]":
+                return
+            try:
+                feature, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The feature continues past the end of the buffer.
+                chunk = f.read(READ_SIZE)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield feature
+            pos = end
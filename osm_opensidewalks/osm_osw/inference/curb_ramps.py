@@ -6,13 +6,10 @@ import utm
 ACCESSIBLE_KERBS = ("flush", "lowered")
 
 
-def _is_crossing(properties):
-    if (
-        properties.get("highway", "") == "footway"
-        and properties.get("footway", "") == "crossing"
-    ):
-        return True
-    return False
+def _is_crossing(edge_attrs):
+    return edge_attrs.isin("highway", ("footway",)) & edge_attrs.isin(
+        "footway", ("crossing",)
+    )
 
 
 def near_curbramp(endpoints, sindex, distance):
@@ -37,13 +34,15 @@ def infer_curbramps(OG, distance=3, progressbar=None):
     :type distance: Numeric
 
     """
+    G = OG.G
+
     # Put all curb nodes into a spatial index (for rapid distance queries)
     kerbs = []
-    for n, d in OG.G.nodes(data=True):
-        if "kerb" in d and d["kerb"] in ACCESSIBLE_KERBS:
-            # Extract geometry while converting to UTM coordinates
-            x, y = utm.from_latlon(d["geometry"].y, d["geometry"].x)[:2]
-            kerbs.append(pygeos.points([x, y]))
+    is_kerb = G.node_attrs.isin("kerb", ACCESSIBLE_KERBS)
+    for lon, lat in zip(G.lon[is_kerb], G.lat[is_kerb]):
+        # Extract geometry while converting to UTM coordinates
+        x, y = utm.from_latlon(lat, lon)[:2]
+        kerbs.append(pygeos.points([x, y]))
     sindex = pygeos.STRtree(kerbs)
 
     # For each crossing, query start and end nodes for proximity to a curb ramp
@@ -51,10 +50,18 @@ def infer_curbramps(OG, distance=3, progressbar=None):
     # curb ramps. This *should* be safe given that crossings get split at
     # street centerlines.
     # FIXME: guarantee this by checking the non-street-intersecting end node.
-    for u, v, d in OG.G.edges(data=True):
+    crossings = []
+    curbramps = []
+    is_crossing = _is_crossing(G.edge_attrs)
+    for i in range(G.number_of_edges()):
         if progressbar is not None:
             progressbar.update(1)
-        if _is_crossing(d):
-            start = d["geometry"].coords[0]
-            end = d["geometry"].coords[-1]
-            d["curbramps"] = int(near_curbramp((start, end), sindex, distance))
+        if is_crossing[i]:
+            coords = G.edge_coords(i)
+            start = tuple(coords[0])
+            end = tuple(coords[-1])
+            crossings.append(i)
+            curbramps.append(
+                int(near_curbramp((start, end), sindex, distance))
+            )
+    G.edge_attrs.set("curbramps", crossings, curbramps)
@@ -0,0 +1,187 @@
+"""Record how the files in a working directory were made, so that stages can
+skip work whose inputs haven't changed.
+
+Every output file has a lineage: the (stage, key) pairs of the stages that
+have written it, in order. A stage's key is a hash of the osm_osw source code
+and of everything the stage reads, such as content hashes of input files and
+options. A stage is up to date for an output when the file hasn't changed
+since it was last recorded and (stage, key) is in its lineage. Rerunning a
+stage drops the stages that came after it from the lineage, so that they are
+rerun too.
+
+"""
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+MANIFEST_NAME = "manifest.json"
+
+# Number of bytes hashed at a time.
+HASH_BLOCK_SIZE = 2**20
+
+
+@functools.lru_cache(maxsize=None)
+def code_digest():
+    """Hash of the osm_osw package's source code, so that cached outputs are
+    rebuilt whenever the code changes.
+
+    """
+    package_dir = Path(__file__).parent
+    h = hashlib.sha256()
+    for path in sorted(package_dir.rglob("*.py")):
+        h.update(str(path.relative_to(package_dir)).encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 hash of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Manifest of stage inputs and outputs in a working directory.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param force: Treat every stage as out of date.
+    :type force: bool
+
+    """
+
+    def __init__(self, workdir, force=False):
+        self.path = Path(workdir, MANIFEST_NAME)
+        self.force = force
+        self.files = {}
+        self.outputs = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.files = manifest["files"]
+            self.outputs = manifest["outputs"]
+
+    def digest(self, path, refresh=False):
+        """Content hash of a file. Hashes are reused while a file's size and
+        modification time are unchanged, so large inputs such as extracts and
+        DEMs are only read again after they change.
+
+        :param path: Path to the file.
+        :type path: str
+        :param refresh: Hash the file even if it appears unchanged.
+        :type refresh: bool
+        :returns: str or None if the file doesn't exist.
+
+        """
+        name = os.path.abspath(path)
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            self.files.pop(name, None)
+            return None
+
+        entry = self.files.get(name)
+        if (
+            refresh
+            or entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+        ):
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "digest": file_digest(name),
+            }
+            self.files[name] = entry
+
+        return entry["digest"]
+
+    def key(self, stage, *inputs):
+        """Key of a stage run on the given inputs (JSON-serializable values,
+        e.g. file digests and options).
+
+        :param stage: Stage name.
+        :type stage: str
+
+        """
+        encoded = json.dumps([code_digest(), stage, inputs], sort_keys=True)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def is_fresh(self, path, stage, key):
+        """Whether an output file is up to date for a stage.
+
+        :param path: Path to the output file.
+        :type path: str
+        :param stage: Stage name.
+        :type stage: str
+        :param key: Stage key, from Manifest.key.
+        :type key: str
+        :returns: bool
+
+        """
+        if self.force:
+            return False
+        entry = self.outputs.get(os.path.abspath(path))
+        if entry is None or self.digest(path) != entry["digest"]:
+            return False
+        return [stage, key] in entry["lineage"]
+
+    def stage_key(self, path, stage):
+        """Key of the stage that last wrote an output file, as recorded in
+        its lineage.
+
+        :param path: Path to the output file.
+        :type path: str
+        :param stage: Stage name.
+        :type stage: str
+        :returns: str or None if the stage hasn't been recorded.
+
+        """
+        entry = self.outputs.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        for recorded_stage, key in entry["lineage"]:
+            if recorded_stage == stage:
+                return key
+        return None
+
+    def record(self, path, stage, key, creates=False):
+        """Record that a stage has written an output file.
+
+        :param path: Path to the output file.
+        :type path: str
+        :param stage: Stage name.
+        :type stage: str
+        :param key: Stage key, from Manifest.key.
+        :type key: str
+        :param creates: Whether the stage creates the file from scratch,
+                        rather than updating it.
+        :type creates: bool
+
+        """
+        name = os.path.abspath(path)
+        lineage = []
+        if not creates and name in self.outputs:
+            for previous_stage, previous_key in self.outputs[name]["lineage"]:
+                if previous_stage == stage:
+                    break
+                lineage.append([previous_stage, previous_key])
+        lineage.append([stage, key])
+
+        self.outputs[name] = {
+            "digest": self.digest(path, refresh=True),
+            "lineage": lineage,
+        }
+
+    def save(self):
+        """Write the manifest to the working directory."""
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files, "outputs": self.outputs}, f)
+        os.replace(tmp_path, self.path)
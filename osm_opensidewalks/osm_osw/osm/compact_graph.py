@@ -0,0 +1,1021 @@
+"""Compact, array-backed graph storage for OSM-derived networks.
+
+Nodes are stored as dense integer indices into numpy arrays of OSM ids and
+coordinates. Coordinates are fixed-point integers in OSM's native units of
+1e-7 degrees and are only converted to floats for geometries and output.
+Edges are stored in CSR order (sorted by source node) with columnar
+attributes, so memory scales with the number of elements rather than with
+per-element dict overhead.
+
+"""
+import json
+
+import networkx as nx
+import numpy as np
+from shapely.geometry import LineString, Point
+
+
+INDEX_DTYPE = np.int32
+
+# Number of rows whose attributes are decoded at once when iterating
+ROW_BATCH_SIZE = 10000
+
+# Version of the binary format written by CompactGraph.save
+FORMAT_VERSION = 1
+
+# Fixed-point coordinates: integer multiples of 1e-7 degrees, as in OSM data.
+COORDINATE_DTYPE = np.int32
+COORDINATE_SCALE = 10000000
+
+
+def to_fixed(degrees):
+    """Convert coordinates in degrees to fixed-point integers."""
+    degrees = np.asarray(degrees, dtype=np.float64)
+    return np.round(degrees * COORDINATE_SCALE).astype(COORDINATE_DTYPE)
+
+
+def to_degrees(fixed):
+    """Convert fixed-point integer coordinates to degrees."""
+    # Dividing (rather than multiplying by 1e-7) gives the float closest to
+    # the decimal value, as osmium does.
+    return np.asarray(fixed) / COORDINATE_SCALE
+
+
+class Column:
+    """A typed column of optional values.
+
+    Columns are one of these kinds:
+
+    - "int": int64 values.
+    - "float": float64 values.
+    - "category": int32 codes into a list of (string) categories.
+    - "object": arbitrary Python objects.
+
+    Missing values are tracked with a boolean `present` array.
+
+    """
+
+    def __init__(self, kind, values, present, categories=None):
+        self.kind = kind
+        self.values = values
+        self.present = present
+        self.categories = categories
+        if kind == "category":
+            self._codes = {c: i for i, c in enumerate(categories)}
+
+    def __len__(self):
+        return len(self.values)
+
+    @staticmethod
+    def infer_kind(values):
+        """Infer the column kind that can represent every (non-None) value."""
+        types = {type(v) for v in values if v is not None}
+        if types == {int}:
+            return "int"
+        if types == {float}:
+            return "float"
+        if types == {str}:
+            return "category"
+        return "object"
+
+    @classmethod
+    def empty(cls, kind, n):
+        present = np.zeros(n, dtype=bool)
+        if kind == "int":
+            return cls(kind, np.zeros(n, dtype=np.int64), present)
+        elif kind == "float":
+            return cls(kind, np.full(n, np.nan), present)
+        elif kind == "category":
+            return cls(kind, np.zeros(n, dtype=np.int32), present, [])
+        else:
+            return cls(kind, np.full(n, None, dtype=object), present)
+
+    @classmethod
+    def from_values(cls, values):
+        """Create a column from a list of values, where None is missing."""
+        kind = cls.infer_kind(values)
+        column = cls.empty(kind, len(values))
+        indices = [i for i, v in enumerate(values) if v is not None]
+        column.set(indices, [values[i] for i in indices])
+        return column
+
+    def accepts(self, values):
+        if not len(values):
+            return True
+        if isinstance(values, np.ndarray):
+            if self.kind == "int":
+                return np.issubdtype(values.dtype, np.integer)
+            if self.kind == "float":
+                return np.issubdtype(values.dtype, np.floating)
+            if self.kind == "object":
+                return True
+            values = values.tolist()
+        kind = self.infer_kind(values)
+        return self.kind == "object" or kind == self.kind
+
+    def set(self, indices, values):
+        """Set values at row indices, widening the column kind if needed."""
+        if not self.accepts(values):
+            self._to_object()
+
+        if self.kind == "category":
+            codes = []
+            for value in values:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self.categories)
+                    self.categories.append(value)
+                    self._codes[value] = code
+                codes.append(code)
+            values = codes
+        elif self.kind == "object" and isinstance(values, np.ndarray):
+            values = values.tolist()
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.kind == "object":
+            # Assign element-wise so that sequence values aren't broadcast
+            for i, value in zip(indices.tolist(), values):
+                self.values[i] = value
+        else:
+            self.values[indices] = values
+        self.present[indices] = True
+
+    def _to_object(self):
+        values = np.full(len(self), None, dtype=object)
+        for i, value in enumerate(self.to_list()):
+            values[i] = value
+        self.kind = "object"
+        self.values = values
+        self.categories = None
+
+    def get(self, i):
+        if not self.present[i]:
+            return None
+        if self.kind == "category":
+            return self.categories[self.values[i]]
+        elif self.kind == "object":
+            return self.values[i]
+        return self.values[i].item()
+
+    def to_list(self, start=None, stop=None):
+        """Python values for every row (or a range of rows), with None for
+        missing values.
+
+        """
+        rows = slice(start, stop)
+        if self.kind == "category":
+            categories = self.categories
+            values = [categories[c] for c in self.values[rows].tolist()]
+        else:
+            values = self.values[rows].tolist()
+        present = self.present[rows].tolist()
+        return [v if p else None for v, p in zip(values, present)]
+
+    def take(self, indices):
+        categories = None
+        if self.categories is not None:
+            categories = list(self.categories)
+        return Column(
+            self.kind,
+            self.values[indices],
+            self.present[indices],
+            categories,
+        )
+
+    def to_arrays(self):
+        """Encode the column as a dict of numpy arrays without Python
+        objects, e.g. for np.savez. Object values are encoded as JSON.
+
+        """
+        arrays = {"present": self.present}
+        if self.kind == "object":
+            arrays["json"] = np.array(json.dumps(self.values.tolist()))
+        else:
+            arrays["values"] = self.values
+        if self.kind == "category":
+            arrays["categories"] = np.array(self.categories, dtype=str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, kind, arrays):
+        """Decode a column encoded with Column.to_arrays."""
+        present = np.asarray(arrays["present"], dtype=bool)
+        if kind == "object":
+            values = np.full(len(present), None, dtype=object)
+            for i, value in enumerate(json.loads(arrays["json"].item())):
+                values[i] = value
+            return cls(kind, values, present)
+        categories = None
+        if kind == "category":
+            categories = arrays["categories"].tolist()
+        return cls(kind, np.asarray(arrays["values"]), present, categories)
+
+    def isin(self, values):
+        """Boolean array of rows whose value is one of `values`."""
+        if self.kind == "category":
+            codes = [self._codes[v] for v in values if v in self._codes]
+            return self.present & np.isin(self.values, codes)
+        return self.present & np.isin(self.values, list(values))
+
+
+class AttributeTable:
+    """Columnar storage of optional, typed attributes for a number of rows."""
+
+    def __init__(self, n, columns=None):
+        self.n = n
+        self.columns = {} if columns is None else columns
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @classmethod
+    def from_records(cls, records):
+        """Create a table from a list of dicts, one per row."""
+        names = {}
+        for record in records:
+            for name in record:
+                names[name] = None
+
+        table = cls(len(records))
+        for name in names:
+            values = [record.get(name) for record in records]
+            table.columns[name] = Column.from_values(values)
+
+        return table
+
+    def set(self, name, indices, values):
+        """Set the values of an attribute for a list of row indices."""
+        if name not in self.columns:
+            kind = "object"
+            if isinstance(values, np.ndarray):
+                if np.issubdtype(values.dtype, np.integer):
+                    kind = "int"
+                elif np.issubdtype(values.dtype, np.floating):
+                    kind = "float"
+            else:
+                kind = Column.infer_kind(values)
+            self.columns[name] = Column.empty(kind, self.n)
+        self.columns[name].set(indices, values)
+
+    def set_records(self, indices, records):
+        """Set the attributes of a list of row indices from dicts."""
+        by_name = {}
+        for i, record in zip(indices, records):
+            for name, value in record.items():
+                by_name.setdefault(name, ([], []))
+                by_name[name][0].append(i)
+                by_name[name][1].append(value)
+
+        for name, (name_indices, values) in by_name.items():
+            self.set(name, name_indices, values)
+
+    def drop(self, name):
+        self.columns.pop(name, None)
+
+    def row(self, i):
+        """Attributes of row i as a dict, skipping missing values."""
+        d = {}
+        for name, column in self.columns.items():
+            if column.present[i]:
+                d[name] = column.get(i)
+        return d
+
+    def iter_rows(self, exclude=(), batch_size=ROW_BATCH_SIZE):
+        """Iterate over the attributes of every row as dicts, skipping
+        missing values. Columns are decoded a batch of rows at a time.
+
+        :param exclude: Names of attributes to leave out.
+        :type exclude: collection of str
+        :param batch_size: Number of rows decoded at once.
+        :type batch_size: int
+
+        """
+        names = [name for name in self.columns if name not in exclude]
+        for start in range(0, self.n, batch_size):
+            stop = min(start + batch_size, self.n)
+            columns = [
+                self.columns[name].to_list(start, stop) for name in names
+            ]
+            for i in range(stop - start):
+                d = {}
+                for name, values in zip(names, columns):
+                    value = values[i]
+                    if value is not None:
+                        d[name] = value
+                yield d
+
+    def set_rows(self, indices, table):
+        """Set the attributes of a list of row indices from the rows of
+        another table, in order. Missing values are skipped.
+
+        :param indices: Row indices, one per row of `table`.
+        :type indices: numpy.ndarray
+        :param table: Table to copy attributes from.
+        :type table: AttributeTable
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        for name, column in table.columns.items():
+            present = column.present
+            if column.kind in ("int", "float"):
+                values = column.values[present]
+            else:
+                values = [
+                    v for v, p in zip(column.to_list(), present.tolist()) if p
+                ]
+            self.set(name, indices[present], values)
+
+    @classmethod
+    def concat(cls, tables):
+        """A new table made of the rows of several tables, in order."""
+        table = cls(sum(len(t) for t in tables))
+        start = 0
+        for t in tables:
+            table.set_rows(np.arange(start, start + len(t)), t)
+            start += len(t)
+        return table
+
+    def take(self, indices):
+        """A new table made of the given rows, in order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = {
+            name: column.take(indices) for name, column in self.columns.items()
+        }
+        return AttributeTable(len(indices), columns)
+
+    def isin(self, name, values):
+        """Boolean array of rows where attribute `name` is one of `values`."""
+        if name not in self.columns:
+            return np.zeros(self.n, dtype=bool)
+        return self.columns[name].isin(values)
+
+    def to_arrays(self, prefix):
+        """Encode the table as a list of (name, kind) column descriptions and
+        a dict of numpy arrays with keys starting with `prefix`.
+
+        """
+        columns = []
+        arrays = {}
+        for i, (name, column) in enumerate(self.columns.items()):
+            columns.append((name, column.kind))
+            for key, array in column.to_arrays().items():
+                arrays[f"{prefix}{i}_{key}"] = array
+        return columns, arrays
+
+    @classmethod
+    def from_arrays(cls, n, columns, arrays, prefix):
+        """Decode a table encoded with AttributeTable.to_arrays."""
+        table = cls(n)
+        for i, (name, kind) in enumerate(columns):
+            column_prefix = f"{prefix}{i}_"
+            column_arrays = {
+                key[len(column_prefix) :]: arrays[key]
+                for key in arrays
+                if key.startswith(column_prefix)
+            }
+            table.columns[name] = Column.from_arrays(kind, column_arrays)
+        return table
+
+
+def take_ragged(offsets, values, indices):
+    """Select (and reorder) the rows of a ragged array.
+
+    :param offsets: Start offset of every row into `values`, plus the end.
+    :type offsets: numpy.ndarray
+    :param values: Flattened row values.
+    :type values: numpy.ndarray
+    :param indices: Rows to select.
+    :type indices: numpy.ndarray
+    :returns: Tuple of new (offsets, values).
+
+    """
+    starts = offsets[:-1][indices]
+    lengths = offsets[1:][indices] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(
+        new_offsets[-1]
+    )
+    return new_offsets, values[positions]
+
+
+def _rank_chains(prev):
+    """Find the first element of, and position along, linked chains.
+
+    Uses pointer jumping, so the number of steps is logarithmic in the length
+    of the longest chain.
+
+    :param prev: Index of the previous element of every element, or the
+                 element itself if it is first.
+    :type prev: numpy.ndarray
+    :returns: Tuple of (first, position, lowest) arrays, where `lowest` is the
+              lowest index seen along the chain. Elements of closed loops
+              never reach a first element: their lowest index is the lowest
+              of the loop.
+
+    """
+    n = len(prev)
+    first = prev.copy()
+    position = (prev != np.arange(n)).astype(np.int64)
+    lowest = np.minimum(prev, np.arange(n))
+    for _ in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        jumped = first[first]
+        if np.array_equal(jumped, first):
+            break
+        position = position + position[first]
+        lowest = np.minimum(lowest, lowest[first])
+        first = jumped
+
+    return first, position, lowest
+
+
+class CompactGraph:
+    """Directed multigraph of OSM nodes stored in numpy arrays.
+
+    :param node_ids: OSM ids of the nodes.
+    :type node_ids: numpy.ndarray
+    :param x: Fixed-point longitudes of the nodes (see to_fixed).
+    :type x: numpy.ndarray
+    :param y: Fixed-point latitudes of the nodes.
+    :type y: numpy.ndarray
+    :param src: Source node index of every edge.
+    :type src: numpy.ndarray
+    :param dst: Destination node index of every edge.
+    :type dst: numpy.ndarray
+    :param node_attrs: Node attributes.
+    :type node_attrs: AttributeTable
+    :param edge_attrs: Edge attributes.
+    :type edge_attrs: AttributeTable
+    :param ndrefs: Optional (offsets, node indices) ragged array of the node
+                   references along every edge.
+    :type ndrefs: tuple of numpy.ndarray
+    :param coords: Optional (offsets, (n, 2) fixed-point lon-lat array)
+                   ragged array of the coordinates of every edge's geometry.
+    :type coords: tuple of numpy.ndarray
+
+    """
+
+    def __init__(
+        self,
+        node_ids,
+        x,
+        y,
+        src,
+        dst,
+        node_attrs=None,
+        edge_attrs=None,
+        ndrefs=None,
+        coords=None,
+    ):
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        x = np.asarray(x, dtype=COORDINATE_DTYPE)
+        y = np.asarray(y, dtype=COORDINATE_DTYPE)
+        src = np.asarray(src, dtype=INDEX_DTYPE)
+        dst = np.asarray(dst, dtype=INDEX_DTYPE)
+        if node_attrs is None:
+            node_attrs = AttributeTable(len(node_ids))
+        if edge_attrs is None:
+            edge_attrs = AttributeTable(len(src))
+
+        # Nodes are kept sorted by OSM id so that ids can be looked up with a
+        # binary search.
+        if np.any(node_ids[1:] < node_ids[:-1]):
+            order = np.argsort(node_ids, kind="stable")
+            remap = np.empty(len(order), dtype=INDEX_DTYPE)
+            remap[order] = np.arange(len(order), dtype=INDEX_DTYPE)
+            node_ids = node_ids[order]
+            x = x[order]
+            y = y[order]
+            node_attrs = node_attrs.take(order)
+            src = remap[src]
+            dst = remap[dst]
+            if ndrefs is not None:
+                ndrefs = (ndrefs[0], remap[ndrefs[1]])
+
+        # Edges are kept sorted by source node: CSR adjacency.
+        if np.any(src[1:] < src[:-1]):
+            order = np.argsort(src, kind="stable")
+            src = src[order]
+            dst = dst[order]
+            edge_attrs = edge_attrs.take(order)
+            if ndrefs is not None:
+                ndrefs = take_ragged(*ndrefs, order)
+            if coords is not None:
+                coords = take_ragged(*coords, order)
+
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.node_attrs = node_attrs
+        self.src = src
+        self.dst = dst
+        self.edge_attrs = edge_attrs
+        self.ndrefs = ndrefs
+        self.coords = coords
+
+        self.indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(src, minlength=len(node_ids)), out=self.indptr[1:]
+        )
+
+    @property
+    def lon(self):
+        """Longitudes of the nodes, in degrees."""
+        return to_degrees(self.x)
+
+    @property
+    def lat(self):
+        """Latitudes of the nodes, in degrees."""
+        return to_degrees(self.y)
+
+    @classmethod
+    def from_ways(cls, way_attrs, offsets, refs, x, y):
+        """Create a graph with one edge per way segment.
+
+        :param way_attrs: Attributes of every way. These are copied to every
+                          edge derived from the way, along with a 'segment'
+                          attribute counting the segments along the way.
+        :type way_attrs: AttributeTable
+        :param offsets: Offset of every way's first node into `refs`, plus the
+                        end. Every way must have at least two nodes.
+        :type offsets: array-like
+        :param refs: OSM node ids of the nodes of every way, concatenated.
+        :type refs: array-like
+        :param x: Fixed-point longitude of every entry in `refs`.
+        :type x: array-like
+        :param y: Fixed-point latitude of every entry in `refs`.
+        :type y: array-like
+
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        refs = np.asarray(refs, dtype=np.int64)
+        x = np.asarray(x, dtype=COORDINATE_DTYPE)
+        y = np.asarray(y, dtype=COORDINATE_DTYPE)
+
+        node_ids, first, inverse = np.unique(
+            refs, return_index=True, return_inverse=True
+        )
+        inverse = inverse.astype(INDEX_DTYPE)
+
+        # Every node but the last one of a way starts a segment
+        counts = np.diff(offsets)
+        is_last = np.zeros(len(refs), dtype=bool)
+        is_last[offsets[1:] - 1] = True
+        starts = np.flatnonzero(~is_last)
+
+        src = inverse[starts]
+        dst = inverse[starts + 1]
+        edge_way = np.repeat(np.arange(len(counts)), counts - 1)
+
+        edge_attrs = way_attrs.take(edge_way)
+        edge_attrs.set(
+            "segment",
+            np.arange(len(starts)),
+            starts - offsets[:-1][edge_way],
+        )
+
+        ndref_offsets = np.arange(0, 2 * len(starts) + 1, 2, dtype=np.int64)
+        ndref_values = np.column_stack((src, dst)).ravel()
+
+        return cls(
+            node_ids,
+            x[first],
+            y[first],
+            src,
+            dst,
+            edge_attrs=edge_attrs,
+            ndrefs=(ndref_offsets, ndref_values),
+        )
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.src)
+
+    def node_index(self, node_ids):
+        """Find the indices of OSM node ids. Missing ids are given -1."""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if not len(self.node_ids):
+            return np.full(len(node_ids), -1, dtype=np.int64)
+        indices = np.searchsorted(self.node_ids, node_ids)
+        indices[indices == len(self.node_ids)] = 0
+        found = self.node_ids[indices] == node_ids
+        return np.where(found, indices, -1)
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        return np.bincount(self.dst, minlength=self.number_of_nodes())
+
+    def successors(self, i):
+        return self.dst[self.indptr[i] : self.indptr[i + 1]]
+
+    def edge_coords(self, i):
+        """Coordinates of an edge's geometry as an (n, 2) array of degrees."""
+        offsets, values = self.coords
+        return to_degrees(values[offsets[i] : offsets[i + 1]])
+
+    def edge_geometry(self, i):
+        return LineString(self.edge_coords(i))
+
+    def node_geometry(self, i):
+        return Point(
+            self.x[i].item() / COORDINATE_SCALE,
+            self.y[i].item() / COORDINATE_SCALE,
+        )
+
+    def node_data(self, i, geometry=False):
+        d = {
+            "lon": self.x[i].item() / COORDINATE_SCALE,
+            "lat": self.y[i].item() / COORDINATE_SCALE,
+        }
+        d.update(self.node_attrs.row(i))
+        if geometry:
+            d["geometry"] = self.node_geometry(i)
+        return d
+
+    def edge_data(self, i, geometry=False):
+        d = self.edge_attrs.row(i)
+        if self.ndrefs is not None:
+            offsets, values = self.ndrefs
+            refs = values[offsets[i] : offsets[i + 1]]
+            d["ndref"] = self.node_ids[refs].tolist()
+        if geometry and self.coords is not None:
+            d["geometry"] = self.edge_geometry(i)
+        return d
+
+    def edges(self, data=False, geometry=False):
+        """Iterate over edges as (u, v) or (u, v, d) OSM node id tuples."""
+        us = self.node_ids[self.src].tolist()
+        vs = self.node_ids[self.dst].tolist()
+        for i, (u, v) in enumerate(zip(us, vs)):
+            if data:
+                yield u, v, self.edge_data(i, geometry=geometry)
+            else:
+                yield u, v
+
+    def contract_nodes(self, nodes):
+        """Remove nodes that have exactly one in-edge and one out-edge by
+        joining these edges into one. Chains of such nodes are joined into a
+        single edge that keeps the attributes of the chain's first edge and
+        concatenates the node refs (and coordinates) of the whole chain.
+
+        A chain that forms a closed loop is kept as one self-loop edge, broken
+        at its lowest-indexed edge.
+
+        :param nodes: Indices of the nodes to remove.
+        :type nodes: numpy.ndarray
+        :returns: A new CompactGraph. Removed nodes are kept in the node table
+                  as they may still be referenced by edge node refs.
+
+        """
+        n_edges = self.number_of_edges()
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if n_edges == 0:
+            return self
+
+        in_edge = np.full(self.number_of_nodes(), -1, dtype=np.int64)
+        in_edge[self.dst] = np.arange(n_edges)
+        out_edge = self.indptr[:-1]
+
+        # Link every edge to the previous edge of its chain. Edges that start
+        # a chain are linked to themselves.
+        prev = np.arange(n_edges)
+        prev[out_edge[nodes]] = in_edge[nodes]
+
+        first, position, lowest = _rank_chains(prev)
+        is_loop = prev[first] != first
+        if is_loop.any():
+            loop_starts = np.flatnonzero(
+                is_loop & (lowest == np.arange(n_edges))
+            )
+            prev[loop_starts] = loop_starts
+            first, position, lowest = _rank_chains(prev)
+
+        # Order edges chain by chain
+        order = np.lexsort((position, first))
+        chain_starts = np.flatnonzero(position[order] == 0)
+        chain_ends = np.append(chain_starts[1:], n_edges) - 1
+        heads = order[chain_starts]
+        tails = order[chain_ends]
+        continuing = position[order] > 0
+
+        def join(ragged):
+            # Concatenate rows of a ragged array along every chain, dropping
+            # the first value of every continuing edge: it is the same as the
+            # last value of the previous edge.
+            offsets, values = take_ragged(*ragged, order)
+            keep = np.ones(len(values), dtype=bool)
+            keep[offsets[:-1][continuing]] = False
+            lengths = np.diff(offsets) - continuing
+            chain_offsets = np.zeros(len(chain_starts) + 1, dtype=np.int64)
+            if len(chain_starts):
+                np.cumsum(
+                    np.add.reduceat(lengths, chain_starts),
+                    out=chain_offsets[1:],
+                )
+            return chain_offsets, values[keep]
+
+        ndrefs = None
+        if self.ndrefs is not None:
+            ndrefs = join(self.ndrefs)
+        coords = None
+        if self.coords is not None:
+            coords = join(self.coords)
+
+        return CompactGraph(
+            self.node_ids,
+            self.x,
+            self.y,
+            self.src[heads],
+            self.dst[tails],
+            node_attrs=self.node_attrs,
+            edge_attrs=self.edge_attrs.take(heads),
+            ndrefs=ndrefs,
+            coords=coords,
+        )
+
+    @classmethod
+    def concat(cls, graphs):
+        """Combine the nodes and edges of several graphs. Nodes with the same
+        OSM id are merged, taking their coordinates and attributes from the
+        last graph they are in.
+
+        Node refs and coordinates are only kept if every graph has them.
+
+        :param graphs: Graphs to combine.
+        :type graphs: list of CompactGraph
+        :returns: CompactGraph
+
+        """
+        node_ids = np.unique(np.concatenate([g.node_ids for g in graphs]))
+        x = np.zeros(len(node_ids), dtype=COORDINATE_DTYPE)
+        y = np.zeros(len(node_ids), dtype=COORDINATE_DTYPE)
+        node_attrs = AttributeTable(len(node_ids))
+        remaps = []
+        for g in graphs:
+            remap = np.searchsorted(node_ids, g.node_ids).astype(INDEX_DTYPE)
+            x[remap] = g.x
+            y[remap] = g.y
+            node_attrs.set_rows(remap, g.node_attrs)
+            remaps.append(remap)
+
+        def concat_ragged(name, remap_values):
+            if any(getattr(g, name) is None for g in graphs):
+                return None
+            offsets = [np.zeros(1, dtype=np.int64)]
+            values = []
+            start = 0
+            for g, remap in zip(graphs, remaps):
+                g_offsets, g_values = getattr(g, name)
+                offsets.append(g_offsets[1:] + start)
+                values.append(remap[g_values] if remap_values else g_values)
+                start += g_offsets[-1]
+            return np.concatenate(offsets), np.concatenate(values)
+
+        return cls(
+            node_ids,
+            x,
+            y,
+            np.concatenate([r[g.src] for g, r in zip(graphs, remaps)]),
+            np.concatenate([r[g.dst] for g, r in zip(graphs, remaps)]),
+            node_attrs=node_attrs,
+            edge_attrs=AttributeTable.concat([g.edge_attrs for g in graphs]),
+            ndrefs=concat_ragged("ndrefs", True),
+            coords=concat_ragged("coords", False),
+        )
+
+    def edge_subgraph(self, mask):
+        """A new graph of the edges selected by a boolean mask, along with
+        the nodes they reference.
+
+        """
+        edges = np.flatnonzero(mask)
+
+        used = np.zeros(self.number_of_nodes(), dtype=bool)
+        used[self.src[edges]] = True
+        used[self.dst[edges]] = True
+        ndrefs = None
+        if self.ndrefs is not None:
+            ndrefs = take_ragged(*self.ndrefs, edges)
+            used[ndrefs[1]] = True
+        nodes = np.flatnonzero(used)
+
+        remap = np.full(self.number_of_nodes(), -1, dtype=INDEX_DTYPE)
+        remap[nodes] = np.arange(len(nodes), dtype=INDEX_DTYPE)
+        if ndrefs is not None:
+            ndrefs = (ndrefs[0], remap[ndrefs[1]])
+
+        coords = None
+        if self.coords is not None:
+            coords = take_ragged(*self.coords, edges)
+
+        return CompactGraph(
+            self.node_ids[nodes],
+            self.x[nodes],
+            self.y[nodes],
+            remap[self.src[edges]],
+            remap[self.dst[edges]],
+            node_attrs=self.node_attrs.take(nodes),
+            edge_attrs=self.edge_attrs.take(edges),
+            ndrefs=ndrefs,
+            coords=coords,
+        )
+
+    def to_networkx(self):
+        """Convert to a networkx MultiDiGraph keyed by OSM node id.
+
+        Geometries are included as shapely objects if they've been
+        constructed.
+
+        """
+        geometry = self.coords is not None
+        G = nx.MultiDiGraph()
+        for i, n in enumerate(self.node_ids.tolist()):
+            G.add_node(n, **self.node_data(i, geometry=geometry))
+        G.add_edges_from(self.edges(data=True, geometry=True))
+
+        return G
+
+    @classmethod
+    def from_networkx(cls, G):
+        """Convert a networkx graph keyed by (integer) OSM node id.
+
+        Nodes must have 'lon' and 'lat' (or Point 'geometry') attributes.
+        Edge 'ndref' lists and LineString 'geometry' attributes are stored as
+        ragged arrays.
+
+        """
+        node_ids = []
+        lon = []
+        lat = []
+        node_records = []
+        for n, d in G.nodes(data=True):
+            d = dict(d)
+            geometry = d.pop("geometry", None)
+            if "lon" in d:
+                lon.append(d.pop("lon"))
+                lat.append(d.pop("lat"))
+            else:
+                lon.append(geometry.x)
+                lat.append(geometry.y)
+            d.pop("osm_id", None)
+            node_ids.append(int(n))
+            node_records.append(d)
+        index = {n: i for i, n in enumerate(node_ids)}
+
+        src = []
+        dst = []
+        edge_records = []
+        ndref_lengths = []
+        ndref_values = []
+        coord_lengths = []
+        coord_values = []
+        has_ndrefs = True
+        has_coords = True
+        for u, v, d in G.edges(data=True):
+            d = dict(d)
+            src.append(index[int(u)])
+            dst.append(index[int(v)])
+
+            ndref = d.pop("ndref", None)
+            if ndref is None:
+                has_ndrefs = False
+            else:
+                ndref_lengths.append(len(ndref))
+                ndref_values.extend(index[int(ref)] for ref in ndref)
+
+            geometry = d.pop("geometry", None)
+            if geometry is None:
+                has_coords = False
+            else:
+                geometry_coords = list(geometry.coords)
+                coord_lengths.append(len(geometry_coords))
+                coord_values.extend(geometry_coords)
+
+            edge_records.append(d)
+
+        def ragged(lengths, values, dtype):
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            return offsets, np.array(values, dtype=dtype)
+
+        ndrefs = None
+        if has_ndrefs and src:
+            ndrefs = ragged(ndref_lengths, ndref_values, INDEX_DTYPE)
+        coords = None
+        if has_coords and src:
+            coords = ragged(coord_lengths, coord_values, np.float64)
+            coords = (coords[0], to_fixed(coords[1].reshape(-1, 2)))
+
+        return cls(
+            node_ids,
+            to_fixed(lon),
+            to_fixed(lat),
+            src,
+            dst,
+            node_attrs=AttributeTable.from_records(node_records),
+            edge_attrs=AttributeTable.from_records(edge_records),
+            ndrefs=ndrefs,
+            coords=coords,
+        )
+
+    def save(self, path):
+        """Save the graph to a binary (uncompressed .npz) file of typed
+        arrays. Coordinates are saved as fixed-point integers.
+
+        :param path: Path to the output file.
+        :type path: str
+
+        """
+        node_columns, node_arrays = self.node_attrs.to_arrays("node_attr_")
+        edge_columns, edge_arrays = self.edge_attrs.to_arrays("edge_attr_")
+        meta = {
+            "version": FORMAT_VERSION,
+            "node_columns": node_columns,
+            "edge_columns": edge_columns,
+        }
+        arrays = {
+            "meta": np.array(json.dumps(meta)),
+            "node_ids": self.node_ids,
+            "x": self.x,
+            "y": self.y,
+            "src": self.src,
+            "dst": self.dst,
+            **node_arrays,
+            **edge_arrays,
+        }
+        if self.ndrefs is not None:
+            arrays["ndrefs_offsets"], arrays["ndrefs_values"] = self.ndrefs
+        if self.coords is not None:
+            arrays["coords_offsets"], arrays["coords_values"] = self.coords
+
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @staticmethod
+    def load_locations(path):
+        """Load only the node locations of a graph saved with
+        CompactGraph.save.
+
+        :param path: Path to the file.
+        :type path: str
+        :returns: Tuple of (lon, lat) numpy.ndarrays, in degrees.
+
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            return to_degrees(npz["x"]), to_degrees(npz["y"])
+
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved with CompactGraph.save.
+
+        :param path: Path to the file.
+        :type path: str
+
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+
+        meta = json.loads(arrays["meta"].item())
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported graph format version {meta['version']}"
+            )
+
+        ndrefs = None
+        if "ndrefs_offsets" in arrays:
+            ndrefs = (arrays["ndrefs_offsets"], arrays["ndrefs_values"])
+        coords = None
+        if "coords_offsets" in arrays:
+            coords = (arrays["coords_offsets"], arrays["coords_values"])
+
+        return cls(
+            arrays["node_ids"],
+            arrays["x"],
+            arrays["y"],
+            arrays["src"],
+            arrays["dst"],
+            node_attrs=AttributeTable.from_arrays(
+                len(arrays["node_ids"]),
+                meta["node_columns"],
+                arrays,
+                "node_attr_",
+            ),
+            edge_attrs=AttributeTable.from_arrays(
+                len(arrays["src"]),
+                meta["edge_columns"],
+                arrays,
+                "edge_attr_",
+            ),
+            ndrefs=ndrefs,
+            coords=coords,
+        )
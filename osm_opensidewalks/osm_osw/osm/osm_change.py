@@ -0,0 +1,210 @@
+"""Read OSM change (.osc) files and apply them to region extracts."""
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+import osmium
+import pygeos
+
+from ..osw.osw_normalizer import OSWWayNormalizer, OSWNodeNormalizer
+from .compact_graph import to_degrees
+from .osm_graph import HAS_FILTERS, OSMNodeParser
+from .pbf import apply_file
+
+
+class OSMChangeParser(osmium.SimpleHandler):
+    """Collects the latest version of every node and way in OSM change
+    files. Deleted objects are recorded as None.
+
+    Nodes are recorded as (x, y, attrs) tuples of fixed-point coordinates and
+    normalized OpenSidewalks attributes (None if the node has none). Ways are
+    recorded as (refs, attrs) tuples of node ids and normalized OpenSidewalks
+    attributes (None if the way isn't an OpenSidewalks way).
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nodes = {}
+        self.ways = {}
+
+    def node(self, n):
+        if n.deleted:
+            self.nodes[n.id] = None
+            return
+        self.nodes[n.id] = (
+            n.location.x,
+            n.location.y,
+            OSWNodeNormalizer.classify(n.tags),
+        )
+
+    def way(self, w):
+        if w.deleted:
+            self.ways[w.id] = None
+            return
+        self.ways[w.id] = (
+            [n.ref for n in w.nodes],
+            OSWWayNormalizer.classify(w.tags),
+        )
+
+
+class _ChangeWriter(osmium.SimpleHandler):
+    """Writes the changes to a subset of nodes and ways, plus the changes to
+    relations with one of them as a member. Deletions are always written.
+
+    """
+
+    def __init__(self, writer, node_ids, way_ids):
+        super().__init__()
+        self.writer = writer
+        self.node_ids = node_ids
+        self.way_ids = way_ids
+
+    def node(self, n):
+        if n.deleted or n.id in self.node_ids:
+            self.writer.add_node(n)
+
+    def way(self, w):
+        if w.deleted or w.id in self.way_ids:
+            self.writer.add_way(w)
+
+    def relation(self, r):
+        if r.deleted or any(
+            (m.type == "n" and m.ref in self.node_ids)
+            or (m.type == "w" and m.ref in self.way_ids)
+            for m in r.members
+        ):
+            self.writer.add_relation(r)
+
+
+def _merge_reader(change_paths):
+    reader = osmium.MergeInputReader()
+    for path in change_paths:
+        reader.add_file(str(path))
+    return reader
+
+
+def read_changes(change_paths):
+    """Read the latest version of every node and way in OSM change files.
+
+    :param change_paths: Paths to .osc (or .osc.gz) files, oldest first.
+    :type change_paths: list of str
+    :returns: OSMChangeParser with `nodes` and `ways` dicts.
+
+    """
+    parser = OSMChangeParser()
+    _merge_reader(change_paths).apply(parser, simplify=True)
+    return parser
+
+
+def locate_nodes(pbf, node_ids):
+    """Read the locations and OpenSidewalks attributes of nodes from an
+    .osm.pbf file.
+
+    :param pbf: Path to the .osm.pbf file.
+    :type pbf: str
+    :param node_ids: OSM ids of the nodes.
+    :type node_ids: collection of int
+    :returns: dict of (x, y, attrs) tuples keyed by node id. Nodes missing
+              from the file are left out.
+
+    """
+    if not node_ids:
+        return {}
+    node_ids = np.unique(np.fromiter(node_ids, dtype=np.int64))
+
+    parser = OSMNodeParser()
+    filters = []
+    if HAS_FILTERS:
+        id_filter = osmium.filter.IdFilter(node_ids.tolist())
+        filters = [id_filter.enable_for(osmium.osm.NODE)]
+    apply_file(parser, pbf, filters=filters)
+
+    ids = np.frombuffer(parser.ids, dtype=np.int64)
+    found = np.isin(ids, node_ids)
+    return {
+        n: (x, y, parser.node_candidates.get(n))
+        for n, x, y in zip(
+            ids[found].tolist(),
+            np.frombuffer(parser.xs, dtype=np.int32)[found].tolist(),
+            np.frombuffer(parser.ys, dtype=np.int32)[found].tolist(),
+        )
+    }
+
+
+def clip_changes(nodes, ways, polygon):
+    """Find the changed nodes and ways that belong to a region, as clipping
+    an extract with completeWays=yes would: ways with at least one node
+    inside the region, and nodes that are inside the region or on one of
+    these ways.
+
+    :param nodes: Located nodes, as (x, y, attrs) tuples keyed by node id.
+                  Deleted nodes are None.
+    :type nodes: dict
+    :param ways: Changed ways, as (refs, attrs) tuples keyed by way id.
+                 Deleted ways are None.
+    :type ways: dict
+    :param polygon: Region (Multi)Polygon in lon-lat coordinates.
+    :type polygon: shapely.geometry.base.BaseGeometry
+    :returns: Tuple of (node id set, way id set). Deleted objects are left
+              out.
+
+    """
+    located = [(n, v[0], v[1]) for n, v in nodes.items() if v is not None]
+    inside = set()
+    if located:
+        ids, xs, ys = zip(*located)
+        region = pygeos.from_wkb(polygon.wkb)
+        pygeos.prepare(region)
+        points = pygeos.points(to_degrees(xs), to_degrees(ys))
+        inside = set(np.array(ids)[pygeos.intersects(region, points)].tolist())
+
+    way_ids = set()
+    node_ids = set(inside)
+    for way_id, way in ways.items():
+        if way is None:
+            continue
+        refs = way[0]
+        if any(ref in inside for ref in refs):
+            way_ids.add(way_id)
+            node_ids.update(refs)
+
+    return node_ids, way_ids
+
+
+def apply_changes_to_pbf(pbf, change_paths, node_ids, way_ids):
+    """Apply the changes to a subset of nodes and ways (see clip_changes)
+    to an .osm.pbf file, replacing it. Deletions are always applied.
+
+    :param pbf: Path to the .osm.pbf file.
+    :type pbf: str
+    :param change_paths: Paths to .osc (or .osc.gz) files, oldest first.
+    :type change_paths: list of str
+    :param node_ids: OSM ids of the changed nodes to apply.
+    :type node_ids: set of int
+    :param way_ids: OSM ids of the changed ways to apply.
+    :type way_ids: set of int
+
+    """
+    pbf = Path(pbf)
+    with tempfile.TemporaryDirectory(dir=pbf.parent) as tmpdir:
+        change_path = str(Path(tmpdir, "changes.osc"))
+        writer = osmium.SimpleWriter(change_path)
+        try:
+            _merge_reader(change_paths).apply(
+                _ChangeWriter(writer, node_ids, way_ids), simplify=True
+            )
+        finally:
+            writer.close()
+
+        reader = osmium.io.Reader(str(pbf))
+        tmp_pbf = Path(tmpdir, pbf.name)
+        writer = osmium.io.Writer(str(tmp_pbf), reader.header())
+        try:
+            _merge_reader([change_path]).apply_to_reader(reader, writer)
+        finally:
+            writer.close()
+            reader.close()
+
+        os.replace(tmp_pbf, pbf)
@@ -1,123 +1,455 @@
 """Graph containers - OSM-specific building strategies and manipulations"""
-import json
+from array import array
+from pathlib import Path
+import tempfile
 
 import networkx as nx
+import numpy as np
 import osmium
 import pyproj
-from shapely.geometry import LineString, Point, mapping, shape
 
+from ..geojson_io import FeatureCollectionWriter, iter_features
 from ..osw.osw_normalizer import OSWWayNormalizer, OSWNodeNormalizer
+from ..parallel import run_jobs
+from ..report import add_count
+from .compact_graph import (
+    AttributeTable,
+    COORDINATE_DTYPE,
+    CompactGraph,
+    take_ragged,
+    to_degrees,
+    to_fixed,
+)
+from .pbf import apply_file, read_chunk, split_blobs
 
 
-class NodeCounter(osmium.SimpleHandler):
-    def __init__(self):
-        super().__init__()
-        self.count = 0
+# Number of edges whose lengths are calculated at once
+GEOMETRY_BATCH_SIZE = 100000
 
-    def node(self, n):
-        self.count += 1
+# Edge attribute of inclines estimated from DEMs. They're kept apart from
+# the inclines tagged in OSM, and replace them in output.
+DEM_INCLINE = "dem_incline"
 
+# Edge attributes that are calculated rather than read from OSM tags. They
+# are dropped when a way's edges are rebuilt from existing edges.
+DERIVED_EDGE_ATTRIBUTES = ("segment", "length", "curbramps", DEM_INCLINE)
 
-class WayCounter(osmium.SimpleHandler):
-    def __init__(self):
-        super().__init__()
-        self.count = 0
+# Coordinate osmium gives to node locations that are missing from a file.
+UNDEFINED_COORDINATE = 2**31 - 1
 
-    def way(self, w):
-        self.count += 1
+# pyosmium >= 4 can filter objects in C++ before they reach Python handlers.
+HAS_FILTERS = hasattr(osmium, "filter")
+
+# Number of byte ranges of a PBF file given to each worker when parsing in
+# parallel. More ranges than workers balance the load between node and way
+# blocks.
+CHUNKS_PER_JOB = 4
+
+
+def _round(degrees, precision=None):
+    if precision is None:
+        return degrees
+    return np.round(degrees, precision)
+
+
+def geodesic_lengths(geod, offsets, coords):
+    """Calculate the geodesic length of many lines at once.
+
+    :param geod: Geodesic distance calculator.
+    :type geod: pyproj.Geod
+    :param offsets: Offset of the first coordinate of every line, plus the
+                    end.
+    :type offsets: numpy.ndarray
+    :param coords: (n, 2) array of the lon-lat coordinates of every line,
+                   concatenated. Every line must have at least 2 coordinates.
+    :type coords: numpy.ndarray
+    :returns: numpy.ndarray of lengths in meters.
+
+    """
+    if len(offsets) < 2:
+        return np.zeros(0)
+
+    lon = np.ascontiguousarray(coords[:, 0])
+    lat = np.ascontiguousarray(coords[:, 1])
+
+    # Distances between every pair of consecutive coordinates, with pairs
+    # that span two lines zeroed out.
+    distances = np.zeros(len(coords))
+    distances[:-1] = geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])[2]
+    distances[offsets[1:] - 1] = 0
+
+    return np.add.reduceat(distances, offsets[:-1])
 
 
 class OSMWayParser(osmium.SimpleHandler):
-    def __init__(self, way_filter, progressbar=None):
+    def __init__(self, way_filter, progressbar=None, locations=True):
         osmium.SimpleHandler.__init__(self)
-        self.G = nx.MultiDiGraph()
         if way_filter is None:
             self.way_filter = lambda w: True
         else:
             self.way_filter = way_filter
         self.progressbar = progressbar
+        self.ways_seen = 0
+        # Whether node locations are available and should be stored.
+        self.locations = locations
+
+        # Ways are accumulated as flat arrays of node references and
+        # locations, with offsets marking where each way starts.
+        self.way_records = []
+        self.offsets = array("q", [0])
+        self.refs = array("q")
+        self.xs = array("i")
+        self.ys = array("i")
 
     def way(self, w):
+        self.ways_seen += 1
         if self.progressbar:
             self.progressbar.update(1)
 
-        if not self.way_filter(w.tags):
-            if self.progressbar:
-                self.progressbar.update(1)
+        attrs = OSWWayNormalizer.classify(w.tags)
+        if attrs is None or not self.way_filter(w.tags):
+            return
+
+        if len(w.nodes) < 2:
             return
 
-        d = {"osm_id": int(w.id)}
-
-        tags = dict(w.tags)
-
-        d2 = {**d, **OSWWayNormalizer(tags).normalize()}
-
-        for i in range(len(w.nodes) - 1):
-            u = w.nodes[i]
-            v = w.nodes[i + 1]
-
-            # NOTE: why are the coordinates floats? Wouldn't fixed
-            # precision be better?
-            u_ref = int(u.ref)
-            u_lon = float(u.lon)
-            u_lat = float(u.lat)
-            v_ref = int(v.ref)
-            v_lon = float(v.lon)
-            v_lat = float(v.lat)
-
-            d3 = {**d2}
-            d3["segment"] = i
-            d3["ndref"] = [u_ref, v_ref]
-            self.G.add_edges_from([(u_ref, v_ref, d3)])
-            self.G.add_node(u_ref, lon=u_lon, lat=u_lat)
-            self.G.add_node(v_ref, lon=v_lon, lat=v_lat)
-            # FIXME: osmium thinks we're keeping the way reference and
-            # raises an exception if we don't delete these references,
-            # but we're not actually keeping any references?
-            del u
-            del v
+        self.way_records.append({"osm_id": int(w.id), **attrs})
+
+        for n in w.nodes:
+            # Locations are kept in osmium's fixed-point integer units.
+            self.refs.append(n.ref)
+            if self.locations:
+                self.xs.append(n.x)
+                self.ys.append(n.y)
+        self.offsets.append(len(self.refs))
+        # FIXME: osmium thinks we're keeping the way reference and
+        # raises an exception if we don't delete these references,
+        # but we're not actually keeping any references?
+        del n
 
         del w
 
+    def to_graph(self):
+        """Create a CompactGraph with one edge per way segment."""
+        xs = np.frombuffer(self.xs, dtype=COORDINATE_DTYPE)
+        ys = np.frombuffer(self.ys, dtype=COORDINATE_DTYPE)
+        way_records, offsets, refs, xs, ys = complete_ways(
+            self.way_records,
+            np.frombuffer(self.offsets, dtype=np.int64),
+            np.frombuffer(self.refs, dtype=np.int64),
+            xs != UNDEFINED_COORDINATE,
+            xs,
+            ys,
+        )
+        add_count("ways_seen", self.ways_seen)
+        add_count("ways_kept", len(way_records))
+        return CompactGraph.from_ways(
+            way_table(way_records), offsets, refs, xs, ys
+        )
+
+
+class OSMParser(OSMWayParser):
+    """Builds a graph from ways and way nodes in a single read of an OSM file.
+
+    Node tags that pass the node filter are held as candidates while the file
+    is read, as nodes come before the ways that reference them. Candidates are
+    attached to the graph once all ways are known.
+
+    """
+
+    def __init__(self, way_filter, node_filter=None):
+        super().__init__(way_filter)
+        if node_filter is None:
+            self.node_filter = lambda n: True
+        else:
+            self.node_filter = node_filter
+        self.node_candidates = {}
+
+    def node(self, n):
+        attrs = OSWNodeNormalizer.classify(n.tags)
+        if attrs is None or not self.node_filter(n.tags):
+            return
 
-class OSMWayNodeParser(osmium.SimpleHandler):
-    def __init__(self, G, node_filter=None, progressbar=None):
-        """
+        self.node_candidates[int(n.id)] = attrs
 
-        :param G: MultiDiGraph that already has ways inserted as edges.
-        :type G: nx.MultiDiGraph
+    def to_graph(self):
+        """Create a CompactGraph with one edge per way segment, including the
+        attributes of candidate nodes that are on a kept way.
 
         """
-        osmium.SimpleHandler.__init__(self)
-        self.G = G
+        G = super().to_graph()
+        attach_node_candidates(G, self.node_candidates)
+
+        return G
+
+
+class OSMNodeParser(osmium.SimpleHandler):
+    """Collects the locations of all nodes, plus the attributes of nodes
+    that pass the node filter.
+
+    """
+
+    def __init__(self, node_filter=None):
+        super().__init__()
         if node_filter is None:
-            self.node_filter = lambda w: True
+            self.node_filter = lambda n: True
         else:
             self.node_filter = node_filter
-        self.progressbar = progressbar
+        self.node_candidates = {}
+        self.ids = array("q")
+        self.xs = array("i")
+        self.ys = array("i")
 
     def node(self, n):
-        if self.progressbar:
-            self.progressbar.update(1)
+        self.ids.append(n.id)
+        self.xs.append(n.location.x)
+        self.ys.append(n.location.y)
 
-        if not self.node_filter(n.tags):
+        attrs = OSWNodeNormalizer.classify(n.tags)
+        if attrs is None or not self.node_filter(n.tags):
             return
 
-        if n.id not in self.G.nodes:
-            return
+        self.node_candidates[int(n.id)] = attrs
+
+
+def way_table(way_records):
+    """Attributes of ways, with an osm_id column even if there are no ways.
+
+    :param way_records: Attributes of every way, including its "osm_id".
+    :type way_records: list of dict
+    :returns: AttributeTable
+
+    """
+    table = AttributeTable.from_records(way_records)
+    if "osm_id" not in table:
+        table.set("osm_id", [], np.empty(0, dtype=np.int64))
+    return table
+
+
+def _output_incline(d):
+    # An incline estimated from DEMs replaces the one tagged in OSM.
+    if DEM_INCLINE in d:
+        d["incline"] = d.pop(DEM_INCLINE)
+
+
+def complete_ways(way_records, offsets, refs, found, *arrays):
+    """Drop ways that reference nodes that could not be located, e.g. nodes
+    missing from a clipped extract.
+
+    :param way_records: Attributes of every way.
+    :type way_records: list of dict
+    :param offsets: Offset of every way's first node into `refs`, plus the
+                    end.
+    :type offsets: numpy.ndarray
+    :param refs: OSM node ids of the nodes of every way, concatenated.
+    :type refs: numpy.ndarray
+    :param found: Whether every entry in `refs` was located.
+    :type found: numpy.ndarray
+    :param arrays: Other arrays with an entry for every entry in `refs`.
+    :type arrays: numpy.ndarray
+    :returns: way_records, offsets, refs and arrays of the complete ways.
+
+    """
+    if found.all():
+        return (way_records, offsets, refs, *arrays)
+
+    counts = np.diff(offsets)
+    keep = np.add.reduceat(~found, offsets[:-1]) == 0
+    way_records = [r for r, k in zip(way_records, keep.tolist()) if k]
+    ref_mask = np.repeat(keep, counts)
+    offsets = np.concatenate(([0], np.cumsum(counts[keep])))
+
+    return (
+        way_records,
+        offsets,
+        refs[ref_mask],
+        *(array[ref_mask] for array in arrays),
+    )
+
+
+def attach_node_candidates(G, node_candidates):
+    """Set node attributes of a graph from a dict of candidate node
+    attributes keyed by OSM node id. Candidates not in the graph are ignored.
+
+    :param G: The graph.
+    :type G: CompactGraph
+    :param node_candidates: Attribute dicts keyed by OSM node id.
+    :type node_candidates: dict
+
+    """
+    candidate_ids = list(node_candidates.keys())
+    indices = G.node_index(candidate_ids)
+    found = indices >= 0
+    records = [
+        node_candidates[n] for n, f in zip(candidate_ids, found.tolist()) if f
+    ]
+    G.node_attrs.set_records(indices[found], records)
+
+
+def _rebuilt_ways(G, ways, rebuilt, is_rebuilt):
+    """Node refs and attributes of the ways to rebuild: from the changed ways
+    if they changed, otherwise from the edges they are made of.
+
+    """
+    unchanged = {way_id: [] for way_id in rebuilt if way_id not in ways}
+    edges = np.flatnonzero(is_rebuilt)
+    osm_ids = G.edge_attrs["osm_id"].values
+    segments = G.edge_attrs["segment"].values
+    for i in edges[np.argsort(segments[edges], kind="stable")].tolist():
+        way_id = osm_ids[i].item()
+        if way_id in unchanged:
+            unchanged[way_id].append(i)
+
+    way_records = []
+    offsets = [0]
+    refs = []
+    for way_id in sorted(rebuilt):
+        if way_id in ways:
+            way = ways[way_id]
+            if way is None or way[1] is None or len(way[0]) < 2:
+                continue
+            way_refs = way[0]
+            attrs = {"osm_id": way_id, **way[1]}
+        else:
+            way_edges = unchanged[way_id]
+            way_refs = []
+            ref_offsets, ref_nodes = G.ndrefs
+            for i in way_edges:
+                edge_refs = ref_nodes[ref_offsets[i] : ref_offsets[i + 1]]
+                # Consecutive edges share their end and start nodes
+                start = 1 if way_refs else 0
+                way_refs.extend(G.node_ids[edge_refs[start:]].tolist())
+            attrs = G.edge_attrs.row(way_edges[0])
+            for name in DERIVED_EDGE_ATTRIBUTES:
+                attrs.pop(name, None)
+
+        way_records.append(attrs)
+        refs.extend(way_refs)
+        offsets.append(len(refs))
+
+    return (
+        way_records,
+        np.array(offsets, dtype=np.int64),
+        np.array(refs, dtype=np.int64),
+    )
+
+
+def _isin_sorted(sorted_values, values):
+    """Vectorized membership test of values in a sorted array."""
+    if not len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_values, values)
+    positions[positions == len(sorted_values)] = 0
+
+    return sorted_values[positions] == values
+
+
+def node_tag_filters(node_tags):
+    """Create osmium filters that only pass nodes with one of the given tags
+    on to Python. Ways and other objects are unaffected.
+
+    :param node_tags: (key, value) tag pairs.
+    :type node_tags: iterable of tuple
+    :returns: list of osmium filters. Empty if node_tags is None or filters
+              are unavailable.
+
+    """
+    if node_tags is None or not HAS_FILTERS:
+        return []
+    return [osmium.filter.TagFilter(*node_tags).enable_for(osmium.osm.NODE)]
+
+
+_id_filter_cache = (None, None)
+
+
+def _node_id_filters(ids_path):
+    """Create (or reuse) osmium filters that only pass nodes whose ids are in
+    the sorted array saved at ids_path. Filters are cached as a worker
+    process parses many byte ranges with the same ids.
+
+    """
+    global _id_filter_cache
+
+    if not HAS_FILTERS:
+        return []
+    path, id_filter = _id_filter_cache
+    if path != ids_path:
+        node_ids = np.load(ids_path, mmap_mode="r")
+        id_filter = osmium.filter.IdFilter(node_ids.tolist())
+        id_filter.enable_for(osmium.osm.NODE)
+        _id_filter_cache = (ids_path, id_filter)
+
+    return [id_filter]
+
+
+def _chunk_size(header, chunk):
+    return header[1] + chunk[1] - chunk[0]
+
+
+def _parse_way_chunk(pbf, header, chunk, way_filter, progressbar=None):
+    """Parse the ways in a byte range of a PBF file, without locations."""
+    parser = OSMWayParser(way_filter, locations=False)
+    parser.apply_buffer(read_chunk(pbf, header, chunk), "pbf")
+
+    if progressbar is not None:
+        progressbar.update(_chunk_size(header, chunk) // 2)
+
+    return (
+        parser.way_records,
+        np.frombuffer(parser.offsets, dtype=np.int64),
+        np.frombuffer(parser.refs, dtype=np.int64),
+        parser.ways_seen,
+    )
+
+
+def _parse_node_chunk(
+    pbf, header, chunk, ids_path, node_filter, progressbar=None
+):
+    """Parse the locations and candidate attributes of the nodes in a byte
+    range of a PBF file, keeping only nodes whose ids are in the sorted array
+    saved at ids_path.
+
+    """
+    parser = OSMNodeParser(node_filter)
+    filters = _node_id_filters(ids_path)
+    if filters:
+        parser.apply_buffer(
+            read_chunk(pbf, header, chunk), "pbf", filters=filters
+        )
+    else:
+        parser.apply_buffer(read_chunk(pbf, header, chunk), "pbf")
 
-        d = {"osm_id": int(n.id)}
+    node_ids = np.load(ids_path, mmap_mode="r")
+    ids = np.frombuffer(parser.ids, dtype=np.int64)
+    referenced = _isin_sorted(node_ids, ids)
 
-        tags = dict(n.tags)
+    candidate_ids = list(parser.node_candidates.keys())
+    candidate_referenced = _isin_sorted(
+        node_ids, np.array(candidate_ids, dtype=np.int64)
+    )
+    candidates = {
+        n: parser.node_candidates[n]
+        for n, r in zip(candidate_ids, candidate_referenced.tolist())
+        if r
+    }
 
-        d2 = {**d, **OSWNodeNormalizer(tags).normalize()}
+    if progressbar is not None:
+        size = _chunk_size(header, chunk)
+        progressbar.update(size - size // 2)
 
-        self.G.add_node(n.id, **d2)
+    return (
+        ids[referenced],
+        np.frombuffer(parser.xs, dtype=COORDINATE_DTYPE)[referenced],
+        np.frombuffer(parser.ys, dtype=COORDINATE_DTYPE)[referenced],
+        candidates,
+    )
 
 
 class OSMGraph:
     def __init__(self, G=None):
         if G is not None:
+            if not isinstance(G, CompactGraph):
+                G = CompactGraph.from_networkx(G)
             self.G = G
 
         # Geodesic distance calculator. Assumes WGS84-like geometries.
@@ -125,17 +457,152 @@ class OSMGraph:
 
     @classmethod
     def from_pbf(
-        self, pbf, way_filter=None, node_filter=None, progressbar=None
+        self,
+        pbf,
+        way_filter=None,
+        node_filter=None,
+        progressbar=None,
+        jobs=1,
+    ):
+        """Create an OSMGraph from an .osm.pbf file in a single read.
+
+        :param pbf: Path to the .osm.pbf file.
+        :type pbf: str
+        :param way_filter: (Optional) function that, given way tags, returns
+                           whether an OpenSidewalks way should be kept.
+        :type way_filter: callable
+        :param node_filter: (Optional) function that, given node tags,
+                            returns whether an OpenSidewalks node's
+                            attributes should be kept.
+        :type node_filter: callable
+        :param progressbar: An (optional) click.progressbar object of length
+                            os.path.getsize(pbf) that will be updated with the
+                            number of bytes read.
+        :type progressbar: click.progressbar
+        :param jobs: Number of worker processes. With more than one job, the
+                     file is split into byte ranges that are parsed in
+                     parallel (see from_pbf_parallel).
+        :type jobs: int
+
+        """
+        if jobs > 1:
+            return self.from_pbf_parallel(
+                pbf, way_filter, node_filter, progressbar, jobs
+            )
+
+        parser = OSMParser(way_filter, node_filter)
+        apply_file(
+            parser,
+            pbf,
+            locations=True,
+            progressbar=progressbar,
+            filters=node_tag_filters(OSWNodeNormalizer.filter_tags()),
+        )
+        G = parser.to_graph()
+        del parser
+
+        return OSMGraph(G)
+
+    @classmethod
+    def from_pbf_parallel(
+        self, pbf, way_filter=None, node_filter=None, progressbar=None, jobs=2
     ):
-        way_parser = OSMWayParser(way_filter, progressbar=progressbar)
-        way_parser.apply_file(pbf, locations=True)
-        G = way_parser.G
-        del way_parser
+        """Create an OSMGraph from an .osm.pbf file using worker processes.
+
+        The file's data blocks are split into byte ranges. Ways are parsed
+        from every range in parallel, then the locations and attributes of
+        the nodes they reference are parsed from every range in parallel.
+        The results are merged by OSM node id. Where pyosmium supports it,
+        unreferenced nodes are skipped before reaching Python. The filters
+        must be picklable, e.g. module-level functions.
+
+        :param pbf: Path to the .osm.pbf file.
+        :type pbf: str
+        :param way_filter: (Optional) function that, given way tags, returns
+                           whether an OpenSidewalks way should be kept.
+        :type way_filter: callable
+        :param node_filter: (Optional) function that, given node tags,
+                            returns whether an OpenSidewalks node's
+                            attributes should be kept.
+        :type node_filter: callable
+        :param progressbar: An (optional) click.progressbar object of length
+                            os.path.getsize(pbf) that will be updated with the
+                            number of bytes read.
+        :type progressbar: click.progressbar
+        :param jobs: Number of worker processes.
+        :type jobs: int
+
+        """
+        header, chunks = split_blobs(pbf, jobs * CHUNKS_PER_JOB)
+
+        way_chunks = run_jobs(
+            _parse_way_chunk,
+            [((pbf, header, chunk, way_filter), {}) for chunk in chunks],
+            jobs=jobs,
+            progressbar=progressbar,
+        )
+
+        way_records = []
+        offsets = [np.zeros(1, dtype=np.int64)]
+        refs = []
+        n_refs = 0
+        ways_seen = 0
+        for chunk_records, chunk_offsets, chunk_refs, seen in way_chunks:
+            way_records += chunk_records
+            ways_seen += seen
+            offsets.append(chunk_offsets[1:] + n_refs)
+            refs.append(chunk_refs)
+            n_refs += len(chunk_refs)
+        offsets = np.concatenate(offsets)
+        refs = np.concatenate(refs) if refs else np.zeros(0, dtype=np.int64)
+        del way_chunks
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Workers read the referenced node ids from a file rather than
+            # receiving a copy per byte range.
+            ids_path = str(Path(tmpdir, "node_ids.npy"))
+            np.save(ids_path, np.unique(refs))
+            node_chunks = run_jobs(
+                _parse_node_chunk,
+                [
+                    ((pbf, header, chunk, ids_path, node_filter), {})
+                    for chunk in chunks
+                ],
+                jobs=jobs,
+                progressbar=progressbar,
+            )
 
-        node_parser = OSMWayNodeParser(G, node_filter, progressbar=progressbar)
-        node_parser.apply_file(pbf)
-        G = node_parser.G
-        del node_parser
+        node_ids = [np.zeros(0, dtype=np.int64)]
+        xs = [np.zeros(0, dtype=COORDINATE_DTYPE)]
+        ys = [np.zeros(0, dtype=COORDINATE_DTYPE)]
+        node_candidates = {}
+        for chunk_ids, chunk_xs, chunk_ys, candidates in node_chunks:
+            node_ids.append(chunk_ids)
+            xs.append(chunk_xs)
+            ys.append(chunk_ys)
+            node_candidates.update(candidates)
+        node_ids = np.concatenate(node_ids)
+        order = np.argsort(node_ids, kind="stable")
+        node_ids = node_ids[order]
+        xs = np.concatenate(xs)[order]
+        ys = np.concatenate(ys)[order]
+        del node_chunks
+
+        way_records, offsets, refs = complete_ways(
+            way_records, offsets, refs, _isin_sorted(node_ids, refs)
+        )
+        add_count("ways_seen", ways_seen)
+        add_count("ways_kept", len(way_records))
+        positions = np.searchsorted(node_ids, refs)
+
+        G = CompactGraph.from_ways(
+            way_table(way_records),
+            offsets,
+            refs,
+            xs[positions],
+            ys[positions],
+        )
+        attach_node_candidates(G, node_candidates)
 
         return OSMGraph(G)
 
@@ -144,216 +611,398 @@ class OSMGraph:
         continuations.
 
         """
-        # Structure is way_id: (node, segment_number). This makes it easy to
-        # sort on-the-fly.
-        remove_nodes = {}
-
-        for node, d in self.G.nodes(data=True):
-            if OSWNodeNormalizer.osw_node_filter(d):
-                # Skip if this is an node feature of interest, e.g. kerb ramp
-                continue
-
-            predecessors = list(self.G.predecessors(node))
-            successors = list(self.G.successors(node))
-
-            if (len(predecessors) == 1) and (len(successors) == 1):
-                # Only one predecessor and one successor - ideal internal node
-                # to remove from graph, merging its location data into other
-                # edges.
-                node_in = predecessors[0]
-                node_out = successors[0]
-                edge_in = self.G[node_in][node][0]
-                edge_out = self.G[node][node_out][0]
-
-                # Only one exception: we shouldn't remove a node that's shared
-                # between two different ways: this is an important decision
-                # point for some paths.
-                if edge_in["osm_id"] != edge_out["osm_id"]:
-                    continue
+        G = self.G
+        if G.number_of_edges() == 0:
+            # No ways were kept, so there aren't any edge columns either.
+            return
 
-                node_data = (node_in, node, node_out, edge_in["segment"])
-
-                # Group by way
-                edge_id = edge_in["osm_id"]
-                if edge_id in remove_nodes:
-                    remove_nodes[edge_id].append(node_data)
-                else:
-                    remove_nodes[edge_id] = [node_data]
-
-        # NOTE: an otherwise unconnected circular path would be removed, as all
-        # nodes are degree 2 and on the same way. This path is pointless for a
-        # network, but is something to keep in mind for any downstream
-        # analysis.
-        for way_id, node_data in remove_nodes.items():
-            # Sort by segment number
-            sorted_node_data = list(sorted(node_data, key=lambda x: x[3]))
-
-            # Split into lists of neighboring nodes
-            neighbors_list = []
-
-            neighbors = [sorted_node_data.pop(0)]
-            for node_in, node, node_out, segment_n in sorted_node_data:
-                if (segment_n - neighbors[-1][3]) != 1:
-                    # Not neighbors!
-                    neighbors_list.append(neighbors)
-                    neighbors = [(node_in, node, node_out, segment_n)]
-                else:
-                    # Neighbors!
-                    neighbors.append((node_in, node, node_out, segment_n))
-            neighbors_list.append(neighbors)
-
-            # Remove internal nodes by group
-            for neighbors in neighbors_list:
-                u, v, w, segment_n = neighbors[0]
-                # FIXME: this try/except is a hack to avert an uncommon and
-                # unexplored edge case. Come back and fix!
-                try:
-                    edge_data = self.G[u][v][0]
-                except KeyError:
-                    continue
-                ndref = edge_data["ndref"]
-                self.G.remove_edge(u, v)
-                for node_in, node, node_out, segment_n in neighbors:
-                    ndref.append(node_out)
-                    # Remove intervening edge
-                    try:
-                        self.G.remove_edge(node, node_out)
-                    except nx.exception.NetworkXError:
-                        pass
-                self.G.add_edges_from([(u, node_out, edge_data)])
-
-    def construct_geometries(self, progressbar=None):
+        # Ideal internal nodes to remove from the graph have only one incoming
+        # and one outgoing edge, with their location data merged into the
+        # joined edge.
+        candidates = (G.in_degree() == 1) & (G.out_degree() == 1)
+        # Skip node features of interest, e.g. kerb ramps
+        candidates &= ~G.node_attrs.isin("kerb", OSWNodeNormalizer.KERB_VALUES)
+        nodes = np.flatnonzero(candidates)
+
+        in_edge = np.empty(G.number_of_nodes(), dtype=np.int64)
+        in_edge[G.dst] = np.arange(G.number_of_edges())
+        edge_in = in_edge[nodes]
+        edge_out = G.indptr[nodes]
+
+        # Only one exception: we shouldn't remove a node that's shared between
+        # two different ways: this is an important decision point for some
+        # paths.
+        osm_ids = G.edge_attrs["osm_id"].values
+        keep = (osm_ids[edge_in] == osm_ids[edge_out]) & (edge_in != edge_out)
+
+        # NOTE: an otherwise unconnected circular path is kept as a single
+        # edge that starts and ends at the same node.
+        self.G = G.contract_nodes(nodes[keep])
+
+    def construct_geometries(self, progressbar=None, edges=None):
         """Given the current list of node references per edge, construct
         geometry.
 
+        Coordinates of every edge are gathered into one flat (ragged) array
+        and lengths are calculated in batches. Shapely geometries are only
+        created on demand, e.g. by OSMGraph.G.edge_geometry. Node references
+        are kept so that the graph can be updated with OSM changes later.
+
+        :param progressbar: An (optional) click.progressbar object that will
+                            be updated as edge lengths are calculated.
+        :type progressbar: click.progressbar
+        :param edges: (Optional) indices of the edges whose lengths should be
+                      calculated. By default, all edges.
+        :type edges: numpy.ndarray
+
         """
-        for u, v, d in self.G.edges(data=True):
-            coords = []
-            for ref in d["ndref"]:
-                # FIXME: is this the best way to retrieve node attributes?
-                node_d = self.G._node[ref]
-                coords.append((node_d["lon"], node_d["lat"]))
-
-            geometry = LineString(coords)
-            d["geometry"] = geometry
-            d["length"] = round(self.geod.geometry_length(geometry), 1)
-            del d["ndref"]
-            if progressbar:
-                progressbar.update(1)
+        offsets, ndrefs = self.G.ndrefs
+        coords = np.column_stack((self.G.x[ndrefs], self.G.y[ndrefs]))
 
-        for n, d in self.G.nodes(data=True):
-            coords = []
-            geometry = Point(d["lon"], d["lat"])
-            d["geometry"] = geometry
+        if edges is None:
+            edges = np.arange(self.G.number_of_edges())
+            edge_offsets, edge_coords = offsets, coords
+        else:
+            edge_offsets, edge_coords = take_ragged(offsets, coords, edges)
+
+        n_edges = len(edges)
+        lengths = np.zeros(n_edges)
+        for start in range(0, n_edges, GEOMETRY_BATCH_SIZE):
+            end = min(start + GEOMETRY_BATCH_SIZE, n_edges)
+            batch_offsets = edge_offsets[start : end + 1]
+            batch_coords = to_degrees(
+                edge_coords[batch_offsets[0] : batch_offsets[-1]]
+            )
+            lengths[start:end] = geodesic_lengths(
+                self.geod, batch_offsets - batch_offsets[0], batch_coords
+            )
             if progressbar:
-                progressbar.update(1)
+                progressbar.update(end - start)
+
+        self.G.edge_attrs.set("length", edges, lengths.round(1))
+        self.G.coords = (offsets, coords)
 
         # FIXME: remove orphaned nodes!
 
-    def to_undirected(self):
-        if self.G.is_multigraph():
-            G = nx.MultiGraph(self.G)
+    def apply_changes(self, ways, nodes, simplify=True):
+        """Update the graph with changed OSM ways and nodes, e.g. from an OSM
+        change file (see osm_change.read_changes).
+
+        Only the affected ways are rebuilt: changed ways, ways with a changed
+        node and ways that share a node with one of these, so that
+        simplification is the same as for a graph built from scratch. Their
+        edges are created, simplified and given geometries and lengths again.
+        Other edges, including attributes added by later stages, are kept.
+
+        :param ways: Changed ways as (refs, attrs) tuples of node ids and
+                     normalized attributes (None if not an OpenSidewalks
+                     way), keyed by way id. Deleted ways are None.
+        :type ways: dict
+        :param nodes: Changed nodes as (x, y, attrs) tuples of fixed-point
+                      coordinates and normalized attributes (or None), keyed
+                      by node id. Deleted nodes are None. Must also include
+                      any other nodes of changed ways that aren't in the
+                      graph.
+        :type nodes: dict
+        :param simplify: Whether to join simple (degree-2) connection nodes
+                         of rebuilt ways, as OSMGraph.simplify does.
+        :type simplify: bool
+
+        """
+        G = self.G
+        n_edges = G.number_of_edges()
+        if "osm_id" in G.edge_attrs:
+            osm_ids = G.edge_attrs["osm_id"].values
         else:
-            G = nx.Graph(self.G)
-        return OSMGraph(G)
+            osm_ids = np.zeros(n_edges, dtype=np.int64)
+        ref_offsets, ref_nodes = G.ndrefs
+        ref_edges = np.repeat(np.arange(n_edges), np.diff(ref_offsets))
+
+        # Graph nodes that moved, changed attributes or were deleted
+        node_ids = np.fromiter(nodes.keys(), dtype=np.int64, count=len(nodes))
+        indices = G.node_index(node_ids)
+        changed = np.zeros(G.number_of_nodes(), dtype=bool)
+        for n, i in zip(node_ids.tolist(), indices.tolist()):
+            if i < 0:
+                continue
+            node = nodes[n]
+            changed[i] = (
+                node is None
+                or node[0] != G.x[i]
+                or node[1] != G.y[i]
+                or (node[2] or {}) != G.node_attrs.row(i)
+            )
+
+        affected = set(ways)
+        affected.update(osm_ids[ref_edges[changed[ref_nodes]]].tolist())
+
+        # Ways sharing a node with an affected way, before or after the
+        # change, are rebuilt too.
+        touched = np.zeros(G.number_of_nodes(), dtype=bool)
+        affected_refs = np.isin(osm_ids[ref_edges], list(affected))
+        touched[ref_nodes[affected_refs]] = True
+        new_refs = [
+            ref
+            for way in ways.values()
+            if way is not None and way[1] is not None
+            for ref in way[0]
+        ]
+        new_indices = G.node_index(new_refs)
+        touched[new_indices[new_indices >= 0]] = True
+        rebuilt = affected | set(
+            osm_ids[ref_edges[touched[ref_nodes]]].tolist()
+        )
+
+        is_rebuilt = np.isin(osm_ids, list(rebuilt))
+        way_records, offsets, refs = _rebuilt_ways(
+            G, ways, rebuilt, is_rebuilt
+        )
+
+        # Locate the nodes of rebuilt ways, dropping ways with missing nodes
+        xs = np.zeros(len(refs), dtype=COORDINATE_DTYPE)
+        ys = np.zeros(len(refs), dtype=COORDINATE_DTYPE)
+        found = np.zeros(len(refs), dtype=bool)
+        node_candidates = {}
+        ref_indices = G.node_index(refs)
+        for j, (n, i) in enumerate(zip(refs.tolist(), ref_indices.tolist())):
+            if n in nodes:
+                node = nodes[n]
+                if node is None:
+                    continue
+                xs[j], ys[j] = node[0], node[1]
+                if node[2] is not None:
+                    node_candidates[n] = node[2]
+            elif i >= 0:
+                xs[j], ys[j] = G.x[i], G.y[i]
+                attrs = G.node_attrs.row(i)
+                if attrs:
+                    node_candidates[n] = attrs
+            else:
+                continue
+            found[j] = True
+        way_records, offsets, refs, xs, ys = complete_ways(
+            way_records, offsets, refs, found, xs, ys
+        )
+        add_count("ways_changed", len(ways))
+        add_count("nodes_changed", int(changed.sum()))
+        add_count("ways_rebuilt", len(way_records))
+
+        H = CompactGraph.from_ways(
+            way_table(way_records), offsets, refs, xs, ys
+        )
+        attach_node_candidates(H, node_candidates)
+
+        kept = G.edge_subgraph(~is_rebuilt)
+        kept.coords = None
+        self.G = CompactGraph.concat([kept, H])
+        if simplify:
+            self.simplify()
+
+        rebuilt_edges = np.isin(
+            self.G.edge_attrs["osm_id"].values, list(rebuilt)
+        )
+        self.construct_geometries(edges=np.flatnonzero(rebuilt_edges))
+
+    def to_undirected(self):
+        """Convert to an undirected networkx MultiGraph."""
+        return nx.MultiGraph(self.to_networkx())
 
     def get_graph(self):
-        return self.G
+        return self.to_networkx()
+
+    def to_networkx(self):
+        """Convert to a networkx MultiDiGraph, e.g. for export to unweaver."""
+        G = self.G.to_networkx()
+        for _, _, d in G.edges(data=True):
+            _output_incline(d)
+        return G
 
     def filter_edges(self, func):
-        # TODO: put this in a "copy-like" function
-        if self.G.is_multigraph():
-            if self.G.is_directed():
-                G = nx.MultiDiGraph()
-            else:
-                G = nx.MultiGraph()
-        else:
-            if self.G.is_directed():
-                G = nx.DiGraph()
-            else:
-                G = nx.Graph()
+        """Create a new OSMGraph of the edges for which func(u, v, d) is
+        True, where d is a dict of the edge's attributes.
 
-        for u, v, d in self.G.edges(data=True):
-            if func(u, v, d):
-                G.add_edge(u, v, **d)
+        """
 
-        # Copy in node data
-        for node in G.nodes:
-            d = self.G._node[node]
-            G.add_node(node, **d)
+        def attrs(d):
+            _output_incline(d)
+            return d
 
-        return OSMGraph(G)
+        mask = np.array(
+            [
+                func(u, v, attrs(d))
+                for u, v, d in self.G.edges(data=True, geometry=True)
+            ],
+            dtype=bool,
+        )
+        return OSMGraph(self.G.edge_subgraph(mask))
 
     def is_multigraph(self):
-        return self.G.is_multigraph()
+        return True
 
     def is_directed(self):
-        return self.G.is_directed()
+        return True
 
-    def to_geojson(self, nodes_path, edges_path):
-        edge_features = []
-        for u, v, d in self.G.edges(data=True):
-            d_copy = {**d}
-            d_copy["_u_id"] = str(u)
-            d_copy["_v_id"] = str(v)
+    def save(self, path):
+        """Save the graph to a binary file of typed columns, e.g. to pass it
+        between processing stages. See CompactGraph.save.
 
-            if "osm_id" in d_copy:
-                d_copy.pop("osm_id")
-            if "segment" in d_copy:
-                d_copy.pop("segment")
+        :param path: Path to the output (.npz) file.
+        :type path: str
 
-            geometry = mapping(d_copy.pop("geometry"))
+        """
+        self.G.save(path)
 
-            edge_features.append(
-                {"type": "Feature", "geometry": geometry, "properties": d_copy}
-            )
-        edges_fc = {"type": "FeatureCollection", "features": edge_features}
+    @classmethod
+    def load(cls, path):
+        """Load a graph saved with OSMGraph.save.
 
-        node_features = []
-        for n, d in self.G.nodes(data=True):
-            d_copy = {**d}
-            d_copy["_id"] = str(n)
+        :param path: Path to the (.npz) file.
+        :type path: str
 
-            if "osm_id" in d_copy:
-                d_copy.pop("osm_id")
+        """
+        return cls(G=CompactGraph.load(path))
 
-            geometry = mapping(d_copy.pop("geometry"))
+    def edge_features(self, precision=None):
+        """Iterate over the edges as GeoJSON Feature dicts.
 
-            node_features.append(
-                {"type": "Feature", "geometry": geometry, "properties": d_copy}
-            )
-        nodes_fc = {"type": "FeatureCollection", "features": node_features}
+        :param precision: Number of decimal places coordinates are rounded
+                          to. By default, they are not rounded.
+        :type precision: int
 
-        with open(edges_path, "w") as f:
-            json.dump(edges_fc, f)
+        """
+        G = self.G
+        coords = None
+        if G.coords is not None:
+            offsets, coords = G.coords
+            offsets = offsets.tolist()
+            coords = _round(to_degrees(coords), precision)
+
+        us = G.node_ids[G.src].tolist()
+        vs = G.node_ids[G.dst].tolist()
+        rows = G.edge_attrs.iter_rows(exclude=("osm_id", "segment", "ndref"))
+        for i, (u, v, d) in enumerate(zip(us, vs, rows)):
+            _output_incline(d)
+            d["_u_id"] = str(u)
+            d["_v_id"] = str(v)
+
+            geometry = None
+            if coords is not None:
+                geometry = {
+                    "type": "LineString",
+                    "coordinates": coords[
+                        offsets[i] : offsets[i + 1]
+                    ].tolist(),
+                }
+
+            yield {
+                "type": "Feature",
+                "geometry": geometry,
+                "properties": d,
+            }
+
+    def node_features(self, precision=None):
+        """Iterate over the nodes as GeoJSON Feature dicts.
+
+        :param precision: Number of decimal places coordinates are rounded
+                          to. By default, they are not rounded.
+        :type precision: int
 
-        with open(nodes_path, "w") as f:
-            json.dump(nodes_fc, f)
+        """
+        G = self.G
+        lons = _round(G.lon, precision).tolist()
+        lats = _round(G.lat, precision).tolist()
+        rows = G.node_attrs.iter_rows(exclude=("osm_id",))
+        for n, lon, lat, attrs in zip(G.node_ids.tolist(), lons, lats, rows):
+            d = {"lon": lon, "lat": lat, **attrs}
+            d["_id"] = str(n)
+
+            yield {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": d,
+            }
+
+    def to_geojson(
+        self, nodes_path, edges_path, precision=None, compression=None
+    ):
+        """Write the nodes and edges to GeoJSON FeatureCollection files,
+        one feature at a time.
+
+        :param nodes_path: Path to the nodes output file.
+        :type nodes_path: str
+        :param edges_path: Path to the edges output file.
+        :type edges_path: str
+        :param precision: Number of decimal places coordinates are rounded
+                          to. By default, they are not rounded.
+        :type precision: int
+        :param compression: "gzip", "zstd" or "none". By default, it is
+                            chosen from the file suffix (.gz or .zst).
+        :type compression: str
 
-    @classmethod
-    def from_geojson(cls, nodes_path, edges_path):
-        with open(nodes_path) as f:
-            nodes_fc = json.load(f)
+        """
+        with FeatureCollectionWriter(edges_path, compression) as writer:
+            writer.write_all(self.edge_features(precision))
 
-        with open(edges_path) as f:
-            edges_fc = json.load(f)
+        with FeatureCollectionWriter(nodes_path, compression) as writer:
+            writer.write_all(self.node_features(precision))
 
-        G = nx.MultiDiGraph()
-        osm_graph = cls(G=G)
+    @classmethod
+    def from_geojson(cls, nodes_path, edges_path, compression=None):
+        """Read a graph written with OSMGraph.to_geojson. Features are read
+        one at a time.
+
+        :param nodes_path: Path to the nodes file.
+        :type nodes_path: str
+        :param edges_path: Path to the edges file.
+        :type edges_path: str
+        :param compression: "gzip", "zstd" or "none". By default, it is
+                            chosen from the file suffix (.gz or .zst).
+        :type compression: str
 
-        for node_feature in nodes_fc["features"]:
+        """
+        node_ids = []
+        lon = []
+        lat = []
+        node_records = []
+        for node_feature in iter_features(nodes_path, compression):
             props = node_feature["properties"]
-            n = props.pop("_id")
-            props["geometry"] = shape(node_feature["geometry"])
-            G.add_node(n, **props)
-
-        for edge_feature in edges_fc["features"]:
+            node_ids.append(int(props.pop("_id")))
+            node_lon, node_lat = node_feature["geometry"]["coordinates"][:2]
+            props.pop("lon", None)
+            props.pop("lat", None)
+            lon.append(node_lon)
+            lat.append(node_lat)
+            node_records.append(props)
+
+        index = {n: i for i, n in enumerate(node_ids)}
+
+        src = []
+        dst = []
+        edge_records = []
+        coord_offsets = array("q", [0])
+        coords = array("d")
+        for edge_feature in iter_features(edges_path, compression):
             props = edge_feature["properties"]
-            u = props.pop("_u_id")
-            v = props.pop("_v_id")
-
-            props["geometry"] = shape(edge_feature["geometry"])
-
-            G.add_edge(u, v, **props)
-
-        return osm_graph
+            src.append(index[int(props.pop("_u_id"))])
+            dst.append(index[int(props.pop("_v_id"))])
+            edge_records.append(props)
+
+            for coord in edge_feature["geometry"]["coordinates"]:
+                coords.extend(coord[:2])
+            coord_offsets.append(len(coords) // 2)
+
+        G = CompactGraph(
+            node_ids,
+            to_fixed(lon),
+            to_fixed(lat),
+            src,
+            dst,
+            node_attrs=AttributeTable.from_records(node_records),
+            edge_attrs=AttributeTable.from_records(edge_records),
+            coords=(
+                np.array(coord_offsets, dtype=np.int64),
+                to_fixed(np.array(coords).reshape(-1, 2)),
+            ),
+        )
+
+        return cls(G=G)
@@ -0,0 +1,221 @@
+"""Helpers for reading .osm.pbf files with osmium handlers."""
+import os
+import struct
+from pathlib import Path
+import threading
+
+# Seconds between checks of how far osmium has read into a file.
+POLL_INTERVAL = 0.25
+
+
+def _read_offset(path):
+    """Find the offset of this process's open file descriptor for a path.
+
+    Relies on Linux's /proc filesystem. Returns None if the file is not open
+    or the offset cannot be determined.
+
+    """
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+
+    offset = None
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}") != path:
+                continue
+            with open(f"/proc/self/fdinfo/{fd}") as f:
+                for line in f:
+                    if line.startswith("pos:"):
+                        pos = int(line.split()[1])
+                        offset = pos if offset is None else max(offset, pos)
+                        break
+        except (OSError, ValueError):
+            continue
+
+    return offset
+
+
+class _ReadProgress(threading.Thread):
+    def __init__(self, path, progressbar):
+        super().__init__(daemon=True)
+        self.path = str(Path(path).resolve())
+        self.progressbar = progressbar
+        self.reported = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(POLL_INTERVAL):
+            offset = _read_offset(self.path)
+            if offset is not None and offset > self.reported:
+                self.progressbar.update(offset - self.reported)
+                self.reported = offset
+
+    def finish(self):
+        self.done.set()
+        self.join()
+        size = os.path.getsize(self.path)
+        if size > self.reported:
+            self.progressbar.update(size - self.reported)
+            self.reported = size
+
+
+def apply_file(handler, path, locations=False, progressbar=None, filters=None):
+    """Apply an osmium handler to an OSM file in a single read, optionally
+    reporting progress as the number of bytes consumed by the reader.
+
+    Progress is measured by watching the reader's offset into the file, so
+    no extra counting passes are needed. Where the offset can't be observed
+    (non-Linux systems), progress is reported once the file has been read.
+
+    :param handler: An osmium handler, e.g. an osmium.SimpleHandler subclass.
+    :type handler: osmium.SimpleHandler
+    :param path: Path to the OSM file.
+    :type path: str
+    :param locations: Whether osmium should attach node locations to ways.
+    :type locations: bool
+    :param progressbar: An (optional) click.progressbar object of length
+                        os.path.getsize(path) that will be updated with the
+                        number of bytes read.
+    :type progressbar: click.progressbar
+    :param filters: (Optional) osmium filters that objects must pass before
+                    reaching the handler. Requires pyosmium >= 4.
+    :type filters: list
+
+    """
+    kwargs = {"locations": locations}
+    if filters:
+        kwargs["filters"] = filters
+
+    if progressbar is None:
+        handler.apply_file(str(path), **kwargs)
+        return
+
+    watcher = _ReadProgress(path, progressbar)
+    watcher.start()
+    try:
+        handler.apply_file(str(path), **kwargs)
+    finally:
+        watcher.finish()
+
+
+def _read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _parse_blob_header(buf):
+    """Read the type and data size fields of a PBF BlobHeader message."""
+    blob_type = None
+    datasize = None
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+            if field == 3:
+                datasize = value
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            if field == 1:
+                blob_type = buf[pos : pos + length].decode()
+            pos += length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type} in PBF file")
+
+    if blob_type is None or datasize is None:
+        raise ValueError("Invalid BlobHeader in PBF file")
+
+    return blob_type, datasize
+
+
+def blob_index(path):
+    """List the blobs (file blocks) of an .osm.pbf file without decoding
+    them.
+
+    :param path: Path to the .osm.pbf file.
+    :type path: str
+    :returns: List of (blob type, offset, size) tuples, where size includes
+              the blob's header.
+
+    """
+    blobs = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            (header_size,) = struct.unpack(">I", f.read(4))
+            blob_type, datasize = _parse_blob_header(f.read(header_size))
+            blob_size = 4 + header_size + datasize
+            blobs.append((blob_type, offset, blob_size))
+            offset += blob_size
+
+    return blobs
+
+
+def split_blobs(path, n_chunks):
+    """Split the data blobs of an .osm.pbf file into contiguous byte ranges
+    of similar size. Each range can be read on its own by prepending the
+    file's header blob to it (see read_chunk).
+
+    :param path: Path to the .osm.pbf file.
+    :type path: str
+    :param n_chunks: Maximum number of ranges.
+    :type n_chunks: int
+    :returns: ((offset, size) of the header blob, list of (start, end) byte
+              ranges) tuple.
+
+    """
+    blobs = blob_index(path)
+    headers = [(o, s) for t, o, s in blobs if t == "OSMHeader"]
+    if not headers:
+        raise ValueError(f"{path} has no OSMHeader block")
+    data = [(o, s) for t, o, s in blobs if t == "OSMData"]
+    if not data:
+        return headers[0], []
+
+    data_size = sum(s for o, s in data)
+    target = data_size / n_chunks
+
+    chunks = []
+    start, end = data[0][0], data[0][0]
+    for offset, blob_size in data:
+        if end - start >= target:
+            chunks.append((start, end))
+            start = offset
+        end = offset + blob_size
+    chunks.append((start, end))
+
+    return headers[0], chunks
+
+
+def read_chunk(path, header, chunk):
+    """Read a byte range of data blobs from an .osm.pbf file as a standalone
+    PBF buffer, suitable for osmium.SimpleHandler.apply_buffer.
+
+    :param path: Path to the .osm.pbf file.
+    :type path: str
+    :param header: (offset, size) of the file's header blob.
+    :type header: tuple of int
+    :param chunk: (start, end) byte range of data blobs.
+    :type chunk: tuple of int
+    :returns: bytes
+
+    """
+    with open(path, "rb") as f:
+        f.seek(header[0])
+        buf = f.read(header[1])
+        f.seek(chunk[0])
+        buf += f.read(chunk[1] - chunk[0])
+
+    return buf
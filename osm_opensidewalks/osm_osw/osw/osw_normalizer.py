@@ -1,3 +1,9 @@
+import functools
+
+# Maximum number of distinct tag combinations whose results are cached.
+CACHE_SIZE = 65536
+
+
 class OSWWayNormalizer:
     ROAD_HIGHWAY_VALUES = (
         "primary",
@@ -7,9 +13,41 @@ class OSWWayNormalizer:
         "service",
     )
 
+    # Tags read when filtering and normalizing ways. Ways with the same
+    # values for these tags are normalized identically.
+    KEYS = ("highway", "footway", "crossing", "width", "incline")
+
+    # Way types in order of precedence, with the tag values each requires.
+    # Attributes are created by the type's _normalize_<type> method.
+    TYPES = (
+        ("sidewalk", (("highway", ("footway",)), ("footway", ("sidewalk",)))),
+        ("crossing", (("highway", ("footway",)), ("footway", ("crossing",)))),
+        ("footway", (("highway", ("footway",)),)),
+        ("road", (("highway", ROAD_HIGHWAY_VALUES),)),
+    )
+
     def __init__(self, tags):
         self.tags = tags
 
+    @classmethod
+    def classify(cls, tags):
+        """Filter and normalize way tags in one step. Results are cached on
+        the values of OSWWayNormalizer.KEYS, so the returned dict is shared
+        and must not be modified.
+
+        :param tags: Way tags, e.g. a dict or an osmium TagList.
+        :type tags: dict-like
+        :returns: dict of normalized attributes, or None if the way is not
+                  an OpenSidewalks way.
+
+        """
+        first = tags.get(cls.KEYS[0])
+        accepted = _first_key_values(cls)
+        if accepted is not None and first not in accepted:
+            return None
+        values = (first,) + tuple(tags.get(key) for key in cls.KEYS[1:])
+        return _classify(cls, values)
+
     def filter(self):
         return (
             self.is_sidewalk()
@@ -103,9 +141,49 @@ class OSWWayNormalizer:
 class OSWNodeNormalizer:
     KERB_VALUES = ("flush", "lowered", "rolled", "raised")
 
+    # Tags read when filtering and normalizing nodes.
+    KEYS = ("kerb", "tactile_surface")
+
+    # Node types in order of precedence, with the tag values each requires.
+    TYPES = (("kerb", (("kerb", KERB_VALUES),)),)
+
     def __init__(self, tags):
         self.tags = tags
 
+    @classmethod
+    def classify(cls, tags):
+        """Filter and normalize node tags in one step. Results are cached on
+        the values of OSWNodeNormalizer.KEYS, so the returned dict is shared
+        and must not be modified.
+
+        :param tags: Node tags, e.g. a dict or an osmium TagList.
+        :type tags: dict-like
+        :returns: dict of normalized attributes, or None if the node is not
+                  an OpenSidewalks node.
+
+        """
+        first = tags.get(cls.KEYS[0])
+        accepted = _first_key_values(cls)
+        if accepted is not None and first not in accepted:
+            return None
+        values = (first,) + tuple(tags.get(key) for key in cls.KEYS[1:])
+        return _classify(cls, values)
+
+    @classmethod
+    def filter_tags(cls):
+        """List (key, value) tag pairs, one of which every OpenSidewalks node
+        has. Useful for skipping other nodes early.
+
+        :returns: list of tuple
+
+        """
+        return [
+            (key, value)
+            for name, required in cls.TYPES
+            for key, allowed in required[:1]
+            for value in allowed
+        ]
+
     def filter(self):
         return self.is_kerb()
 
@@ -133,3 +211,35 @@ class OSWNodeNormalizer:
 
     def is_kerb(self):
         return self.tags.get("kerb", "") in self.KERB_VALUES
+
+
+@functools.lru_cache(maxsize=None)
+def _first_key_values(normalizer_class):
+    """Compile the values of the first of KEYS that any type accepts, so that
+    most objects can be rejected after reading a single tag. Returns None if
+    a type accepts any value.
+
+    """
+    key = normalizer_class.KEYS[0]
+    values = set()
+    for name, required in normalizer_class.TYPES:
+        allowed = dict(required).get(key)
+        if allowed is None:
+            return None
+        values.update(allowed)
+
+    return frozenset(values)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _classify(normalizer_class, values):
+    tags = {
+        key: value
+        for key, value in zip(normalizer_class.KEYS, values)
+        if value is not None
+    }
+    for name, required in normalizer_class.TYPES:
+        if all(tags.get(key) in allowed for key, allowed in required):
+            return getattr(normalizer_class(tags), f"_normalize_{name}")()
+
+    return None
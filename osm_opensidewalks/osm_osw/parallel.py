@@ -0,0 +1,125 @@
+"""Run per-region work in a pool of worker processes."""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import threading
+import time
+
+# Seconds between progress messages sent from each worker to the parent.
+PROGRESS_INTERVAL = 0.2
+
+_progress_queue = None
+
+
+class ProgressProxy:
+    """Stand-in for a click.progressbar in a worker process. Updates are
+    batched and forwarded to the parent process through a queue.
+
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.pending = 0
+        self.last_sent = time.monotonic()
+
+    def update(self, n_steps):
+        self.pending += n_steps
+        if time.monotonic() - self.last_sent > PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.queue.put(self.pending)
+            self.pending = 0
+        self.last_sent = time.monotonic()
+
+
+def _init_worker(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def _run_in_worker(func, args, kwargs):
+    progressbar = ProgressProxy(_progress_queue)
+    try:
+        return func(*args, progressbar=progressbar, **kwargs)
+    finally:
+        progressbar.flush()
+
+
+def _forward_progress(queue, progressbar):
+    while True:
+        n_steps = queue.get()
+        if n_steps is None:
+            break
+        progressbar.update(n_steps)
+
+
+def run_jobs(func, tasks, jobs=1, progressbar=None, task_progress=False):
+    """Call a function for every task, optionally in worker processes.
+
+    :param func: Module-level function to call as func(*args, **kwargs). It
+                 must accept a `progressbar` keyword argument unless
+                 `task_progress` is True.
+    :type func: callable
+    :param tasks: (args, kwargs) tuples, one per call.
+    :type tasks: list of tuple
+    :param jobs: Number of worker processes. With 1 job, tasks are run in
+                 this process, one after another.
+    :type jobs: int
+    :param progressbar: An (optional) click.progressbar object. Progress
+                        reported by workers is forwarded to it.
+    :type progressbar: click.progressbar
+    :param task_progress: Update the progressbar by 1 for every completed
+                          task instead of passing it to `func`.
+    :type task_progress: bool
+    :returns: List of return values, in the order of `tasks`.
+
+    """
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for i, (args, kwargs) in enumerate(tasks):
+            if task_progress:
+                results[i] = func(*args, **kwargs)
+                if progressbar is not None:
+                    progressbar.update(1)
+            else:
+                results[i] = func(*args, progressbar=progressbar, **kwargs)
+        return results
+
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue()
+        forwarder = None
+        if progressbar is not None and not task_progress:
+            forwarder = threading.Thread(
+                target=_forward_progress, args=(queue, progressbar)
+            )
+            forwarder.start()
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(jobs, len(tasks)),
+                initializer=_init_worker,
+                initargs=(queue,),
+            ) as executor:
+                futures = {}
+                for i, (args, kwargs) in enumerate(tasks):
+                    if task_progress:
+                        future = executor.submit(func, *args, **kwargs)
+                    else:
+                        future = executor.submit(
+                            _run_in_worker, func, args, kwargs
+                        )
+                    futures[future] = i
+
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+                    if task_progress and progressbar is not None:
+                        progressbar.update(1)
+        finally:
+            if forwarder is not None:
+                queue.put(None)
+                forwarder.join()
+
+    return results
@@ -0,0 +1,414 @@
+"""The stages of the pipeline as a dependency graph of per-region and
+per-tileset tasks, and the manifest keys of every stage.
+
+Each region moves through clip -> network -> infer_curbramps -> incline as
+soon as its own inputs are ready. DEM tilesets are fetched and masked
+alongside, and every tileset is masked once the regions that overlap it have
+been clipped, so masking never waits on graph building. Regions are merged
+once every incline has been estimated.
+
+"""
+import os
+from pathlib import Path
+
+from shapely.geometry import shape
+
+from .constants import BUFFER_DIST
+from .dems.transforms import fetch_ned_tile, list_ned13s, ned13s_for_bounds
+from .scheduler import Task
+from .stages import (
+    build_network,
+    clip_region,
+    extract_masked_geometries,
+    graph_path,
+    infer_region_curbramps,
+    infer_region_inclines,
+    mask_tileset,
+    merge_regions,
+    tileset_polygons,
+)
+
+# Rough estimates of peak memory use, as multiples of the size of a task's
+# input file: a region's .osm.pbf for network and extraction, its graph for
+# the later stages and the tileset for masking.
+PBF_MEMORY_FACTOR = 150
+GRAPH_MEMORY_FACTOR = 2
+DEM_MEMORY_FACTOR = 2
+
+# osmosis runs with a 256 MB heap (see osm_clip).
+CLIP_MEMORY = 512 * 2**20
+
+
+def pbf_path(workdir, region_id):
+    return Path(workdir, f"{region_id}.osm.pbf")
+
+
+def dem_path(workdir, tileset):
+    return Path(workdir, "dems", f"{tileset}.tif")
+
+
+def region_tilesets(config):
+    """Names of the DEM tilesets that overlap each region.
+
+    :param config: Region config.
+    :type config: dict
+    :returns: dict of lists of tileset names, keyed by region ID.
+
+    """
+    return {
+        region["properties"]["id"]: ned13s_for_bounds(
+            shape(region["geometry"]).bounds
+        )
+        for region in config["features"]
+    }
+
+
+def clip_key(manifest, workdir, region):
+    extract_path = Path(
+        workdir, Path(region["properties"]["extract_url"]).name
+    )
+    return manifest.key("clip", manifest.digest(extract_path), region)
+
+
+def network_key(manifest, workdir, region_id, simplify):
+    return manifest.key(
+        "network", manifest.digest(pbf_path(workdir, region_id)), simplify
+    )
+
+
+def curbramps_key(manifest):
+    return manifest.key("infer_curbramps")
+
+
+def mask_key(
+    manifest, workdir, region_ids, all_touched=False, network_keys=None
+):
+    """Key of a tileset's mask, which depends on the regions that overlap
+    it. When only the pixels around network nodes are masked, it also
+    depends on the keys of the regions' networks (network_keys).
+
+    """
+    return manifest.key(
+        "mask",
+        BUFFER_DIST,
+        all_touched,
+        network_keys,
+        [
+            (region_id, manifest.digest(pbf_path(workdir, region_id)))
+            for region_id in region_ids
+        ],
+    )
+
+
+def incline_key(manifest, workdir, tilesets):
+    """Key of a region's inclines, which depend on the (masked) tilesets
+    that overlap it.
+
+    """
+    return manifest.key(
+        "incline",
+        [
+            (tileset, manifest.digest(dem_path(workdir, tileset)))
+            for tileset in tilesets
+        ],
+    )
+
+
+def merge_key(manifest, workdir, region_ids):
+    return manifest.key(
+        "merge",
+        [
+            (region_id, manifest.digest(graph_path(workdir, region_id)))
+            for region_id in region_ids
+        ],
+    )
+
+
+def _memory(path, factor):
+    return lambda: factor * os.path.getsize(path)
+
+
+def runall_tasks(
+    config,
+    workdir,
+    manifest,
+    simplify=True,
+    all_touched=False,
+    roi=False,
+    jobs=1,
+):
+    """Create the tasks that run every stage of the pipeline, skipping work
+    whose inputs haven't changed. Outputs are recorded in the manifest as
+    soon as they're written.
+
+    :param config: Region config.
+    :type config: dict
+    :param workdir: Working directory.
+    :type workdir: str
+    :param manifest: The working directory's manifest.
+    :type manifest: osm_osw.manifest.Manifest
+    :param simplify: Whether to join simple (degree-2) connection nodes.
+    :type simplify: bool
+    :param all_touched: Whether to mask every DEM pixel that a building or
+                        bridge touches, see mask_tileset.
+    :type all_touched: bool
+    :param roi: Whether to only mask the DEM pixels that incline inference
+                reads around network nodes, see mask_tileset. Tilesets are
+                then masked once their regions' networks are built.
+    :type roi: bool
+    :param jobs: CPU budget. Regions are parsed with several processes when
+                 there are fewer regions than jobs. Tilesets are masked in
+                 one worker each, since mask_tileset would otherwise start a
+                 pool inside a worker.
+    :type jobs: int
+    :returns: List of osm_osw.scheduler.Task, for run_tasks.
+
+    """
+    regions = {
+        region["properties"]["id"]: region for region in config["features"]
+    }
+    tilesets = region_tilesets(config)
+    tileset_regions = {}
+    for region_id, names in tilesets.items():
+        for tileset in names:
+            tileset_regions.setdefault(tileset, []).append(region_id)
+    cached = set(list_ned13s(workdir))
+    parse_jobs = max(1, jobs // len(regions))
+
+    # Keys are computed once a task's dependencies have finished, since they
+    # hash the files that the dependencies write.
+    keys = {}
+
+    def cached_stage(name, path, stage, key, args, creates=False):
+        # Plan and done functions for a task that writes to path as stage.
+        # args is either func's arguments or a function of the results of
+        # finished tasks that returns them.
+        def plan(results):
+            keys[name] = key()
+            if manifest.is_fresh(path, stage, keys[name]):
+                return None
+            return (args(results) if callable(args) else args), {}
+
+        def done(result):
+            manifest.record(path, stage, keys[name], creates=creates)
+            manifest.save()
+
+        return {"plan": plan, "done": done}
+
+    def tileset_mask_key(region_ids):
+        network_keys = None
+        if roi:
+            network_keys = [
+                network_key(manifest, workdir, region_id, simplify)
+                for region_id in region_ids
+            ]
+        return mask_key(
+            manifest, workdir, region_ids, all_touched, network_keys
+        )
+
+    def mask_is_fresh(tileset):
+        key = tileset_mask_key(tileset_regions[tileset])
+        return manifest.is_fresh(dem_path(workdir, tileset), "mask", key)
+
+    # Ready tasks of later stages are started first, so that each region is
+    # finished as soon as possible.
+    tasks = []
+    for region_id, region in regions.items():
+        extract_path = Path(
+            workdir, Path(region["properties"]["extract_url"]).name
+        )
+        clipped_path = pbf_path(workdir, region_id)
+        path = graph_path(workdir, region_id)
+        name = ("clip", region_id)
+        tasks.append(
+            Task(
+                name,
+                clip_region,
+                **cached_stage(
+                    name,
+                    clipped_path,
+                    "clip",
+                    lambda region=region: clip_key(manifest, workdir, region),
+                    (extract_path, clipped_path, region),
+                    creates=True,
+                ),
+                memory=CLIP_MEMORY,
+                thread=True,
+                priority=4,
+            )
+        )
+
+        name = ("network", region_id)
+        tasks.append(
+            Task(
+                name,
+                build_network,
+                deps=[("clip", region_id)],
+                **cached_stage(
+                    name,
+                    path,
+                    "network",
+                    lambda region_id=region_id: network_key(
+                        manifest, workdir, region_id, simplify
+                    ),
+                    (workdir, region_id, simplify, parse_jobs),
+                    creates=True,
+                ),
+                cpus=parse_jobs,
+                memory=_memory(clipped_path, PBF_MEMORY_FACTOR),
+                priority=3,
+            )
+        )
+
+        name = ("infer_curbramps", region_id)
+        tasks.append(
+            Task(
+                name,
+                infer_region_curbramps,
+                deps=[("network", region_id)],
+                **cached_stage(
+                    name,
+                    path,
+                    "infer_curbramps",
+                    lambda: curbramps_key(manifest),
+                    (workdir, region_id),
+                ),
+                memory=_memory(path, GRAPH_MEMORY_FACTOR),
+                priority=2,
+            )
+        )
+
+        name = ("incline", region_id)
+        tasks.append(
+            Task(
+                name,
+                infer_region_inclines,
+                deps=[("infer_curbramps", region_id)]
+                + [("mask", tileset) for tileset in tilesets[region_id]],
+                **cached_stage(
+                    name,
+                    path,
+                    "incline",
+                    lambda region_id=region_id: incline_key(
+                        manifest, workdir, tilesets[region_id]
+                    ),
+                    (workdir, region_id, tilesets[region_id]),
+                ),
+                memory=_memory(path, GRAPH_MEMORY_FACTOR),
+                priority=1,
+            )
+        )
+
+        # Geometries are only extracted for regions that overlap a stale
+        # tileset, which can be told once the regions that overlap its
+        # tilesets have been clipped.
+        def plan_extract(results, region_id=region_id):
+            if all(mask_is_fresh(tileset) for tileset in tilesets[region_id]):
+                return None
+            return (workdir, region_id, BUFFER_DIST), {}
+
+        tasks.append(
+            Task(
+                ("extract", region_id),
+                extract_masked_geometries,
+                deps=[
+                    ("clip", other_id)
+                    for tileset in tilesets[region_id]
+                    for other_id in tileset_regions[tileset]
+                ]
+                + [
+                    ("fetch", tileset)
+                    for tileset in tilesets[region_id]
+                    if tileset not in cached
+                ],
+                plan=plan_extract,
+                memory=_memory(clipped_path, PBF_MEMORY_FACTOR),
+                priority=3,
+            )
+        )
+
+    for tileset, region_ids in tileset_regions.items():
+        path = dem_path(workdir, tileset)
+        deps = [("extract", region_id) for region_id in region_ids]
+        if tileset not in cached:
+            tasks.append(
+                Task(
+                    ("fetch", tileset),
+                    fetch_ned_tile,
+                    args=(tileset, workdir),
+                    cpus=0,
+                    thread=True,
+                    priority=4,
+                )
+            )
+            deps.append(("fetch", tileset))
+
+        graph_paths = None
+        if roi:
+            # Masks are made from the graphs' nodes once curb ramps have
+            # been inferred, so that no other task is writing the graphs.
+            deps += [
+                ("infer_curbramps", region_id) for region_id in region_ids
+            ]
+            graph_paths = [
+                graph_path(workdir, region_id) for region_id in region_ids
+            ]
+
+        def mask_args(
+            results, path=path, region_ids=region_ids, graph_paths=graph_paths
+        ):
+            polygons = [
+                polygon
+                for region_id in region_ids
+                for polygon in results[("extract", region_id)]
+            ]
+            return (
+                path,
+                tileset_polygons([path], polygons)[0],
+                all_touched,
+                graph_paths,
+                # The task already runs in a worker process.
+                1,
+                not manifest.force,
+            )
+
+        name = ("mask", tileset)
+        tasks.append(
+            Task(
+                name,
+                mask_tileset,
+                deps=deps,
+                **cached_stage(
+                    name,
+                    path,
+                    "mask",
+                    lambda region_ids=region_ids: tileset_mask_key(region_ids),
+                    mask_args,
+                    creates=True,
+                ),
+                memory=_memory(path, DEM_MEMORY_FACTOR),
+                priority=2,
+            )
+        )
+
+    region_ids = list(regions)
+    merged_path = Path(workdir, "transportation.geojson")
+    name = ("merge",)
+    tasks.append(
+        Task(
+            name,
+            merge_regions,
+            deps=[("incline", region_id) for region_id in region_ids],
+            **cached_stage(
+                name,
+                merged_path,
+                "merge",
+                lambda: merge_key(manifest, workdir, region_ids),
+                (workdir, region_ids, merged_path),
+                creates=True,
+            ),
+            priority=0,
+        )
+    )
+
+    return tasks
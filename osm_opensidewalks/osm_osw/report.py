@@ -0,0 +1,254 @@
+"""Performance reports: wall time, CPU time, peak memory and element counts
+for every stage of every region, written as JSON.
+
+Stages are measured where they run (in worker processes, for parallel
+stages) with measure_call. Code deep inside a stage adds to the counts of
+the running measurement with add_count, which does nothing when nothing is
+being measured.
+
+"""
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+# Number of frames kept per traced allocation.
+TRACEMALLOC_FRAMES = 1
+
+_active = threading.local()
+
+
+def add_count(name, n=1):
+    """Add to a count of the stage that's being measured in this thread, if
+    any.
+
+    :param name: Name of the count, e.g. "ways_seen".
+    :type name: str
+    :param n: Amount to add.
+    :type n: int
+
+    """
+    counts = getattr(_active, "counts", None)
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + n
+
+
+def _reset_peak_rss():
+    # Linux can reset a process's peak RSS, so that the peak of every stage
+    # run by a worker can be measured.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cpu_times():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        self_usage.ru_utime + self_usage.ru_stime,
+        children.ru_utime + children.ru_stime,
+    )
+
+
+def host_info():
+    """Description of the machine and Python running the pipeline."""
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def measure_call(name, options, func, *args, **kwargs):
+    """Call a function, measuring it as a stage.
+
+    :param name: Task name: (stage,) or (stage, id), where id is e.g. a
+                 region ID or DEM tileset name.
+    :type name: tuple
+    :param options: Measurement options: {"allocations": number of top
+                    allocating source lines to record with tracemalloc (0 to
+                    disable), "process": whether the call has the process to
+                    itself, so that CPU time and peak RSS are its own}.
+    :type options: dict
+    :param func: Function to call as func(*args, **kwargs).
+    :type func: callable
+    :returns: Tuple of (func's return value, stage record dict).
+
+    """
+    process = options.get("process", True)
+    allocations = options.get("allocations", 0) if process else 0
+
+    record = {"stage": name[0], "id": name[1] if len(name) > 1 else None}
+    counts = {}
+    previous_counts = getattr(_active, "counts", None)
+    _active.counts = counts
+
+    if process:
+        peak_reset = _reset_peak_rss()
+        cpu_start, children_start = _cpu_times()
+    if allocations:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    wall_start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+
+        record["wall_time"] = time.perf_counter() - wall_start
+        if process:
+            cpu_end, children_end = _cpu_times()
+            record["cpu_time"] = cpu_end - cpu_start
+            # Worker processes started by the stage, e.g. to parse an
+            # .osm.pbf.
+            record["children_cpu_time"] = children_end - children_start
+            record["peak_rss"] = _peak_rss()
+            record["peak_rss_is_stage_peak"] = peak_reset
+        if allocations:
+            snapshot = tracemalloc.take_snapshot()
+            record["traced_peak"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        # Also when the stage raises, so that later stages (or the rest of
+        # the command) aren't traced or counted as this one.
+        if allocations:
+            tracemalloc.stop()
+        _active.counts = previous_counts
+
+    if allocations:
+        record["allocations"] = [
+            {
+                "location": f"{stat.traceback[0].filename}:"
+                f"{stat.traceback[0].lineno}",
+                "size": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:allocations]
+        ]
+    record["counts"] = counts
+
+    return result, record
+
+
+class Report:
+    """Collects stage records and writes them to a JSON file. Use as a
+    context manager to write the report when the command finishes, even if
+    it fails.
+
+    :param path: Path to the JSON report, or None to not measure anything.
+    :type path: str
+    :param command: Name of the command being run.
+    :type command: str
+    :param allocations: Number of top allocating source lines to record for
+                        every stage with tracemalloc (which slows stages
+                        down). 0 to disable.
+    :type allocations: int
+
+    """
+
+    def __init__(self, path, command, allocations=0):
+        self.path = path
+        self.command = command
+        self.allocations = allocations
+        self.stages = []
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.wall_start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.write()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def options(self, process=True):
+        """Measurement options for measure_call."""
+        return {"allocations": self.allocations, "process": process}
+
+    def call(self, name, func, *args, **kwargs):
+        """Call a function in this process, measuring it if enabled.
+
+        :param name: Task name, see measure_call.
+        :type name: tuple
+
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        result, record = measure_call(
+            name, self.options(), func, *args, **kwargs
+        )
+        self.stages.append(record)
+        return result
+
+    def tasks(self, names, func, tasks):
+        """Wrap run_jobs tasks so that every call is measured, if enabled.
+
+        :param names: Task names, see measure_call.
+        :type names: list of tuple
+        :param func: The function that the tasks call.
+        :type func: callable
+        :param tasks: (args, kwargs) tuples, one per call.
+        :type tasks: list of tuple
+        :returns: Tuple of (function, tasks) for run_jobs.
+
+        """
+        if not self.enabled:
+            return func, tasks
+        options = self.options()
+        return measure_call, [
+            ((name, options, func, *args), kwargs)
+            for name, (args, kwargs) in zip(names, tasks)
+        ]
+
+    def results(self, results):
+        """Record the measurements in the return values of wrapped run_jobs
+        tasks, and return the values of the wrapped functions.
+
+        :param results: Return values from run_jobs.
+        :type results: list
+
+        """
+        if not self.enabled:
+            return results
+        values = []
+        for value, record in results:
+            values.append(value)
+            self.stages.append(record)
+        return values
+
+    def add(self, record):
+        self.stages.append(record)
+
+    def write(self):
+        """Write the report, if enabled."""
+        if not self.enabled:
+            return
+        report = {
+            "command": self.command,
+            "started": self.started.isoformat(),
+            "wall_time": time.perf_counter() - self.wall_start,
+            "host": host_info(),
+            "stages": self.stages,
+        }
+        with open(self.path, "w") as f:
+            json.dump(report, f, indent=2)
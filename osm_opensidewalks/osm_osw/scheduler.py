@@ -0,0 +1,211 @@
+"""Run a dependency graph of tasks concurrently within a CPU and memory
+budget.
+
+"""
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+from .report import measure_call
+
+# Maximum number of tasks run in threads (e.g. downloads) at once.
+MAX_THREADS = 4
+
+
+class Task:
+    """A unit of work in a dependency graph.
+
+    :param name: Unique name, e.g. ("network", region_id).
+    :type name: tuple
+    :param func: Module-level function to call as func(*args, **kwargs).
+    :type func: callable
+    :param args: Positional arguments to func, unless planned.
+    :type args: tuple
+    :param kwargs: Keyword arguments to func, unless planned.
+    :type kwargs: dict
+    :param deps: Names of the tasks that must finish first.
+    :type deps: list of tuple
+    :param plan: Called in this process with the results of finished tasks
+                 (keyed by name) once the dependencies have finished.
+                 Returns (args, kwargs) for func, or None if the task is up to
+                 date and should be skipped.
+    :type plan: callable
+    :param done: Called in this process with func's return value after it
+                 succeeds, e.g. to record its outputs in the manifest.
+    :type done: callable
+    :param cpus: Number of CPUs the task uses.
+    :type cpus: int
+    :param memory: Estimated peak memory use in bytes, or a function (called
+                   after planning) that estimates it.
+    :type memory: int or callable
+    :param thread: Run in a thread of this process rather than in a worker
+                   process, for tasks that mostly wait on downloads or other
+                   programs.
+    :type thread: bool
+    :param priority: Ready tasks with lower priorities are started first.
+    :type priority: int
+
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        args=(),
+        kwargs=None,
+        deps=(),
+        plan=None,
+        done=None,
+        cpus=1,
+        memory=0,
+        thread=False,
+        priority=0,
+    ):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.plan = plan
+        self.done = done
+        self.cpus = cpus
+        self.memory = memory
+        self.thread = thread
+        self.priority = priority
+
+
+def run_tasks(tasks, jobs=1, memory=None, progressbar=None, report=None):
+    """Run tasks as soon as their dependencies have finished, while the CPUs
+    and estimated memory of the running tasks fit within a budget. A task
+    that doesn't fit is still started when nothing else is running.
+
+    If a task fails, no more tasks are started and the error is raised once
+    the running tasks have finished.
+
+    :param tasks: Tasks to run. Dependencies must be in the list.
+    :type tasks: list of Task
+    :param jobs: CPU budget, and the number of worker processes.
+    :type jobs: int
+    :param memory: Memory budget in bytes, or None for no limit.
+    :type memory: int
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated by 1 for every task that finishes or is
+                        skipped.
+    :type progressbar: click.progressbar
+    :param report: An (optional) osm_osw.report.Report that every task is
+                   measured for.
+    :type report: osm_osw.report.Report
+    :returns: dict of the return values of the tasks that were run (not
+              skipped), keyed by name.
+
+    """
+    tasks = {task.name: task for task in tasks}
+    order = {name: i for i, name in enumerate(tasks)}
+    waiting = {}
+    dependents = {name: [] for name in tasks}
+    for name, task in tasks.items():
+        waiting[name] = set(task.deps)
+        for dep in waiting[name]:
+            if dep not in tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+            dependents[dep].append(name)
+
+    ready = [name for name, deps in waiting.items() if not deps]
+    planned = {}
+    results = {}
+    finished = set()
+    running = {}
+    used_cpus = 0
+    used_memory = 0
+    error = None
+
+    def finish(name):
+        finished.add(name)
+        for dependent in dependents[name]:
+            waiting[dependent].discard(name)
+            if not waiting[dependent]:
+                ready.append(dependent)
+        if progressbar is not None:
+            progressbar.update(1)
+
+    def start_next():
+        # Starts (or skips) the first ready task, in order of priority, that
+        # fits within the budget.
+        nonlocal used_cpus, used_memory
+        ready.sort(key=lambda name: (tasks[name].priority, order[name]))
+        for name in ready:
+            task = tasks[name]
+            if name not in planned:
+                if task.plan is None:
+                    call = (task.args, task.kwargs)
+                else:
+                    call = task.plan(results)
+                if call is None:
+                    ready.remove(name)
+                    finish(name)
+                    return True
+                task_memory = task.memory
+                if callable(task_memory):
+                    task_memory = task_memory()
+                planned[name] = (call, task_memory)
+
+            (args, kwargs), task_memory = planned[name]
+            cpus = min(task.cpus, jobs)
+            if running and (
+                used_cpus + cpus > jobs
+                or (memory is not None and used_memory + task_memory > memory)
+            ):
+                continue
+
+            executor = threads if task.thread else processes
+            if report is not None and report.enabled:
+                # Tasks in threads share this process's CPU time and memory.
+                options = report.options(process=not task.thread)
+                args = (name, options, task.func, *args)
+                future = executor.submit(measure_call, *args, **kwargs)
+            else:
+                future = executor.submit(task.func, *args, **kwargs)
+            running[future] = (name, cpus, task_memory)
+            used_cpus += cpus
+            used_memory += task_memory
+            ready.remove(name)
+            return True
+        return False
+
+    with ProcessPoolExecutor(
+        max_workers=jobs
+    ) as processes, ThreadPoolExecutor(max_workers=MAX_THREADS) as threads:
+        while True:
+            while error is None and start_next():
+                pass
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, cpus, task_memory = running.pop(future)
+                used_cpus -= cpus
+                used_memory -= task_memory
+                try:
+                    result = future.result()
+                    if report is not None and report.enabled:
+                        result, record = result
+                        report.add(record)
+                    if tasks[name].done is not None:
+                        tasks[name].done(result)
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                results[name] = result
+                finish(name)
+
+    if error is not None:
+        raise error
+    if len(finished) < len(tasks):
+        raise ValueError("Task dependencies form a cycle")
+
+    return results
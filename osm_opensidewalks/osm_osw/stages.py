@@ -0,0 +1,343 @@
+"""Per-region pipeline stages. These are module-level functions so that the
+CLI can run them in worker processes.
+
+"""
+import asyncio
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+from shapely.geometry import shape
+
+from .dems.mask_dem import extract_masked, mask_dem, route_polygons
+from .dems.transforms import infer_incline, list_ned13s
+from .geojson_io import FeatureCollectionWriter, NewlineDelimitedWriter
+from .inference.curb_ramps import infer_curbramps
+from .osm.osm_change import (
+    apply_changes_to_pbf,
+    clip_changes,
+    locate_nodes,
+    read_changes,
+)
+from .osm.compact_graph import CompactGraph
+from .osm.osm_clip import osm_clip
+from .osm.osm_graph import DEM_INCLINE, OSMGraph
+from .report import add_count
+
+
+def graph_path(workdir, region_id):
+    """Path of a region's graph, saved between stages with OSMGraph.save.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_id: Region ID from the config.
+    :type region_id: str
+    :returns: pathlib.Path
+
+    """
+    return Path(workdir, f"{region_id}.graph.npz")
+
+
+def clip_region(extract_path, clipped_path, region):
+    """Clip a region's .osm.pbf from an extract.
+
+    :param extract_path: Path to the extract's .osm.pbf.
+    :type extract_path: str
+    :param clipped_path: Path to write the region's .osm.pbf to.
+    :type clipped_path: str
+    :param region: Region feature from the config.
+    :type region: dict
+
+    """
+    asyncio.run(osm_clip(extract_path, clipped_path, region))
+
+
+def build_network(workdir, region_id, simplify=True, jobs=1, progressbar=None):
+    """Create a region's OpenSidewalks graph from its clipped .osm.pbf and
+    write it to file.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_id: Region ID from the config.
+    :type region_id: str
+    :param simplify: Whether to join simple (degree-2) connection nodes.
+    :type simplify: bool
+    :param jobs: Number of worker processes used to parse the .osm.pbf.
+    :type jobs: int
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated with the number of .osm.pbf bytes read.
+    :type progressbar: click.progressbar
+
+    """
+    pbf_path = str(Path(workdir, f"{region_id}.osm.pbf"))
+    OG = OSMGraph.from_pbf(pbf_path, progressbar=progressbar, jobs=jobs)
+    add_count("nodes", OG.G.number_of_nodes())
+    add_count("edges", OG.G.number_of_edges())
+    if simplify:
+        OG.simplify()
+        add_count("simplified_edges", OG.G.number_of_edges())
+    OG.construct_geometries()
+    OG.save(graph_path(workdir, region_id))
+
+
+def apply_region_changes(workdir, region, change_paths, simplify=True):
+    """Apply OSM change files to a region's clipped .osm.pbf and update its
+    graph in place, rebuilding only the affected ways. Changes outside of the
+    region are skipped.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region: Region feature from the config.
+    :type region: dict
+    :param change_paths: Paths to .osc (or .osc.gz) files, oldest first.
+    :type change_paths: list of str
+    :param simplify: Whether to join simple (degree-2) connection nodes.
+    :type simplify: bool
+
+    """
+    region_id = region["properties"]["id"]
+    pbf_path = Path(workdir, f"{region_id}.osm.pbf")
+    path = graph_path(workdir, region_id)
+
+    changes = read_changes(change_paths)
+    OG = OSMGraph.load(path)
+
+    # Locate the nodes of changed ways, and find which changed nodes are
+    # already in the extract. Unchanged nodes that aren't in the graph are
+    # read from the extract.
+    ids = {
+        ref
+        for way in changes.ways.values()
+        if way is not None
+        for ref in way[0]
+    }
+    ids.update(changes.nodes)
+    ids = np.fromiter(ids, dtype=np.int64, count=len(ids))
+    indices = OG.G.node_index(ids)
+    in_graph = indices >= 0
+    located = locate_nodes(pbf_path, ids[~in_graph].tolist())
+    graph_nodes = {
+        n: (OG.G.x[i], OG.G.y[i], None)
+        for n, i in zip(ids[in_graph].tolist(), indices[in_graph].tolist())
+    }
+
+    node_ids, way_ids = clip_changes(
+        {**graph_nodes, **located, **changes.nodes},
+        changes.ways,
+        shape(region["geometry"]),
+    )
+    node_ids.update(
+        n for n in changes.nodes if n in graph_nodes or n in located
+    )
+
+    nodes = {n: node for n, node in located.items() if n not in changes.nodes}
+    nodes.update(
+        (n, node)
+        for n, node in changes.nodes.items()
+        if node is None or n in node_ids
+    )
+    ways = {
+        way_id: way if way_id in way_ids else None
+        for way_id, way in changes.ways.items()
+    }
+
+    OG.apply_changes(ways, nodes, simplify=simplify)
+    apply_changes_to_pbf(pbf_path, change_paths, node_ids, way_ids)
+    OG.save(path)
+
+
+def infer_region_curbramps(workdir, region_id, progressbar=None):
+    """Infer curbramps on a region's crossings and update its graph.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_id: Region ID from the config.
+    :type region_id: str
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as edges are processed.
+    :type progressbar: click.progressbar
+
+    """
+    path = graph_path(workdir, region_id)
+    OG = OSMGraph.load(path)
+    add_count("edges", OG.G.number_of_edges())
+    infer_curbramps(OG, progressbar=progressbar)
+    OG.save(path)
+
+
+def infer_region_inclines(workdir, region_id, tilesets=None, progressbar=None):
+    """Estimate edge inclines for a region from DEM tilesets and update its
+    graph.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_id: Region ID from the config.
+    :type region_id: str
+    :param tilesets: Names of the (cached) tilesets to use. Defaults to every
+                     cached tileset.
+    :type tilesets: list of str
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as edges are processed.
+    :type progressbar: click.progressbar
+
+    """
+    path = graph_path(workdir, region_id)
+    OG = OSMGraph.load(path)
+
+    add_count("edges", OG.G.number_of_edges())
+    if OG.G.number_of_edges() == 0:
+        # No ways were kept, so there aren't any edge columns either.
+        return
+    lengths = OG.G.edge_attrs["length"].values
+    # Estimates from earlier runs are dropped, so that edges whose pixels
+    # are now masked don't keep them.
+    OG.G.edge_attrs.drop(DEM_INCLINE)
+
+    if tilesets is None:
+        tilesets = list_ned13s(workdir)
+
+    for tileset in tilesets:
+        tileset_path = Path(workdir, "dems", f"{tileset}.tif")
+
+        edges = []
+        inclines = []
+        with rasterio.open(tileset_path) as dem:
+            for i in range(OG.G.number_of_edges()):
+                incline = infer_incline(
+                    OG.G.edge_geometry(i), lengths[i], dem, 3
+                )
+                if incline is not None:
+                    edges.append(i)
+                    inclines.append(incline)
+                if progressbar is not None:
+                    progressbar.update(1)
+        OG.G.edge_attrs.set(DEM_INCLINE, edges, inclines)
+        add_count("inclines", len(edges))
+
+    OG.save(path)
+
+
+def extract_masked_geometries(workdir, region_id, buffer):
+    """Extract buffered building, bridge area and bridge line polygons to
+    mask from a region's clipped .osm.pbf.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_id: Region ID from the config.
+    :type region_id: str
+    :param buffer: Buffer distance in meters.
+    :type buffer: float
+    :returns: List of GeoJSON MultiPolygon geometries (dict).
+
+    """
+    pbf_path = Path(workdir, f"{region_id}.osm.pbf")
+    areas, bridges = extract_masked(pbf_path, buffer)
+    add_count("areas", len(areas))
+    add_count("bridges", len(bridges))
+
+    return areas + bridges
+
+
+def tileset_polygons(dem_paths, polygons):
+    """Route polygons to the DEM tilesets whose bounds they intersect.
+
+    :param dem_paths: Paths to DEM tilesets.
+    :type dem_paths: list of str
+    :param polygons: GeoJSON (Multi)Polygon geometries, e.g. from
+                     extract_masked_geometries.
+    :type polygons: list of dict
+    :returns: list of lists of polygons, one per tileset.
+
+    """
+    tile_bounds = []
+    for path in dem_paths:
+        with rasterio.open(path) as rast:
+            tile_bounds.append(list(rast.bounds))
+    return route_polygons(polygons, tile_bounds)
+
+
+def mask_tileset(
+    dem_path,
+    polygons,
+    all_touched=False,
+    graph_paths=None,
+    jobs=1,
+    reuse=True,
+    progressbar=None,
+):
+    """Replace a DEM tileset's mask with one that masks out the pixels in
+    the given polygons, e.g. from tileset_polygons.
+
+    :param dem_path: Path to the DEM tileset.
+    :type dem_path: str
+    :param polygons: GeoJSON (Multi)Polygon geometries to mask.
+    :type polygons: list of dict
+    :param all_touched: Mask every pixel that a polygon touches, rather than
+                        only the pixels whose centers are in a polygon.
+    :type all_touched: bool
+    :param graph_paths: Optional paths of region graphs. If given, only the
+                        DEM pixels that incline inference reads around their
+                        nodes are masked.
+    :type graph_paths: list of str
+    :param jobs: Number of worker processes that mask strips of the tileset.
+    :type jobs: int
+    :param reuse: Reuse the strips of the tileset's cached mask whose
+                  polygons haven't changed, see mask_dem.
+    :type reuse: bool
+    :param progressbar: An (optional) click.progressbar object that will be
+                        updated as polygons are masked.
+    :type progressbar: click.progressbar
+
+    """
+    if not polygons:
+        # Tiles that have never been masked are left untouched.
+        with rasterio.open(dem_path) as rast:
+            if rast.mask_flag_enums[0] == [MaskFlags.all_valid]:
+                return
+    points = None
+    if graph_paths is not None:
+        lons = [np.empty(0)]
+        lats = [np.empty(0)]
+        for path in graph_paths:
+            lon, lat = CompactGraph.load_locations(path)
+            lons.append(lon)
+            lats.append(lat)
+        points = (np.concatenate(lons), np.concatenate(lats))
+        add_count("roi_nodes", len(points[0]))
+
+    mask_dem(
+        dem_path,
+        polygons,
+        progressbar=progressbar,
+        all_touched=all_touched,
+        points=points,
+        jobs=jobs,
+        reuse=reuse,
+    )
+    add_count("polygons_masked", len(polygons))
+
+
+def merge_regions(workdir, region_ids, path, ndjson=False):
+    """Write the edges of region graphs to one GeoJSON file. Features are
+    written as they're read so that only one region is in memory at a time.
+
+    :param workdir: Working directory.
+    :type workdir: str
+    :param region_ids: Region IDs from the config.
+    :type region_ids: list of str
+    :param path: Path to the output file.
+    :type path: str
+    :param ndjson: Write newline-delimited GeoJSON instead of a
+                   FeatureCollection.
+    :type ndjson: bool
+
+    """
+    writer_class = (
+        NewlineDelimitedWriter if ndjson else FeatureCollectionWriter
+    )
+    with writer_class(path) as writer:
+        for region_id in region_ids:
+            OG = OSMGraph.load(graph_path(workdir, region_id))
+            writer.write_all(OG.edge_features())
+    add_count("features_written", writer.count)
@@ -0,0 +1,52 @@
+import json
+
+import osmium
+from click.testing import CliRunner
+
+from osm_osw.cli import osm_osw
+from osm_osw.stages import build_network
+
+
+def _write_config(workdir):
+    ring = [[-123, 47], [-122, 47], [-122, 48], [-123, 48], [-123, 47]]
+    config = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {
+                    "id": "empty",
+                    "name": "Empty",
+                    "lon": -122.5,
+                    "lat": 47.5,
+                    "zoom": 14,
+                    "extract_url": "https://example.com/empty.osm.pbf",
+                },
+                "geometry": {"type": "MultiPolygon", "coordinates": [[ring]]},
+            }
+        ],
+    }
+    path = workdir / "config.geojson"
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def test_merge_removes_other_format(tmp_path):
+    config = _write_config(tmp_path)
+    osmium.SimpleWriter(str(tmp_path / "empty.osm.pbf")).close()
+    build_network(tmp_path, "empty")
+    geojson = tmp_path / "transportation.geojson"
+    geojsonl = tmp_path / "transportation.geojsonl"
+
+    def merge(*options):
+        result = CliRunner().invoke(
+            osm_osw, ["merge", config, "--workdir", str(tmp_path), *options]
+        )
+        assert result.exit_code == 0, result.output
+
+    merge()
+    merge("--ndjson")
+    assert geojsonl.exists() and not geojson.exists()
+
+    merge()
+    assert geojson.exists() and not geojsonl.exists()
@@ -0,0 +1,97 @@
+import numpy as np
+
+from osm_osw.osm.compact_graph import AttributeTable, CompactGraph
+
+
+def _graph(ways):
+    # A graph with one edge per segment of the given ways: lists of OSM node
+    # ids, whose coordinates are derived from the ids.
+    refs = [ref for way in ways for ref in way]
+    offsets = np.cumsum([0] + [len(way) for way in ways])
+    return CompactGraph.from_ways(
+        AttributeTable.from_records(
+            [{"osm_id": i + 1} for i in range(len(ways))]
+        ),
+        offsets,
+        refs,
+        [ref * 100 for ref in refs],
+        [ref * 200 for ref in refs],
+    )
+
+
+def test_node_index():
+    G = _graph([[30, 10, 20]])
+    indices = G.node_index([20, 40, 10, 5, 30])
+    assert indices.tolist() == [1, -1, 0, -1, 2]
+    assert G.node_ids[indices[[0, 2, 4]]].tolist() == [20, 10, 30]
+
+
+def test_node_index_empty_graph():
+    G = _graph([])
+    assert G.number_of_nodes() == 0
+    indices = G.node_index([1, 2])
+    assert indices.tolist() == [-1, -1]
+    assert indices.dtype == np.int64
+    assert G.node_index([]).tolist() == []
+
+
+def _edges(G):
+    # (source id, destination id, node ref ids, osm_id) of every edge.
+    offsets, refs = G.ndrefs
+    osm_ids = G.edge_attrs["osm_id"].values
+    return [
+        (
+            G.node_ids[G.src[i]].item(),
+            G.node_ids[G.dst[i]].item(),
+            G.node_ids[refs[offsets[i] : offsets[i + 1]]].tolist(),
+            osm_ids[i].item(),
+        )
+        for i in range(G.number_of_edges())
+    ]
+
+
+def test_contract_nodes_chain():
+    G = _graph([[1, 2, 3, 4], [4, 5]])
+    H = G.contract_nodes(G.node_index([2, 3]))
+    assert _edges(H) == [(1, 4, [1, 2, 3, 4], 1), (4, 5, [4, 5], 2)]
+    # Contracted nodes stay in the node table for the node refs.
+    assert H.node_ids.tolist() == [1, 2, 3, 4, 5]
+    assert H.out_degree().tolist() == [1, 0, 0, 1, 0]
+
+
+def test_contract_nodes_keeps_attributes_of_first_edge():
+    G = _graph([[1, 2], [2, 3]])
+    H = G.contract_nodes(G.node_index([2]))
+    assert _edges(H) == [(1, 3, [1, 2, 3], 1)]
+    assert H.edge_attrs["segment"].values.tolist() == [0]
+
+
+def test_contract_nodes_nothing():
+    G = _graph([[1, 2, 3]])
+    H = G.contract_nodes([])
+    assert _edges(H) == _edges(G)
+
+
+def test_contract_nodes_closed_loop():
+    # Every node of the loop is contracted: the loop is kept as one self-loop
+    # edge, starting from its lowest-indexed edge.
+    G = _graph([[3, 2, 1, 3]])
+    H = G.contract_nodes(G.node_index([1, 2, 3]))
+    assert _edges(H) == [(1, 1, [1, 3, 2, 1], 1)]
+
+    G = _graph([[1, 2, 3, 1]])
+    H = G.contract_nodes(G.node_index([2, 3]))
+    assert _edges(H) == [(1, 1, [1, 2, 3, 1], 1)]
+
+
+def test_contract_nodes_self_loop():
+    G = _graph([[5, 5]])
+    H = G.contract_nodes(G.node_index([5]))
+    assert _edges(H) == [(5, 5, [5, 5], 1)]
+
+
+def test_contract_nodes_empty_graph():
+    G = _graph([])
+    H = G.contract_nodes([])
+    assert H.number_of_nodes() == 0
+    assert H.number_of_edges() == 0
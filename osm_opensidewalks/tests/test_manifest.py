@@ -0,0 +1,74 @@
+from osm_osw.manifest import Manifest
+
+
+def _output(workdir, text="graph"):
+    path = workdir / "region.graph.npz"
+    path.write_text(text)
+    return path
+
+
+def test_record_and_is_fresh(tmp_path):
+    path = _output(tmp_path)
+    manifest = Manifest(tmp_path)
+    key = manifest.key("network", "input digest")
+    assert not manifest.is_fresh(path, "network", key)
+
+    manifest.record(path, "network", key, creates=True)
+    assert manifest.is_fresh(path, "network", key)
+    assert not manifest.is_fresh(path, "network", "other key")
+    assert not manifest.is_fresh(path, "incline", key)
+    assert manifest.stage_key(path, "network") == key
+    assert manifest.stage_key(path, "incline") is None
+
+
+def test_saved_manifest(tmp_path):
+    path = _output(tmp_path)
+    manifest = Manifest(tmp_path)
+    manifest.record(path, "network", "a", creates=True)
+    manifest.save()
+
+    assert Manifest(tmp_path).is_fresh(path, "network", "a")
+    assert not Manifest(tmp_path, force=True).is_fresh(path, "network", "a")
+
+
+def test_changed_output_is_stale(tmp_path):
+    path = _output(tmp_path)
+    manifest = Manifest(tmp_path)
+    manifest.record(path, "network", "a", creates=True)
+
+    _output(tmp_path, "edited graph")
+    assert not manifest.is_fresh(path, "network", "a")
+
+    path.unlink()
+    assert not manifest.is_fresh(path, "network", "a")
+
+
+def test_lineage_truncation(tmp_path):
+    path = _output(tmp_path)
+    manifest = Manifest(tmp_path)
+    manifest.record(path, "network", "n1", creates=True)
+    manifest.record(path, "curbramps", "c1")
+    manifest.record(path, "incline", "i1")
+    for stage, key in [("network", "n1"), ("curbramps", "c1")]:
+        assert manifest.is_fresh(path, stage, key)
+
+    # Rerunning a stage drops the stages that came after it.
+    _output(tmp_path, "graph with new curb ramps")
+    manifest.record(path, "curbramps", "c2")
+    assert manifest.is_fresh(path, "network", "n1")
+    assert manifest.is_fresh(path, "curbramps", "c2")
+    assert not manifest.is_fresh(path, "curbramps", "c1")
+    assert not manifest.is_fresh(path, "incline", "i1")
+
+    # A stage that creates its output starts a new lineage.
+    manifest.record(path, "network", "n2", creates=True)
+    assert manifest.is_fresh(path, "network", "n2")
+    assert not manifest.is_fresh(path, "network", "n1")
+    assert not manifest.is_fresh(path, "curbramps", "c2")
+
+
+def test_key(tmp_path):
+    manifest = Manifest(tmp_path)
+    assert manifest.key("mask", "a", 1) == manifest.key("mask", "a", 1)
+    assert manifest.key("mask", "a", 1) != manifest.key("mask", "a", 2)
+    assert manifest.key("mask", "a") != manifest.key("incline", "a")
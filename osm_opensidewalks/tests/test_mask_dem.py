@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from osm_osw.dems import mask_dem as mask_dem_module
+from osm_osw.dems.mask_dem import mask_dem, mask_sidecar_path
+
+# A DEM with three strips of rows (see MASK_STRIP_ROWS).
+WIDTH = 64
+HEIGHT = 1200
+RESOLUTION = 1e-4
+WEST = -122.3
+NORTH = 47.7
+
+
+def _write_dem(path):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=WIDTH,
+        height=HEIGHT,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(WEST, NORTH, RESOLUTION, RESOLUTION),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dem:
+        dem.write(np.ones((1, HEIGHT, WIDTH), dtype="float32"))
+    return str(path)
+
+
+def _square(row, col, size=5):
+    # A GeoJSON MultiPolygon covering size x size pixels from (row, col).
+    west = WEST + col * RESOLUTION
+    north = NORTH - row * RESOLUTION
+    east = west + size * RESOLUTION
+    south = north - size * RESOLUTION
+    ring = [[west, south], [east, south], [east, north], [west, north]]
+    return {"type": "MultiPolygon", "coordinates": [[ring + [ring[0]]]]}
+
+
+def _read_mask(path):
+    with rasterio.open(path) as dem:
+        return dem.read_masks(1)
+
+
+@pytest.fixture
+def strips_masked(monkeypatch):
+    # Row offsets of the strips that were masked rather than reused.
+    masked = []
+    mask_strip = mask_dem_module.mask_strip
+
+    def spy(grid, row_start, *args, **kwargs):
+        masked.append(row_start)
+        return mask_strip(grid, row_start, *args, **kwargs)
+
+    monkeypatch.setattr(mask_dem_module, "mask_strip", spy)
+    return masked
+
+
+POLYGONS = [_square(10, 10), _square(600, 20), _square(1100, 30, size=8)]
+
+
+def test_unchanged_mask_is_reused(tmp_path, strips_masked):
+    path = _write_dem(tmp_path / "dem.tif")
+    mask_dem(path, POLYGONS)
+    assert sorted(strips_masked) == [0, 512, 1024]
+    assert mask_sidecar_path(path).exists()
+    mask = _read_mask(path)
+    assert (mask == 0).sum() == 25 + 25 + 64
+
+    strips_masked.clear()
+    mtime = (tmp_path / "dem.tif").stat().st_mtime_ns
+    mask_dem(path, list(reversed(POLYGONS)))
+    assert strips_masked == []
+    assert (tmp_path / "dem.tif").stat().st_mtime_ns == mtime
+    assert (_read_mask(path) == mask).all()
+
+
+def test_changed_strips_match_fresh_mask(tmp_path, strips_masked):
+    path = _write_dem(tmp_path / "dem.tif")
+    mask_dem(path, POLYGONS)
+
+    # Move the polygon in the middle strip.
+    polygons = [POLYGONS[0], _square(700, 40), POLYGONS[2]]
+    strips_masked.clear()
+    mask_dem(path, polygons)
+    assert strips_masked == [512]
+
+    fresh_path = _write_dem(tmp_path / "fresh.tif")
+    mask_dem(fresh_path, polygons, reuse=False)
+    assert (_read_mask(path) == _read_mask(fresh_path)).all()
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"all_touched": True},
+        {"points": (np.array([WEST + 12.5e-4]), np.array([NORTH - 12.5e-4]))},
+    ],
+)
+def test_changed_options_match_fresh_mask(tmp_path, strips_masked, options):
+    path = _write_dem(tmp_path / "dem.tif")
+    mask_dem(path, POLYGONS)
+
+    strips_masked.clear()
+    mask_dem(path, POLYGONS, **options)
+    assert sorted(strips_masked) == [0, 512, 1024]
+
+    fresh_path = _write_dem(tmp_path / "fresh.tif")
+    mask_dem(fresh_path, POLYGONS, reuse=False, **options)
+    assert (_read_mask(path) == _read_mask(fresh_path)).all()
+
+
+def test_replaced_dem_is_masked_from_sidecar(tmp_path, strips_masked):
+    path = _write_dem(tmp_path / "dem.tif")
+    mask_dem(path, POLYGONS)
+    mask = _read_mask(path)
+
+    with rasterio.open(path, "r+") as dem:
+        dem.write_mask(True)
+    strips_masked.clear()
+    mask_dem(path, POLYGONS)
+    assert strips_masked == []
+    assert (_read_mask(path) == mask).all()
+
+
+def test_reuse_disabled(tmp_path, strips_masked):
+    path = _write_dem(tmp_path / "dem.tif")
+    mask_dem(path, POLYGONS)
+
+    strips_masked.clear()
+    mask_dem(path, POLYGONS, reuse=False)
+    assert sorted(strips_masked) == [0, 512, 1024]
+
+
+def test_parallel_strips_match_serial(tmp_path):
+    serial_path = _write_dem(tmp_path / "serial.tif")
+    mask_dem(serial_path, POLYGONS, jobs=1)
+    parallel_path = _write_dem(tmp_path / "parallel.tif")
+    mask_dem(parallel_path, POLYGONS, jobs=2)
+    assert (_read_mask(serial_path) == _read_mask(parallel_path)).all()
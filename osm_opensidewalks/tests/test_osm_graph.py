@@ -0,0 +1,104 @@
+import osmium
+from osmium.osm.mutable import Node, Way
+
+from benchmarks.synthetic import write_pbf
+from osm_osw.osm.osm_graph import OSMGraph
+
+
+def _graph_state(OG):
+    # Everything that's saved and output about a graph.
+    G = OG.G
+    return {
+        "node_ids": G.node_ids.tolist(),
+        "x": G.x.tolist(),
+        "y": G.y.tolist(),
+        "src": G.src.tolist(),
+        "dst": G.dst.tolist(),
+        "ndrefs": [array.tolist() for array in G.ndrefs],
+        "node_attrs": {
+            name: column.to_list()
+            for name, column in G.node_attrs.columns.items()
+        },
+        "edge_attrs": {
+            name: column.to_list()
+            for name, column in G.edge_attrs.columns.items()
+        },
+    }
+
+
+def _write_pbf(path, nodes=(), ways=()):
+    writer = osmium.SimpleWriter(str(path))
+    try:
+        for node in nodes:
+            writer.add_node(node)
+        for way in ways:
+            writer.add_way(way)
+    finally:
+        writer.close()
+    return str(path)
+
+
+def test_from_pbf_without_ways(tmp_path):
+    # A kerb node that isn't on any way is a candidate node, but there's no
+    # graph to attach it to.
+    kerb = Node(
+        id=1,
+        location=(-122.3, 47.6),
+        tags={"barrier": "kerb", "kerb": "lowered"},
+    )
+    path = _write_pbf(tmp_path / "kerb.osm.pbf", nodes=[kerb])
+
+    OG = OSMGraph.from_pbf(path)
+    assert OG.G.number_of_nodes() == 0
+    assert OG.G.number_of_edges() == 0
+
+
+def test_simplify(tmp_path):
+    nodes = [
+        Node(id=i, location=(-122.3 + i * 1e-4, 47.6)) for i in (1, 2, 3, 5)
+    ]
+    nodes.append(
+        Node(id=4, location=(-122.3 + 4e-4, 47.6), tags={"kerb": "lowered"})
+    )
+    ways = [
+        Way(id=10, nodes=[1, 2, 3], tags={"highway": "footway"}),
+        Way(id=20, nodes=[3, 4, 5], tags={"highway": "footway"}),
+    ]
+    path = _write_pbf(tmp_path / "ways.osm.pbf", nodes=nodes, ways=ways)
+
+    OG = OSMGraph.from_pbf(path)
+    OG.simplify()
+
+    # Node 2 is joined, but not node 3 (shared by two ways) or the kerb.
+    G = OG.G
+    offsets, refs = G.ndrefs
+    edges = sorted(
+        G.node_ids[refs[offsets[i] : offsets[i + 1]]].tolist()
+        for i in range(G.number_of_edges())
+    )
+    assert edges == [[1, 2, 3], [3, 4], [4, 5]]
+
+
+def test_parallel_from_pbf(tmp_path):
+    # Large enough to be split into more than one byte range.
+    path = str(tmp_path / "grid.osm.pbf")
+    write_pbf(path, 120)
+
+    serial = OSMGraph.from_pbf(path)
+    parallel = OSMGraph.from_pbf(path, jobs=2)
+    assert serial.G.number_of_edges() > 0
+    assert _graph_state(parallel) == _graph_state(serial)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "grid.osm.pbf")
+    write_pbf(path, 10)
+    OG = OSMGraph.from_pbf(path)
+    OG.simplify()
+    OG.construct_geometries()
+
+    OG.save(tmp_path / "grid.graph.npz")
+    loaded = OSMGraph.load(tmp_path / "grid.graph.npz")
+    assert _graph_state(loaded) == _graph_state(OG)
+    assert loaded.G.coords[1].tolist() == OG.G.coords[1].tolist()
+    assert list(loaded.edge_features()) == list(OG.edge_features())
@@ -0,0 +1,35 @@
+import tracemalloc
+
+import pytest
+
+from osm_osw.report import add_count, measure_call
+
+
+def _count_and_fail():
+    add_count("ways", 3)
+    raise ValueError("stage failed")
+
+
+def test_measure_call_records_counts():
+    def stage():
+        add_count("ways", 2)
+        add_count("ways", 1)
+        return "done"
+
+    result, record = measure_call(("network", "a"), {}, stage)
+    assert result == "done"
+    assert record["stage"] == "network" and record["id"] == "a"
+    assert record["counts"] == {"ways": 3}
+
+
+def test_measure_call_cleans_up_when_stage_raises():
+    def outer():
+        with pytest.raises(ValueError):
+            measure_call(("network",), {"allocations": 5}, _count_and_fail)
+        # The failed stage's tracing stopped, and counts go to this stage
+        # again.
+        assert not tracemalloc.is_tracing()
+        add_count("edges", 1)
+
+    _, record = measure_call(("runall",), {"process": False}, outer)
+    assert record["counts"] == {"edges": 1}
@@ -0,0 +1,113 @@
+import pytest
+
+from osm_osw.scheduler import Task, run_tasks
+
+
+def _add(a, b):
+    return a + b
+
+
+def _fail():
+    raise RuntimeError("task failed")
+
+
+def _chain(log):
+    # a -> b -> c, and d, which depends on a and c. b and d are planned from
+    # the results of their dependencies.
+    def done(name):
+        return lambda result: log.append(name)
+
+    return [
+        Task(
+            "d",
+            _add,
+            deps=["a", "c"],
+            plan=lambda results: ((results["a"], results["c"]), {}),
+            done=done("d"),
+        ),
+        Task("c", _add, args=(0, 100), deps=["b"], done=done("c")),
+        Task(
+            "b",
+            _add,
+            deps=["a"],
+            plan=lambda results: ((results["a"], 10), {}),
+            done=done("b"),
+        ),
+        Task("a", _add, args=(1, 2), done=done("a")),
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_dependency_order(jobs):
+    log = []
+    results = run_tasks(_chain(log), jobs=jobs)
+    assert results == {"a": 3, "b": 13, "c": 100, "d": 103}
+    assert log == ["a", "b", "c", "d"]
+
+
+def test_priority():
+    # With one CPU, independent tasks run one at a time: lower priorities
+    # first, then in the order they were given.
+    log = []
+    tasks = [
+        Task(name, _add, args=(0, 0), priority=priority)
+        for name, priority in [("x", 1), ("y", 0), ("z", 1), ("w", 0)]
+    ]
+    for task in tasks:
+        task.done = lambda result, name=task.name: log.append(name)
+    run_tasks(tasks, jobs=1)
+    assert log == ["y", "w", "x", "z"]
+
+
+def test_skipped_tasks():
+    tasks = [
+        Task("a", _add, plan=lambda results: None),
+        Task("b", _add, args=(1, 1), deps=["a"]),
+    ]
+    assert run_tasks(tasks) == {"b": 2}
+
+
+def test_tasks_over_budget_run_alone():
+    tasks = [
+        Task("a", _add, args=(1, 1), cpus=4, memory=100),
+        Task("b", _add, args=(2, 2), memory=lambda: 100),
+    ]
+    assert run_tasks(tasks, jobs=2, memory=10) == {"a": 2, "b": 4}
+
+
+def test_thread_tasks():
+    tasks = [
+        Task("a", _add, args=(1, 1), thread=True),
+        Task(
+            "b",
+            _add,
+            deps=["a"],
+            plan=lambda results: ((results["a"], 1), {}),
+        ),
+    ]
+    assert run_tasks(tasks, jobs=2) == {"a": 2, "b": 3}
+
+
+def test_failure_stops_dependents():
+    log = []
+    tasks = [
+        Task("a", _fail),
+        Task("b", _add, args=(1, 1), deps=["a"], done=log.append),
+    ]
+    with pytest.raises(RuntimeError, match="task failed"):
+        run_tasks(tasks)
+    assert log == []
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match="unknown task"):
+        run_tasks([Task("a", _add, args=(1, 1), deps=["b"])])
+
+
+def test_cycle():
+    tasks = [
+        Task("a", _add, args=(1, 1), deps=["b"]),
+        Task("b", _add, args=(1, 1), deps=["a"]),
+    ]
+    with pytest.raises(ValueError, match="cycle"):
+        run_tasks(tasks)
@@ -0,0 +1,178 @@
+import json
+
+import numpy as np
+import osmium
+
+from benchmarks.synthetic import LAT0, LON0, grid_bounds, write_dem, write_pbf
+
+from osm_osw.dems.mask_dem import mask_dem
+from osm_osw.osm.osm_graph import DEM_INCLINE, OSMGraph
+from osm_osw.stages import (
+    apply_region_changes,
+    build_network,
+    graph_path,
+    infer_region_curbramps,
+    infer_region_inclines,
+    merge_regions,
+)
+
+
+def _region(region_id):
+    return {
+        "type": "Feature",
+        "properties": {"id": region_id},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [
+                [[-123, 47], [-122, 47], [-122, 48], [-123, 48], [-123, 47]]
+            ],
+        },
+    }
+
+
+CHANGES = """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <create>
+    <node id="11" version="1" lat="47.6" lon="-122.3"/>
+    <node id="12" version="1" lat="47.601" lon="-122.3"/>
+    <way id="5" version="1">
+      <nd ref="11"/>
+      <nd ref="12"/>
+      <tag k="highway" v="footway"/>
+    </way>
+  </create>
+</osmChange>
+"""
+
+
+def _empty_region(workdir):
+    osmium.SimpleWriter(str(workdir / "empty.osm.pbf")).close()
+    build_network(workdir, "empty")
+    return OSMGraph.load(graph_path(workdir, "empty"))
+
+
+def test_stages_without_ways(tmp_path):
+    OG = _empty_region(tmp_path)
+    assert OG.G.number_of_edges() == 0
+
+    infer_region_curbramps(tmp_path, "empty")
+    infer_region_inclines(tmp_path, "empty", tilesets=[])
+    assert (
+        OSMGraph.load(graph_path(tmp_path, "empty")).G.number_of_edges() == 0
+    )
+
+
+def test_apply_changes_to_empty_graph(tmp_path):
+    _empty_region(tmp_path)
+    change_path = tmp_path / "changes.osc"
+    change_path.write_text(CHANGES)
+
+    apply_region_changes(tmp_path, _region("empty"), [str(change_path)])
+
+    G = OSMGraph.load(graph_path(tmp_path, "empty")).G
+    assert G.node_ids.tolist() == [11, 12]
+    assert G.number_of_edges() == 1
+    assert G.edge_attrs["osm_id"].values.tolist() == [5]
+
+
+def test_merge_keeps_other_files(tmp_path):
+    _empty_region(tmp_path)
+    path = tmp_path / "roads.geojson"
+    sibling = tmp_path / "roads.geojsonl"
+    sibling.write_text("")
+
+    merge_regions(tmp_path, ["empty"], path)
+    assert json.loads(path.read_text())["features"] == []
+    assert sibling.exists()
+
+
+def _way_refs(path, way_id):
+    refs = []
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, w):
+            if w.id == way_id:
+                refs.extend(n.ref for n in w.nodes)
+
+    Handler().apply_file(str(path))
+    return refs
+
+
+def _features(OG):
+    return sorted(
+        json.dumps(feature, sort_keys=True) for feature in OG.edge_features()
+    )
+
+
+def test_apply_changes_matches_rebuild(tmp_path):
+    pbf_path = tmp_path / "grid.osm.pbf"
+    write_pbf(pbf_path, 6)
+    dem_path = tmp_path / "dems" / "grid.tif"
+    write_dem(dem_path, grid_bounds(6))
+    build_network(tmp_path, "grid")
+    # Edges get their own incline estimates before the changes.
+    infer_region_inclines(tmp_path, "grid", ["grid"])
+    estimated = OSMGraph.load(graph_path(tmp_path, "grid"))
+    assert estimated.G.edge_attrs[DEM_INCLINE].present.any()
+    unestimated = (~estimated.G.edge_attrs[DEM_INCLINE].present).sum()
+    street = _way_refs(pbf_path, 1)
+
+    # Retag a street as a sidewalk, move an intersection, delete a street
+    # and add a footway.
+    nds = "".join(f'<nd ref="{ref}"/>' for ref in street)
+    change_path = tmp_path / "changes.osc"
+    change_path.write_text(
+        f"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify>
+    <node id="8" version="2" lat="{LAT0 + 0.00105}" lon="{LON0 + 0.00102}"/>
+    <way id="1" version="2">
+      {nds}
+      <tag k="highway" v="footway"/>
+      <tag k="footway" v="sidewalk"/>
+    </way>
+  </modify>
+  <delete>
+    <way id="7" version="2"/>
+  </delete>
+  <create>
+    <node id="100001" version="1" lat="{LAT0 - 0.0005}" lon="{LON0}"/>
+    <way id="100001" version="1">
+      <nd ref="1"/>
+      <nd ref="100001"/>
+      <tag k="highway" v="footway"/>
+    </way>
+  </create>
+</osmChange>
+"""
+    )
+
+    # Mask the pixels around a few intersections, so that the edges meeting
+    # there fall back to their tagged inclines.
+    west, south = LON0 + 0.0015, LAT0 + 0.0005
+    east, north = LON0 + 0.0035, LAT0 + 0.0015
+    ring = [[west, south], [east, south], [east, north], [west, north]]
+    polygon = {"type": "MultiPolygon", "coordinates": [[ring + [ring[0]]]]}
+    mask_dem(str(dem_path), [polygon])
+
+    apply_region_changes(tmp_path, _region("grid"), [str(change_path)])
+    updated = OSMGraph.load(graph_path(tmp_path, "grid"))
+    osm_ids = set(updated.G.edge_attrs["osm_id"].values.tolist())
+    assert 100001 in osm_ids and 7 not in osm_ids
+    # Rebuilt edges don't keep the estimates of the edges they replace.
+    rebuilt_edges = np.isin(updated.G.edge_attrs["osm_id"].values, [1, 100001])
+    assert rebuilt_edges.any()
+    assert not updated.G.edge_attrs[DEM_INCLINE].present[rebuilt_edges].any()
+    infer_region_inclines(tmp_path, "grid", ["grid"])
+    updated = OSMGraph.load(graph_path(tmp_path, "grid"))
+    assert (~updated.G.edge_attrs[DEM_INCLINE].present).sum() > unestimated
+
+    # The extract was updated too, so building it from scratch gives the
+    # same graph.
+    build_network(tmp_path, "grid")
+    infer_region_inclines(tmp_path, "grid", ["grid"])
+    rebuilt = OSMGraph.load(graph_path(tmp_path, "grid"))
+    assert _features(updated) == _features(rebuilt)
+    assert sorted(updated.G.node_ids.tolist()) == sorted(
+        rebuilt.G.node_ids.tolist()
+    )